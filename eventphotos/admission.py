@@ -0,0 +1,161 @@
+import functools
+import os
+import threading
+
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+from rest_framework.request import Request
+
+try:
+    import fcntl
+except ImportError:
+    # no flock (Windows): only the per process limit applies
+    fcntl = None
+
+
+class ProcessSemaphore(object):
+    """
+    Counts the holders in this process against a limit which may change (settings).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def try_acquire(self, limit: int) -> bool:
+        with self.lock:
+            if self.count >= limit:
+                return False
+            self.count += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.count -= 1
+
+
+class FileSemaphore(object):
+    """
+    At most limit holders across all processes of the host: one lock file per slot below
+    UPLOAD_ADMISSION_LOCK_DIR/<name>, locked with flock while held. The slots of a crashed
+    process are released by the operating system.
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.directory = os.path.join(settings.UPLOAD_ADMISSION_LOCK_DIR, name)
+        self.limit = limit
+        self.fd = None
+
+    def try_acquire(self) -> bool:
+        if fcntl is None:
+            return True
+        os.makedirs(self.directory, exist_ok=True)
+        for slot in range(self.limit):
+            fd = os.open(os.path.join(self.directory, 'slot_{}'.format(slot)), os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            self.fd = fd
+            return True
+        return False
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+process_uploads = ProcessSemaphore()
+
+
+def process_limit() -> int:
+    """
+    Uploads per process: the worker threads minus the share reserved for reads (at least one).
+    """
+    return max(int(settings.UPLOAD_ADMISSION_WORKERS * (1 - settings.UPLOAD_ADMISSION_READ_RESERVE)), 1)
+
+
+def event_semaphore(event_pk) -> FileSemaphore:
+    return FileSemaphore('event_{}'.format(event_pk),
+                         settings.UPLOAD_ADMISSION_EVENT_LIMITS.get(event_pk, settings.UPLOAD_ADMISSION_EVENT_LIMIT))
+
+
+class Admission(object):
+    """
+    Slot for processing one upload of the user to the event: within the per process, global,
+    per event and per user limits of UPLOAD_ADMISSION_*.
+    """
+
+    def __init__(self, user_pk, event_pk=None):
+        self.semaphores = [FileSemaphore('global', settings.UPLOAD_ADMISSION_GLOBAL_LIMIT),
+                           FileSemaphore('user_{}'.format(user_pk),
+                                         settings.UPLOAD_ADMISSION_USER_LIMITS.get(
+                                             user_pk, settings.UPLOAD_ADMISSION_USER_LIMIT))]
+        if event_pk is not None:
+            self.semaphores.append(event_semaphore(event_pk))
+        self.acquired = []
+
+    def try_acquire(self) -> bool:
+        if not process_uploads.try_acquire(process_limit()):
+            return False
+        self.acquired.append(process_uploads)
+
+        for semaphore in self.semaphores:
+            if not semaphore.try_acquire():
+                self.release()
+                return False
+            self.acquired.append(semaphore)
+        return True
+
+    def try_acquire_event(self, event_pk) -> bool:
+        """
+        Additionally takes a slot of the event (known only once the request body is parsed).
+        """
+        semaphore = event_semaphore(event_pk)
+        if not semaphore.try_acquire():
+            return False
+        self.acquired.append(semaphore)
+        return True
+
+    def release(self):
+        for semaphore in reversed(self.acquired):
+            semaphore.release()
+        self.acquired = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def admission_controlled(view):
+    """
+    Processes the upload only when an Admission slot is free, otherwise answers 429 with Retry-After at once,
+    so uploads cannot occupy the workers needed by reads (neither processing nor waiting for a slot).
+    The process, global and user slots are taken before the request body is parsed, the event slot after.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not settings.UPLOAD_ADMISSION:
+            return view(*args, **kwargs)
+
+        request = next(arg for arg in args if isinstance(arg, Request))
+        admission = Admission(request.user.pk)
+        if not admission.try_acquire():
+            raise Throttled(wait=settings.UPLOAD_ADMISSION_RETRY_AFTER, detail='too many uploads in progress')
+        with admission:
+            try:
+                event_pk = int(request.data.get('event'))
+            except (TypeError, ValueError):
+                # rejected by the serializer
+                event_pk = None
+            if event_pk is not None and not admission.try_acquire_event(event_pk):
+                raise Throttled(wait=settings.UPLOAD_ADMISSION_RETRY_AFTER, detail='too many uploads in progress')
+            return view(*args, **kwargs)
+
+    return wrapper
@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class WphotosConfig(AppConfig):
     name = 'eventphotos'
+
+    def ready(self):
+        # register the signal receivers which invalidate cached tokens
+        import eventphotos.authentication
+        # and those which keep the search index and the best of rankings in sync
+        import eventphotos.search
+        import eventphotos.ranking
@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.authentication import SessionAuthentication, TokenAuthentication, get_authorization_header
+from rest_framework.authtoken.models import Token
+
+
+def token_cache_key(key: str) -> str:
+    return 'auth-token:{}'.format(key)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication which caches the (user, token) snapshot for AUTH_TOKEN_CACHE_TIMEOUT seconds.
+    The snapshot is invalidated when the token or its user changes.
+    """
+
+    def authenticate_credentials(self, key):
+        cache_key = token_cache_key(key)
+
+        credentials = cache.get(cache_key)
+        if credentials is None:
+            credentials = super(CachedTokenAuthentication, self).authenticate_credentials(key)
+            cache.set(cache_key, credentials, settings.AUTH_TOKEN_CACHE_TIMEOUT)
+
+        return credentials
+
+
+class TokenAwareSessionAuthentication(SessionAuthentication):
+    """
+    Session authentication which steps aside for requests with a token,
+    so that the session (and the user behind it) is never loaded for them.
+    """
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if auth and auth[0].lower() == TokenAuthentication.keyword.lower().encode():
+            return None
+
+        return super(TokenAwareSessionAuthentication, self).authenticate(request)
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance=None, **kwargs):
+    cache.delete(token_cache_key(instance.key))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_tokens(sender, instance=None, **kwargs):
+    keys = Token.objects.filter(user=instance).values_list('key', flat=True)
+    cache.delete_many([token_cache_key(key) for key in keys])
@@ -0,0 +1,165 @@
+import os
+import struct
+import zlib
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils.deconstruct import deconstructible
+
+from eventphotos import sharding
+from eventphotos.models import ArchivedFile, Photo
+from eventserver.storage import HashedFileSystemStorage
+
+# every entry of a container: name length, stored data size, compression, name, data
+# (the containers describe themselves, the index can be rebuilt from them)
+ENTRY_HEADER = struct.Struct('>HQB')
+STORED = 0
+ZLIB = 1
+
+
+def container_path(container: str) -> str:
+    return os.path.join(settings.COLD_STORAGE_ROOT, container)
+
+
+def read_archived(entry: ArchivedFile) -> bytes:
+    with open(container_path(entry.container), 'rb') as f:
+        f.seek(entry.offset)
+        if entry.compressed_size is None:
+            return f.read(entry.size)
+        return zlib.decompress(f.read(entry.compressed_size))
+
+
+class ColdStorageMixin(object):
+    """
+    Falls back to the cold storage containers for files moved there by archive_event,
+    so archived originals can still be opened under their name. Archived files are read-only.
+    """
+
+    def archived(self, name: str):
+        return ArchivedFile.objects.filter(name=name).first()
+
+    def _open(self, name, mode='rb'):
+        try:
+            return super(ColdStorageMixin, self)._open(name, mode)
+        except FileNotFoundError:
+            entry = self.archived(name)
+            if entry is None or 'b' not in mode or set(mode) - {'r', 'b'}:
+                raise
+            return File(BytesIO(read_archived(entry)), name)
+
+    def exists(self, name):
+        return super(ColdStorageMixin, self).exists(name) or self.archived(name) is not None
+
+    def size(self, name):
+        try:
+            return super(ColdStorageMixin, self).size(name)
+        except FileNotFoundError:
+            entry = self.archived(name)
+            if entry is None:
+                raise
+            return entry.size
+
+    def get_modified_time(self, name):
+        try:
+            return super(ColdStorageMixin, self).get_modified_time(name)
+        except FileNotFoundError:
+            entry = self.archived(name)
+            if entry is None:
+                raise
+            return entry.dt
+
+    def delete(self, name):
+        super(ColdStorageMixin, self).delete(name)
+        # the space in the container is not reclaimed
+        ArchivedFile.objects.filter(name=name).delete()
+
+    def delete_hot(self, name):
+        """
+        Deletes the file from the hot tier only.
+        """
+        super(ColdStorageMixin, self).delete(name)
+
+
+@deconstructible
+class TieredFileSystemStorage(ColdStorageMixin, HashedFileSystemStorage):
+    pass
+
+
+class ContainerWriter(object):
+    """
+    Appends files to the containers of an event (event_<id>/000001.pack, ...),
+    starting a new container when COLD_STORAGE_CONTAINER_SIZE would be exceeded.
+    Files are zlib compressed (COLD_STORAGE_COMPRESSION_LEVEL) if that makes them smaller,
+    already compressed formats (JPEG) are stored as they are.
+    """
+
+    def __init__(self, event_pk: int):
+        self.directory = 'event_{}'.format(event_pk)
+        os.makedirs(container_path(self.directory), exist_ok=True)
+        containers = sorted(os.listdir(container_path(self.directory)))
+        self.number = int(containers[-1].split('.')[0]) if containers else 1
+
+    def append(self, name: str, data: bytes) -> ArchivedFile:
+        compressed = zlib.compress(data, settings.COLD_STORAGE_COMPRESSION_LEVEL)
+        if len(compressed) < len(data):
+            return self._append(name, compressed, ZLIB, ArchivedFile(name=name, size=len(data),
+                                                                     compressed_size=len(compressed)))
+        return self._append(name, data, STORED, ArchivedFile(name=name, size=len(data)))
+
+    def _append(self, name: str, stored: bytes, compression: int, entry: ArchivedFile) -> ArchivedFile:
+        encoded_name = name.encode('utf8')
+        container = '{}/{:06d}.pack'.format(self.directory, self.number)
+        path = container_path(container)
+        if os.path.exists(path) and os.path.getsize(path) + len(stored) > settings.COLD_STORAGE_CONTAINER_SIZE:
+            self.number += 1
+            return self._append(name, stored, compression, entry)
+
+        with open(path, 'ab') as f:
+            offset = f.tell() + ENTRY_HEADER.size + len(encoded_name)
+            f.write(ENTRY_HEADER.pack(len(encoded_name), len(stored), compression) + encoded_name)
+            f.write(stored)
+            f.flush()
+            os.fsync(f.fileno())
+
+        entry.container, entry.offset = container, offset
+        return entry
+
+
+def archive_event(event_pk: int, dry_run: bool = False):
+    """
+    Moves the originals of the photos of the event into cold storage containers, losslessly compressed
+    (not re-encoded, which could drop metadata chunks and would change the content clients know by hash_md5).
+    Returns (number of files, their size).
+    """
+    storage = default_storage
+    if not isinstance(storage, ColdStorageMixin):
+        raise ValueError('DEFAULT_FILE_STORAGE has no cold storage')
+
+    upload_to = Photo._meta.get_field('photo').upload_to + '/'
+    photos = sharding.using_event(Photo.objects, event_pk).filter(event_id=event_pk)
+
+    writer = None
+    count = size = 0
+    for pk, name in photos.order_by('pk').values_list('pk', 'photo').iterator():
+        if not name.startswith(upload_to) or not os.path.isfile(storage.path(name)):
+            # not uploaded through the field, or already archived
+            continue
+        if ArchivedFile.objects.filter(name=name).exists():
+            # an earlier run was interrupted before deleting the file
+            storage.delete_hot(name)
+            continue
+
+        count += 1
+        size += os.path.getsize(storage.path(name))
+        if dry_run:
+            continue
+
+        with open(storage.path(name), 'rb') as f:
+            data = f.read()
+        writer = writer or ContainerWriter(event_pk)
+        writer.append(name, data).save()
+        storage.delete_hot(name)
+
+    return count, size
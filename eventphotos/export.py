@@ -0,0 +1,254 @@
+import hashlib
+import os
+import struct
+import zlib
+
+import dateutil.parser
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+
+from eventphotos import sharding
+from eventphotos.media import parse_range
+from eventphotos.models import Photo
+
+CHUNK_SIZE = 64 * 1024
+
+# zip 2.0, zip64 4.5
+VERSION = 20
+VERSION_ZIP64 = 45
+# utf-8 names (crc and sizes are in the local headers, no data descriptors)
+FLAGS = 0x800
+
+
+class ZipEntry(object):
+    def __init__(self, name: str, storage_name: str, size: int, dt, crc: int):
+        self.name = name
+        self.storage_name = storage_name
+        self.size = size
+        self.dt = dt
+        self.crc = crc
+        self.offset = 0
+
+
+def file_crc(name: str) -> int:
+    crc = 0
+    with default_storage.open(name, 'rb') as f:
+        for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(data, crc)
+    return crc
+
+
+def event_entries(event_id, owner_id=None, from_dt=None, to_dt=None):
+    """
+    Returns the zip entries of the visible originals of an event in a deterministic order.
+    CRCs missing in Photo.crc32 (photos uploaded before it was stored) are computed and stored.
+    """
+    photos = sharding.using_event(Photo.objects, event_id).filter(event_id=event_id, visible=True)
+    if owner_id is not None:
+        photos = photos.filter(owner_id=owner_id)
+    if from_dt is not None:
+        photos = photos.filter(photo_dt__gte=from_dt)
+    if to_dt is not None:
+        photos = photos.filter(photo_dt__lt=to_dt)
+
+    entries = []
+    for photo in photos.order_by('photo_dt', 'pk').only('pk', 'photo', 'photo_dt', 'crc32'):
+        try:
+            size = default_storage.size(photo.photo.name)
+            if photo.crc32 is None:
+                photo.crc32 = file_crc(photo.photo.name)
+                photos.filter(pk=photo.pk).update(crc32=photo.crc32)
+        except (OSError, SuspiciousFileOperation):
+            # file missing
+            continue
+        dt = timezone.localtime(photo.photo_dt) if timezone.is_aware(photo.photo_dt) else photo.photo_dt
+        name = '{:%Y-%m-%d_%H-%M-%S}_{}{}'.format(dt, photo.pk, os.path.splitext(photo.photo.name)[1].lower())
+        entries.append(ZipEntry(name, photo.photo.name, size, dt, photo.crc32))
+    return entries
+
+
+def parse_dt(value: str):
+    """
+    Parses a date (time) filter parameter, naive values are in the current time zone.
+    Raises ValueError.
+    """
+    dt = dateutil.parser.parse(value)
+    return timezone.make_aware(dt) if timezone.is_naive(dt) else dt
+
+
+def zip_response(request, archive, filename: str):
+    """
+    Streams the archive, supports a single Range (and If-Range) to resume downloads.
+    """
+    start, end = 0, archive.size - 1
+    status = 200
+
+    range_header = request.META.get('HTTP_RANGE', None)
+    if range_header is not None and request.META.get('HTTP_IF_RANGE', archive.etag) == archive.etag:
+        byte_range = parse_range(range_header, archive.size)
+        if byte_range is None:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(archive.size)
+            return response
+        start, end = byte_range
+        status = 206
+
+    content = archive.range(start, end) if request.method != 'HEAD' else iter([])
+    response = StreamingHttpResponse(content, status=status, content_type='application/zip')
+    response['Content-Length'] = end - start + 1
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = archive.etag
+    if status == 206:
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, archive.size)
+    return response
+
+
+class ZipStream(object):
+    """
+    Zip archive of stored (uncompressed, photos are compressed already) entries, generated on the fly.
+
+    The layout only depends on names, sizes, dates and CRCs of the entries, so the archive size is known
+    in advance and any byte range can be generated without reading the files before it. CRCs and sizes
+    are written in the local headers (no data descriptors), which streaming unzippers require.
+    Entries and archives beyond zip64_limit use zip64 records.
+    """
+    zip64_limit = 0xffffffff
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+
+        # (offset, length, generator function of (start, end) within the segment)
+        self.segments = []
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            for length, generate in [
+                (len(self.local_header(entry)), self.static(self.local_header, entry)),
+                (entry.size, self.file_data(entry)),
+            ]:
+                self.segments.append((offset, length, generate))
+                offset += length
+
+        self.central_directory_offset = offset
+        self.central_directory_size = sum(len(self.central_directory_header(entry)) for entry in self.entries)
+        offset += self.central_directory_size
+        self.segments.append((self.central_directory_offset, self.central_directory_size, self.central_directory))
+        self.segments.append((offset, len(self.end_records()), self.static(self.end_records)))
+        self.size = offset + len(self.end_records())
+
+    @property
+    def etag(self) -> str:
+        layout = '\n'.join('{}:{}:{}:{}'.format(entry.name, entry.size, entry.dt.isoformat(), entry.crc)
+                           for entry in self.entries)
+        return '"{}"'.format(hashlib.md5(layout.encode('utf8')).hexdigest())
+
+    def __iter__(self):
+        return self.range(0, self.size - 1)
+
+    def range(self, start: int, end: int):
+        """
+        Generates the bytes start to end (inclusive) of the archive.
+        """
+        for offset, length, generate in self.segments:
+            if offset + length <= start or length == 0:
+                continue
+            if offset > end:
+                break
+            yield from generate(max(start - offset, 0), min(end - offset, length - 1))
+
+    # segments
+
+    @staticmethod
+    def static(fn, *args):
+        def generate(start, end):
+            yield fn(*args)[start:end + 1]
+        return generate
+
+    def file_data(self, entry):
+        def generate(start, end):
+            with default_storage.open(entry.storage_name, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    data = f.read(min(CHUNK_SIZE, remaining))
+                    if not data:
+                        raise IOError('{} is shorter than {} bytes'.format(entry.storage_name, entry.size))
+                    remaining -= len(data)
+                    yield data
+        return generate
+
+    def central_directory(self, start, end):
+        chunk = []
+        position = 0
+        for entry in self.entries:
+            header = self.central_directory_header(entry)
+            length = len(header)
+            if position > end:
+                break
+            if position + length > start:
+                chunk.append(header[max(start - position, 0):end - position + 1])
+                if len(chunk) * length >= CHUNK_SIZE:
+                    yield b''.join(chunk)
+                    chunk = []
+            position += length
+        yield b''.join(chunk)
+
+    # records
+
+    def is_zip64(self, entry) -> bool:
+        return entry.size >= self.zip64_limit or entry.offset >= self.zip64_limit
+
+    @staticmethod
+    def dos_date_time(dt):
+        year = min(max(dt.year, 1980), 2107)
+        return ((year - 1980) << 9 | dt.month << 5 | dt.day,
+                dt.hour << 11 | dt.minute << 5 | dt.second // 2)
+
+    def local_header(self, entry) -> bytes:
+        name = entry.name.encode('utf8')
+        date, time = self.dos_date_time(entry.dt)
+        if self.is_zip64(entry):
+            # the sizes are in the zip64 extra field
+            extra = struct.pack('<HHQQ', 0x0001, 16, entry.size, entry.size)
+            size = 0xffffffff
+            version = VERSION_ZIP64
+        else:
+            extra = b''
+            size = entry.size
+            version = VERSION
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, version, FLAGS, 0, time, date, entry.crc, size, size,
+                           len(name), len(extra)) + name + extra
+
+    def central_directory_header(self, entry) -> bytes:
+        name = entry.name.encode('utf8')
+        date, time = self.dos_date_time(entry.dt)
+        if self.is_zip64(entry):
+            extra = struct.pack('<HHQQQ', 0x0001, 24, entry.size, entry.size, entry.offset)
+            size = offset = 0xffffffff
+            version = VERSION_ZIP64
+        else:
+            extra = b''
+            size, offset = entry.size, entry.offset
+            version = VERSION
+        # made by unix (file permissions rw-r--r--)
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | version, version, FLAGS, 0, time, date,
+                           entry.crc, size, size, len(name), len(extra), 0, 0, 0, 0o100644 << 16,
+                           offset) + name + extra
+
+    def end_records(self) -> bytes:
+        count = len(self.entries)
+        size = self.central_directory_size
+        offset = self.central_directory_offset
+
+        records = b''
+        if count >= 0xffff or size >= self.zip64_limit or offset >= self.zip64_limit:
+            zip64_offset = offset + size
+            records += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, VERSION_ZIP64, VERSION_ZIP64, 0, 0,
+                                   count, count, size, offset)
+            records += struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1)
+            count, size, offset = 0xffff, 0xffffffff, 0xffffffff
+        records += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, size, offset, 0)
+        return records
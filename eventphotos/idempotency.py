@@ -0,0 +1,89 @@
+import functools
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+
+PENDING = 0
+DONE = 1
+
+
+class RequestInProgress(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'a request with this Idempotency-Key is in progress'
+
+
+class KeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = 'the Idempotency-Key was used for a different request'
+
+
+def fingerprint(request: Request) -> str:
+    """
+    Hash of the request data, uploaded files are represented by name and size.
+    """
+    items = []
+    for key in sorted(request.data.keys()) if hasattr(request.data, 'keys') else []:
+        value = request.data[key]
+        if hasattr(value, 'size'):
+            value = (getattr(value, 'name', None), value.size)
+        items.append((key, value))
+    return hashlib.md5(repr((request.path, items)).encode('utf8')).hexdigest()[:16]
+
+
+def idempotent(view):
+    """
+    Replays the response of a POST for retries with the same Idempotency-Key header (per user),
+    so the request is processed only once. Responses are kept in the 'idempotency' cache for
+    IDEMPOTENCY_KEY_TIMEOUT seconds, failed requests (exceptions, server errors) are not kept, so they can be
+    retried. Requests without the header are not affected.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        request = next(arg for arg in args if isinstance(arg, Request))
+        key = request.META.get(HEADER, None)
+        if key is None:
+            return view(*args, **kwargs)
+        if not 0 < len(key) <= settings.IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise ValidationError('invalid Idempotency-Key')
+
+        cache = caches['idempotency']
+        cache_key = 'idempotency:{}:{}'.format(request.user.pk, hashlib.md5(key.encode('utf8')).hexdigest())
+        request_fingerprint = fingerprint(request)
+
+        if not cache.add(cache_key, (PENDING, request_fingerprint), settings.IDEMPOTENCY_PENDING_TIMEOUT):
+            entry = cache.get(cache_key)
+            if entry is not None:
+                if entry[1] != request_fingerprint:
+                    raise KeyReused()
+                if entry[0] == PENDING:
+                    raise RequestInProgress()
+                response = Response(entry[3], status=entry[2], headers=entry[4])
+                response['Idempotent-Replayed'] = 'true'
+                return response
+            # expired in between
+            cache.add(cache_key, (PENDING, request_fingerprint), settings.IDEMPOTENCY_PENDING_TIMEOUT)
+
+        try:
+            response = view(*args, **kwargs)
+        except Exception:
+            # errors are rendered by the exception handler later on, the client may retry
+            cache.delete(cache_key)
+            raise
+
+        if response.status_code < 500 and hasattr(response, 'data'):
+            headers = {header: response[header] for header in ('Location',) if response.has_header(header)}
+            cache.set(cache_key, (DONE, request_fingerprint, response.status_code, response.data, headers),
+                      settings.IDEMPOTENCY_KEY_TIMEOUT)
+        else:
+            cache.delete(cache_key)
+        return response
+
+    return wrapper
@@ -0,0 +1,224 @@
+"""
+Write-behind buffer for like toggles (LIKE_WRITE_BEHIND).
+
+The buffer lives in the memory of each process. With several worker processes, a toggle is only visible to
+requests served by the process which buffered it until it is flushed, so a user may not see their own like
+(and like counts lag) for up to LIKE_WRITE_BEHIND_FLUSH_INTERVAL milliseconds when the next request goes to
+another worker.
+"""
+
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from eventphotos import sharding
+from eventphotos.models import Like, Photo, batched_counts, count_likes
+
+try:
+    import fcntl
+except ImportError:
+    # no flock (Windows): only the journal of a process with the same pid is replayed
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class LikeBuffer(object):
+    """
+    Write-behind buffer for like toggles.
+
+    Toggles are collected in memory (last write wins per (user, photo)) and written to the database
+    in one transaction every LIKE_WRITE_BEHIND_FLUSH_INTERVAL milliseconds, or as soon as
+    LIKE_WRITE_BEHIND_MAX_PENDING toggles are pending. Pending toggles are lost on a crash unless
+    LIKE_WRITE_BEHIND_JOURNAL is set: every process appends each toggle to its own journal
+    <LIKE_WRITE_BEHIND_JOURNAL>.<pid> before it is acknowledged (and fsync's it if LIKE_WRITE_BEHIND_JOURNAL_FSYNC
+    is set), and truncates it after a flush. The journal is flock'ed while the process lives, on start up a process
+    takes over the journals of processes which are gone.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # photo pk -> user pk -> (like, liked in the database when the toggle was buffered or None if unknown)
+        self.pending = {}
+        self.pending_count = 0
+        self.thread = None
+        self.journal = None
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return getattr(settings, 'LIKE_WRITE_BEHIND', False)
+
+    def add(self, user_pk: int, photo_pk: int, like: bool, liked_in_db: bool):
+        with self.lock:
+            self._start()
+
+            self._add(user_pk, photo_pk, like, liked_in_db)
+            self._write_journal(user_pk, photo_pk, like)
+
+            if self.pending_count >= settings.LIKE_WRITE_BEHIND_MAX_PENDING:
+                self.flush()
+
+    def _add(self, user_pk: int, photo_pk: int, like: bool, liked_in_db):
+        photo_pending = self.pending.setdefault(photo_pk, {})
+        if user_pk in photo_pending:
+            # keep the database state of the first toggle
+            liked_in_db = photo_pending[user_pk][1]
+        else:
+            self.pending_count += 1
+        photo_pending[user_pk] = (like, liked_in_db)
+
+    def is_liked(self, user_pk: int, photo_pk: int):
+        """
+        Returns the pending like state or None if there is no pending toggle.
+        """
+        with self.lock:
+            entry = self.pending.get(photo_pk, {}).get(user_pk, None)
+            return None if entry is None else entry[0]
+
+    def like_delta(self, photo_pk: int) -> int:
+        """
+        Returns the change of the like count of the photo caused by the pending toggles.
+        """
+        with self.lock:
+            return sum(int(like) - int(liked_in_db)
+                       for like, liked_in_db in self.pending.get(photo_pk, {}).values()
+                       if liked_in_db is not None)
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+
+            # the lock is held while writing, so that reads never miss a toggle
+            pending_by_db = {}
+            for photo_pk, photo_pending in self.pending.items():
+                # likes of different events live in different databases
+                db = sharding.event_database(sharding.event_id_for_pk(photo_pk)) if sharding.is_enabled() \
+                    else 'default'
+                for user_pk, entry in photo_pending.items():
+                    pending_by_db.setdefault(db, {})[(user_pk, photo_pk)] = entry
+
+            for db, pending in pending_by_db.items():
+                self._write(pending, db)
+
+            self.pending = {}
+            self.pending_count = 0
+            self._truncate_journal()
+
+    @staticmethod
+    def _write(pending, db: str):
+        user_pks = {user_pk for user_pk, _ in pending}
+        photo_pks = {photo_pk for _, photo_pk in pending}
+
+        with transaction.atomic(using=db), batched_counts():
+            # photos may have been deleted in the meantime
+            photo_pks = set(Photo.objects.using(db).filter(pk__in=photo_pks).values_list('pk', flat=True))
+
+            existing = {(user_pk, photo_pk): pk for pk, user_pk, photo_pk in
+                        Like.objects.using(db).filter(owner__pk__in=user_pks, photo__pk__in=photo_pks)
+                        .values_list('pk', 'owner__pk', 'photo__pk')}
+
+            # bulk_create does not call Like.save, hence set dt here
+            now = timezone.now()
+            created = Like.objects.db_manager(db).bulk_create(
+                Like(owner_id=user_pk, photo_id=photo_pk, dt=now)
+                for (user_pk, photo_pk), (like, _) in pending.items()
+                if like and photo_pk in photo_pks and (user_pk, photo_pk) not in existing)
+            # bulk_create does not send post_save either
+            count_likes([like.photo_id for like in created], 1, db)
+
+            deleted_pks = [existing[key] for key, (like, _) in pending.items() if not like and key in existing]
+            if deleted_pks:
+                Like.objects.using(db).filter(pk__in=deleted_pks).delete()
+
+    def _start(self):
+        if self.thread is not None:
+            return
+
+        self._replay_journal()
+
+        interval = settings.LIKE_WRITE_BEHIND_FLUSH_INTERVAL
+        if interval:
+            self.thread = threading.Thread(target=self._run, args=(interval / 1000,), daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def _run(self, interval: float):
+        stopped = threading.Event()
+        while not stopped.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('flushing likes failed')
+            finally:
+                # the thread has its own connection, do not keep it open between flushes
+                connection.close()
+
+    def _replay_journal(self):
+        path = settings.LIKE_WRITE_BEHIND_JOURNAL
+        if not path or self.journal is not None:
+            return
+
+        own_path = '{}.{}'.format(path, os.getpid())
+        self.journal = open(own_path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self.journal.fileno(), fcntl.LOCK_EX)
+        # left over by an earlier process with the same pid
+        for user_pk, photo_pk, like in self._read_journal(own_path):
+            self._add(user_pk, photo_pk, like, None)
+
+        if fcntl is None:
+            return
+        # journals of other processes (and the single journal of earlier versions): only those of processes
+        # which are gone are not locked, their toggles move to this process' journal
+        for other_path in sorted(glob.glob(glob.escape(path) + '.*')) + [path]:
+            suffix = other_path[len(path) + 1:]
+            if other_path == own_path or (other_path != path and not suffix.isdigit()) \
+                    or not os.path.exists(other_path):
+                continue
+            with open(other_path) as other:
+                try:
+                    fcntl.flock(other.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                for user_pk, photo_pk, like in self._read_journal(other_path):
+                    self._add(user_pk, photo_pk, like, None)
+                    self._write_journal(user_pk, photo_pk, like)
+                os.remove(other_path)
+
+    @staticmethod
+    def _read_journal(path: str):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # incomplete last line
+                    continue
+                yield entry['user'], entry['photo'], entry['like']
+
+    def _write_journal(self, user_pk: int, photo_pk: int, like: bool):
+        if self.journal is None:
+            return
+
+        self.journal.write(json.dumps({'user': user_pk, 'photo': photo_pk, 'like': like}) + '\n')
+        self.journal.flush()
+        if settings.LIKE_WRITE_BEHIND_JOURNAL_FSYNC:
+            os.fsync(self.journal.fileno())
+
+    def _truncate_journal(self):
+        if self.journal is None:
+            return
+
+        self.journal.seek(0)
+        self.journal.truncate()
+
+
+like_buffer = LikeBuffer()
@@ -0,0 +1,39 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from eventphotos.coldstorage import archive_event
+from eventphotos.models import Event
+
+
+class Command(BaseCommand):
+    help = 'Moves the original photos of events which ended COLD_STORAGE_AFTER_DAYS ago into cold storage ' \
+           'containers (thumbnails and web photos stay). Archived originals can still be downloaded.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.COLD_STORAGE_AFTER_DAYS,
+                            help='archive events which ended at least this many days ago')
+        parser.add_argument('--event', type=int, help='only this event (regardless of its end)')
+        parser.add_argument('--dry-run', action='store_true', help='only report what would be archived')
+
+    def handle(self, *args, **options):
+        if options['event'] is not None:
+            events = Event.objects.filter(pk=options['event'])
+        else:
+            events = Event.objects.filter(end_dt__lt=timezone.now() - timedelta(days=options['days']))
+
+        total = total_size = 0
+        for event in events.order_by('pk'):
+            try:
+                count, size = archive_event(event.pk, dry_run=options['dry_run'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            if count:
+                self.stdout.write('event {}: {} originals, {} bytes'.format(event.pk, count, size))
+            total += count
+            total_size += size
+
+        self.stdout.write('{} {} originals, {} bytes'.format(
+            'would archive' if options['dry_run'] else 'archived', total, total_size))
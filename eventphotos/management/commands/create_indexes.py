@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Min
+
+from eventphotos.models import Like, Photo, UserAuthenticatedForEvent
+from eventphotos.search import photo_databases
+
+
+class Command(BaseCommand):
+    help = 'Creates the indexes and unique constraints of photos, likes and event authorisations which are missing ' \
+           'in databases created before they were declared (by migrate --run-syncdb or as event database), ' \
+           'duplicate authorisations are removed first.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='only report what would be created')
+
+    def handle(self, *args, **options):
+        created = removed = 0
+        for using in photo_databases():
+            connection = connections[using]
+            for model in [Photo, Like, UserAuthenticatedForEvent]:
+                with connection.cursor() as cursor:
+                    constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+                unique = {tuple(constraint['columns']) for constraint in constraints.values() if constraint['unique']}
+                missing_unique = [fields for fields in model._meta.unique_together
+                                  if tuple(model._meta.get_field(field).column for field in fields) not in unique]
+                missing_indexes = [index for index in model._meta.indexes if index.name not in constraints]
+
+                for fields in missing_unique:
+                    self.stdout.write('{}: unique {} {}'.format(using, model._meta.db_table, ', '.join(fields)))
+                for index in missing_indexes:
+                    self.stdout.write('{}: index {}'.format(using, index.name))
+                created += len(missing_unique) + len(missing_indexes)
+                if options['dry_run']:
+                    continue
+
+                with transaction.atomic(using=using):
+                    if missing_unique:
+                        removed += self.remove_duplicates(model, using, missing_unique)
+                    with connection.schema_editor() as editor:
+                        editor.alter_unique_together(model, [], missing_unique)
+                        for index in missing_indexes:
+                            editor.add_index(model, index)
+
+        self.stdout.write('{} {} indexes, {} duplicates removed'.format(
+            'would create' if options['dry_run'] else 'created', created, removed))
+
+    def remove_duplicates(self, model, using, unique_together) -> int:
+        removed = 0
+        for fields in unique_together:
+            objects = model.objects.using(using).order_by()
+            first = objects.values(*fields).annotate(first=Min('pk')).values_list('first', flat=True)
+            removed += objects.exclude(pk__in=list(first)).delete()[1].get(model._meta.label, 0)
+        return removed
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from eventphotos.models import Event
+from eventphotos.stats import rebuild_event_stats, verify_event_stats
+
+
+class Command(BaseCommand):
+    help = 'Compares the incrementally maintained event statistics with counts of the photos and likes ' \
+           'and reports the differences. --rebuild recounts the statistics of inconsistent events ' \
+           '(e.g. after an upgrade, for photos and likes which existed before).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', type=int, help='only this event')
+        parser.add_argument('--rebuild', action='store_true', help='recount inconsistent events')
+
+    def handle(self, *args, **options):
+        events = Event.objects.all()
+        if options['event'] is not None:
+            events = events.filter(pk=options['event'])
+
+        checked = inconsistent = 0
+        for event_pk in events.order_by('pk').values_list('pk', flat=True):
+            checked += 1
+            differences = verify_event_stats(event_pk)
+            if not differences:
+                continue
+
+            inconsistent += 1
+            for counter, key, stored, counted in differences:
+                self.stdout.write('event {}: {} {}: stored {}, counted {}'.format(event_pk, counter, key, stored, counted))
+            if options['rebuild']:
+                rebuild_event_stats(event_pk)
+
+        self.stdout.write('{} events, {} inconsistent{}'.format(
+            checked, inconsistent, ' (rebuilt)' if options['rebuild'] and inconsistent else ''))
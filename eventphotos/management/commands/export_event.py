@@ -0,0 +1,42 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from eventphotos import export
+from eventphotos.models import Event
+
+
+class Command(BaseCommand):
+    help = 'Writes a zip archive of the visible original photos of an event (same layout as the export endpoint).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('event_id', type=int)
+        parser.add_argument('output', help="zip file, '-' for stdout")
+        parser.add_argument('--owner', type=int, help='only photos of this user id')
+        parser.add_argument('--from', dest='from_dt', help='only photos taken at or after this date (time)')
+        parser.add_argument('--to', dest='to_dt', help='only photos taken before this date (time)')
+
+    def handle(self, *args, **options):
+        if not Event.objects.filter(pk=options['event_id']).exists():
+            raise CommandError('event {} does not exist'.format(options['event_id']))
+
+        try:
+            entries = export.event_entries(
+                options['event_id'], owner_id=options['owner'],
+                from_dt=export.parse_dt(options['from_dt']) if options['from_dt'] else None,
+                to_dt=export.parse_dt(options['to_dt']) if options['to_dt'] else None)
+        except (ValueError, OverflowError) as e:
+            raise CommandError('invalid date: {}'.format(e))
+
+        archive = export.ZipStream(entries)
+        if options['output'] == '-':
+            output = sys.stdout.buffer
+            for data in archive:
+                output.write(data)
+            output.flush()
+        else:
+            with open(options['output'], 'wb') as output:
+                for data in archive:
+                    output.write(data)
+            self.stderr.write('{} photos, {} bytes written to {}'.format(
+                len(archive.entries), archive.size, options['output']))
@@ -0,0 +1,80 @@
+from django.core.files.storage import default_storage, FileSystemStorage
+from django.core.management.base import BaseCommand, CommandError
+
+from eventphotos import sharding
+from eventphotos.models import Event, Photo
+from eventserver.storage import HashedNameMixin
+
+
+class Command(BaseCommand):
+    help = 'Moves the media files of events and photos into the hash-prefixed directories of the file storage ' \
+           '(DEFAULT_FILE_STORAGE) and updates their names in the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='only report what would be moved')
+        parser.add_argument('--from-local', action='store_true',
+                            help='read the files from MEDIA_ROOT, e.g. to move them into S3Storage')
+
+    def handle(self, *args, **options):
+        if not isinstance(default_storage, HashedNameMixin):
+            raise CommandError('DEFAULT_FILE_STORAGE does not use hash-prefixed directories')
+
+        self.dry_run = options['dry_run']
+        self.from_local = options['from_local']
+        self.source = FileSystemStorage() if self.from_local else default_storage
+        self.moved = self.missing = 0
+
+        self.migrate(Event, Event.objects.all(), ['icon'])
+        if sharding.is_enabled():
+            for event_pk in Event.objects.values_list('pk', flat=True):
+                self.migrate(Photo, sharding.using_event(Photo.objects, event_pk), ['photo', 'thumbnail', 'web_photo'])
+        else:
+            self.migrate(Photo, Photo.objects.all(), ['photo', 'thumbnail', 'web_photo'])
+
+        self.stdout.write('{} {} files, {} missing'.format(
+            'would move' if self.dry_run else 'moved', self.moved, self.missing))
+
+    def migrate(self, model, queryset, fields):
+        for row in queryset.order_by('pk').values_list('pk', *fields).iterator():
+            pk, names = row[0], row[1:]
+
+            moves = {}
+            for field, name in zip(fields, names):
+                new_name = self.new_name(model, field, name)
+                if new_name is None:
+                    continue
+                if not self.source.exists(name):
+                    self.stderr.write('{} {}: {} is missing'.format(model._meta.label, pk, name))
+                    self.missing += 1
+                    continue
+                moves[field] = (name, new_name)
+            if not moves:
+                continue
+
+            self.moved += len(moves)
+            if self.dry_run:
+                continue
+
+            # copy, switch the database to the copies, then delete the originals:
+            # an interruption leaves at most an unreferenced copy behind
+            updates = {}
+            for field, (name, new_name) in moves.items():
+                with self.source.open(name, 'rb') as f:
+                    updates[field] = default_storage.save(new_name, f)
+            queryset.filter(pk=pk).update(**updates)
+            for name, new_name in moves.values():
+                self.source.delete(name)
+
+    def new_name(self, model, field, name):
+        """
+        Returns the hash-prefixed name of a file of the field or None if it does not have to be moved.
+        """
+        upload_to = model._meta.get_field(field).upload_to
+        if not name or not name.startswith(upload_to + '/'):
+            # no file or not uploaded through the field
+            return None
+
+        new_name = HashedNameMixin.fan_out('{}/{}'.format(upload_to, name.rsplit('/', 1)[-1]))
+        if new_name == name and (not self.from_local or isinstance(default_storage, FileSystemStorage)):
+            return None
+        return new_name
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from eventphotos.models import Event
+from eventphotos.ranking import rank_event
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the "best of" rankings of the events from all of their photos. The rankings are updated ' \
+           'incrementally, run this periodically to catch up on photos which lost the ranking its place.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', type=int, help='only this event')
+
+    def handle(self, *args, **options):
+        events = Event.objects.all()
+        if options['event'] is not None:
+            events = events.filter(pk=options['event'])
+
+        count = 0
+        for event_pk in events.order_by('pk').values_list('pk', flat=True):
+            rank_event(event_pk)
+            count += 1
+
+        self.stdout.write('ranked {} events'.format(count))
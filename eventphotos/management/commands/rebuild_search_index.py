@@ -0,0 +1,31 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from eventphotos.models import Photo
+from eventphotos.search import TABLE, create_table, index_photos, is_available, photo_databases
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full text search index of the photo comments and owner names ' \
+           '(e.g. for photos uploaded before it existed).'
+
+    def handle(self, *args, **options):
+        databases = photo_databases()
+        if not all(is_available(using) for using in databases):
+            raise CommandError('photo search needs SQLite with FTS5')
+        names = dict(User.objects.values_list('pk', 'first_name'))
+
+        total = 0
+        for using in databases:
+            photos = Photo.objects.using(using).order_by('pk').values_list('pk', 'comment', 'owner_id', 'event_id')
+            create_table(using)
+            with transaction.atomic(using=using):
+                with connections[using].cursor() as cursor:
+                    cursor.execute('DELETE FROM {}'.format(TABLE))
+                rows = [(pk, comment, names.get(owner_pk, ''), event_pk)
+                        for pk, comment, owner_pk, event_pk in photos.iterator()]
+                index_photos(rows, using)
+            total += len(rows)
+
+        self.stdout.write('indexed {} photos'.format(total))
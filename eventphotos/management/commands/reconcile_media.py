@@ -0,0 +1,142 @@
+import heapq
+import posixpath
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from eventphotos import sharding, sprites
+from eventphotos.coldstorage import ColdStorageMixin
+from eventphotos.models import ArchivedFile, Event, Photo, MEDIA_FIELDS, media_directories
+
+
+def walk(storage, directory: str):
+    """
+    Yields the names of all files below the directory in sorted (string) order,
+    holding one directory listing per level in memory.
+    """
+    try:
+        directories, files = storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    # a directory sorts like its files: 'a-b' < 'a/x'
+    entries = sorted([(name + '/', True) for name in directories] + [(name, False) for name in files])
+    for name, is_directory in entries:
+        path = posixpath.join(directory, name.rstrip('/'))
+        if is_directory:
+            yield from walk(storage, path)
+        else:
+            yield path
+
+
+def field_names(queryset, field: str, batch_size: int = 1000):
+    """
+    Yields the distinct values of the field in sorted order, batch_size at a time.
+    """
+    last = None
+    while True:
+        batch = queryset if last is None else queryset.filter(**{field + '__gt': last})
+        names = list(batch.order_by(field).values_list(field, flat=True).distinct()[:batch_size])
+        yield from names
+        if len(names) < batch_size:
+            return
+        last = names[-1]
+
+
+def unique(names):
+    previous = None
+    for name in names:
+        if name != previous:
+            yield name
+        previous = name
+
+
+class Command(BaseCommand):
+    help = 'Compares the media files (including archived ones) with the file names in the database: ' \
+           'reports (and deletes) files nobody refers to and reports referenced files which are missing. ' \
+           'Also reports (and deletes) sprite sheets which are no longer used.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true', help='delete orphaned files')
+        parser.add_argument('--min-age', type=int, default=3600,
+                            help='seconds before an unreferenced file counts as orphaned (uploads in progress)')
+
+    def handle(self, *args, **options):
+        min_mtime = timezone.now() - timedelta(seconds=options['min_age'])
+        files = orphans = deleted = missing = 0
+
+        # a file may be on hot storage and archived (interrupted archive_originals), it is one file
+        stored = unique(heapq.merge(*[walk(default_storage, directory) for directory in media_directories()],
+                                    field_names(ArchivedFile.objects.all(), 'name')))
+        referenced = unique(heapq.merge(*self.references()))
+
+        # merge join of both sorted streams
+        name, reference = next(stored, None), next(referenced, None)
+        while name is not None or reference is not None:
+            if reference is None or (name is not None and name < reference):
+                files += 1
+                if default_storage.get_modified_time(name) < min_mtime:
+                    orphans += 1
+                    self.stdout.write('orphaned {}'.format(name))
+                    if options['delete']:
+                        self.delete_orphan(name)
+                        deleted += 1
+                name = next(stored, None)
+            elif name is None or reference < name:
+                missing += 1
+                self.stdout.write('missing {}'.format(reference))
+                reference = next(referenced, None)
+            else:
+                files += 1
+                name, reference = next(stored, None), next(referenced, None)
+
+        # sprite sheets are rewritten while their coordinates are cached, older ones are not handed out any more
+        sheets = expired = deleted_sheets = 0
+        min_sheet_mtime = min_mtime - timedelta(seconds=settings.PHOTO_SPRITE_CACHE_TIMEOUT)
+        for name in walk(default_storage, sprites.SPRITE_DIR):
+            sheets += 1
+            if default_storage.get_modified_time(name) < min_sheet_mtime:
+                expired += 1
+                self.stdout.write('expired {}'.format(name))
+                if options['delete']:
+                    self.delete_hot(name)
+                    deleted_sheets += 1
+        self.stdout.write('{} sprite sheets, {} expired ({} deleted)'.format(sheets, expired, deleted_sheets))
+
+        self.stdout.write('{} files, {} orphaned ({} deleted), {} missing'.format(files, orphans, deleted, missing))
+
+    @staticmethod
+    def delete_hot(name: str):
+        if isinstance(default_storage, ColdStorageMixin):
+            default_storage.delete_hot(name)
+        else:
+            default_storage.delete(name)
+
+    def delete_orphan(self, name: str):
+        """
+        Deletes the hot copy of the unreferenced file and its archive entry (the container space is not reclaimed).
+        """
+        self.delete_hot(name)
+        ArchivedFile.objects.filter(name=name).delete()
+
+    @staticmethod
+    def references():
+        """
+        Returns sorted streams of the file names in the database below media_directories().
+        SQLite compares text in binary order, which is the order of Python strings.
+        """
+        querysets = {Event: [Event.objects.all()]}
+        if sharding.is_enabled():
+            querysets[Photo] = [sharding.using_event(Photo.objects, event_pk)
+                                for event_pk in Event.objects.values_list('pk', flat=True)]
+        else:
+            querysets[Photo] = [Photo.objects.all()]
+
+        streams = []
+        for model, field in MEDIA_FIELDS:
+            upload_to = model._meta.get_field(field).upload_to
+            for queryset in querysets[model]:
+                streams.append(field_names(queryset.filter(**{field + '__startswith': upload_to + '/'}), field))
+        return streams
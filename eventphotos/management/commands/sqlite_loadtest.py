@@ -0,0 +1,80 @@
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, OperationalError
+from django.utils import timezone
+
+from eventphotos.models import Event, Photo, Like, UserAuthenticatedForEvent
+
+
+class Command(BaseCommand):
+    help = 'Concurrent like toggle load test against the configured database, ' \
+           'with and without the SQLite write queue. Creates and removes a temporary event.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--operations', type=int, default=200, help='like toggles per thread')
+        parser.add_argument('--photos', type=int, default=10)
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.stdout.write('journal mode: {}'.format(cursor.fetchone()[0]))
+
+        now = timezone.now()
+        event = Event.objects.create(name='load test', start_dt=now, end_dt=now, challenge='load test')
+        users = [User.objects.create_user('loadtest{}'.format(i), '', None) for i in range(options['threads'])]
+        try:
+            for user in users:
+                UserAuthenticatedForEvent.objects.create(user=user, event=event)
+            # bulk_create does not call Photo.save, hence no image processing
+            Photo.objects.bulk_create(Photo(owner=users[0], event=event, upload_dt=now, photo_dt=now,
+                                            photo='photos/loadtest.jpg', hash_md5='')
+                                      for _ in range(options['photos']))
+            photos = list(Photo.objects.filter(event=event))
+
+            write_queue = settings.SQLITE_WRITE_QUEUE
+            try:
+                for enabled in [False, True]:
+                    settings.SQLITE_WRITE_QUEUE = enabled
+                    self.run(users, photos, options['operations'])
+            finally:
+                settings.SQLITE_WRITE_QUEUE = write_queue
+        finally:
+            event.delete()
+            for user in users:
+                user.delete()
+
+    def run(self, users, photos, operations):
+        errors = []
+
+        def toggle_likes(user):
+            try:
+                for i in range(operations):
+                    photo = photos[i % len(photos)]
+                    # same queries as like_photo
+                    if not UserAuthenticatedForEvent.is_user_authenticated_for_event(user, photo.event):
+                        raise RuntimeError('not authenticated')
+                    is_liked = Like.objects.filter(photo=photo, owner=user).exists()
+                    try:
+                        Like.set_like(user, photo, not is_liked, is_liked)
+                    except OperationalError as e:
+                        errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=toggle_likes, args=(user,)) for user in users]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - start
+
+        total = len(users) * operations
+        self.stdout.write('write queue {}: {} toggles by {} threads in {:.2f}s: {:.0f} toggles/s, {} errors'.format(
+            'on' if settings.SQLITE_WRITE_QUEUE else 'off', total, len(users), duration, total / duration,
+            len(errors)))
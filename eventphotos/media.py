@@ -0,0 +1,279 @@
+import hashlib
+import hmac
+import mimetypes
+import os
+import posixpath
+import re
+import struct
+import time
+import uuid
+from io import BytesIO
+from urllib.parse import quote, urlencode
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, HttpResponseRedirect, \
+    StreamingHttpResponse
+
+from eventphotos.coldstorage import ColdStorageMixin, container_path, read_archived
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# photo fields which can be fetched with batch_response
+BATCH_RENDITIONS = ('thumbnail', 'web_photo')
+# photo id, length
+BATCH_RECORD_HEADER = struct.Struct('>QI')
+CHUNK_SIZE = 64 * 1024
+
+
+def storage_name(path: str):
+    """
+    The normalised storage name of a media url path, None if it could leave its directory
+    (.. components, absolute paths, backslashes).
+    """
+    if not path or path.startswith('/') or '\\' in path or '..' in path.split('/'):
+        return None
+    name = posixpath.normpath(path)
+    if name == '.' or name.startswith('/') or '..' in name.split('/'):
+        return None
+    return name
+
+
+def media_signature(path: str, expires: int) -> str:
+    message = '{}:{}'.format(path, expires).encode('utf8')
+    return hmac.new(settings.SECRET_KEY.encode('utf8'), message, hashlib.sha256).hexdigest()[:32]
+
+
+def sign_media_url(url: str, path: str, now: float = None) -> str:
+    """
+    Appends expiry and signature to the url of the media file path. The expiry is the end of the
+    next MEDIA_URL_BUCKET_SECONDS bucket, so every user gets the same url during a bucket and
+    caches can share the response.
+    """
+    bucket = settings.MEDIA_URL_BUCKET_SECONDS
+    expires = (int(now if now is not None else time.time()) // bucket + 2) * bucket
+    return '{}?{}'.format(url, urlencode([('expires', expires), ('signature', media_signature(path, expires))]))
+
+
+def is_signed(request, path: str) -> bool:
+    """
+    Checks the expiry and signature query parameters of a media request.
+    """
+    try:
+        expires = int(request.GET['expires'])
+        signature = request.GET['signature']
+    except (KeyError, ValueError):
+        return False
+    return expires > time.time() and hmac.compare_digest(media_signature(path, expires), signature)
+
+
+def serve_media(request, path: str, signed: bool = False):
+    """
+    Serves a file below MEDIA_ROOT. With MEDIA_ACCEL the transfer is handed to the front-end server
+    (nginx: X-Accel-Redirect to MEDIA_ACCEL_PREFIX, Apache/lighttpd: X-Sendfile), otherwise the file
+    is streamed by Django, which supports Range and If-None-Match and is meant for development.
+    Files of storages without local paths are redirected to, archived files are always streamed by Django.
+
+    Media file names are never reused for other content. Responses to signed urls may be
+    stored by shared caches until the url expires, all others only by the client.
+    """
+    try:
+        full_path = default_storage.path(path)
+    except NotImplementedError:
+        # remote storage (S3Storage), the client fetches the file from there
+        if not default_storage.exists(path):
+            raise Http404('file not found')
+        return HttpResponseRedirect(default_storage.url(path))
+    except SuspiciousFileOperation:
+        raise Http404('file not found')
+
+    archived = None
+    if not os.path.isfile(full_path):
+        # originals of finished events may have been moved into cold storage
+        archived = default_storage.archived(path) if isinstance(default_storage, ColdStorageMixin) else None
+        if archived is None:
+            raise Http404('file not found')
+
+    content_type, encoding = mimetypes.guess_type(full_path)
+    content_type = content_type or 'application/octet-stream'
+
+    if archived is not None and archived.compressed_size is not None:
+        # decompressed in memory, ranges refer to the original
+        etag = '"{:x}-{:x}-{:x}"'.format(int(os.stat(container_path(archived.container)).st_mtime),
+                                         archived.offset, archived.size)
+        response = ranged_response(request, BytesIO(read_archived(archived)), archived.size, etag, content_type,
+                                   whole=True)
+    elif archived is not None:
+        response = file_response(request, container_path(archived.container), content_type,
+                                 offset=archived.offset, size=archived.size)
+    elif settings.MEDIA_ACCEL == 'nginx':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + quote(path)
+    elif settings.MEDIA_ACCEL == 'sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = full_path
+    else:
+        response = file_response(request, full_path, content_type)
+
+    if signed:
+        max_age = max(int(request.GET['expires']) - int(time.time()), 0)
+        response['Cache-Control'] = 'public, max-age={}, immutable'.format(max_age)
+    else:
+        response['Cache-Control'] = 'private, max-age={}, immutable'.format(settings.MEDIA_MAX_AGE)
+    return response
+
+
+def file_response(request, full_path: str, content_type: str, offset: int = 0, size: int = None):
+    """
+    Streams the file, or size bytes of it from offset on.
+    """
+    stat = os.stat(full_path)
+    if size is None:
+        size = stat.st_size
+        etag = '"{:x}-{:x}"'.format(int(stat.st_mtime), size)
+    else:
+        etag = '"{:x}-{:x}-{:x}"'.format(int(stat.st_mtime), offset, size)
+
+    return ranged_response(request, open(full_path, 'rb'), size, etag, content_type,
+                           offset=offset, whole=offset + size == stat.st_size)
+
+
+def ranged_response(request, f, size: int, etag: str, content_type: str, offset: int = 0, whole: bool = False):
+    """
+    Streams size bytes of the file object from offset on (or the requested range of them) and closes it,
+    whole tells whether they end at the end of the file.
+    """
+    if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        f.close()
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    start, end = 0, size - 1
+    status = 200
+
+    range_header = request.META.get('HTTP_RANGE', None)
+    # If-Range: only honour the range if the client has the current version
+    if range_header is not None and request.META.get('HTTP_IF_RANGE', etag) == etag:
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            f.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+        start, end = byte_range
+        status = 206
+
+    f.seek(offset + start)
+    if end == size - 1 and whole:
+        # the file object itself allows the WSGI server to use sendfile (wsgi.file_wrapper)
+        content = f
+    else:
+        content = BoundedReader(f, end - start + 1)
+
+    response = FileResponse(content, status=status, content_type=content_type)
+    response['Content-Length'] = end - start + 1
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    if status == 206:
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+    return response
+
+
+def batch_response(request, files):
+    """
+    Streams the media files [(photo id, name), ...] in one response. Missing files are left out.
+
+    With "Accept: multipart/mixed" every file is a part with its photo id as Content-ID, otherwise
+    (application/octet-stream) every file is preceded by its photo id (8 bytes) and its length (4 bytes),
+    both unsigned big endian.
+    """
+    sized_files = []
+    for photo_pk, name in files:
+        try:
+            sized_files.append((photo_pk, name, default_storage.size(name)))
+        except OSError:
+            continue
+
+    if 'multipart/mixed' in request.META.get('HTTP_ACCEPT', ''):
+        boundary = uuid.uuid4().hex
+        parts = [(multipart_header(boundary, photo_pk, name, size), name, size) for photo_pk, name, size in sized_files]
+        closing = '\r\n--{}--\r\n'.format(boundary).encode('ascii')
+        content_type = 'multipart/mixed; boundary={}'.format(boundary)
+    else:
+        parts = [(BATCH_RECORD_HEADER.pack(photo_pk, size), name, size) for photo_pk, name, size in sized_files]
+        closing = b''
+        content_type = 'application/octet-stream'
+
+    def generate():
+        for header, name, size in parts:
+            yield header
+            with default_storage.open(name, 'rb') as f:
+                remaining = size
+                while remaining > 0:
+                    data = f.read(min(CHUNK_SIZE, remaining))
+                    if not data:
+                        raise IOError('{} is shorter than {} bytes'.format(name, size))
+                    remaining -= len(data)
+                    yield data
+        yield closing
+
+    response = StreamingHttpResponse(generate(), content_type=content_type)
+    response['Content-Length'] = sum(len(header) + size for header, name, size in parts) + len(closing)
+    return response
+
+
+def multipart_header(boundary: str, photo_pk: int, name: str, size: int) -> bytes:
+    content_type, encoding = mimetypes.guess_type(name)
+    # the delimiter of every part but the first includes the line break after the previous part
+    return ('\r\n--{}\r\n'
+            'Content-Type: {}\r\n'
+            'Content-ID: <{}>\r\n'
+            'Content-Length: {}\r\n'
+            '\r\n').format(boundary, content_type or 'application/octet-stream', photo_pk, size).encode('ascii')
+
+
+def parse_range(range_header: str, size: int):
+    """
+    Returns the (first byte, last byte) of a single byte range or None if it cannot be satisfied.
+    Multiple ranges are not supported.
+    """
+    match = RANGE_RE.match(range_header.strip())
+    if match is None or size == 0:
+        return None
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    elif last:
+        # suffix range: the last bytes of the file
+        start = max(size - int(last), 0)
+        end = size - 1
+    else:
+        return None
+
+    if start > end:
+        return None
+    return start, end
+
+
+class BoundedReader(object):
+    """
+    File-like object which reads at most length bytes from f.
+    """
+
+    def __init__(self, f, length: int):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
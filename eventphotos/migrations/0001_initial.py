@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 16:18
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('container', models.CharField(max_length=255)),
+                ('offset', models.BigIntegerField()),
+                ('size', models.BigIntegerField()),
+                ('compressed_size', models.BigIntegerField(null=True)),
+                ('dt', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BestPhoto',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('rank', models.IntegerField()),
+            ],
+            options={
+                'ordering': ['rank'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ContributorStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('photos', models.IntegerField(default=0)),
+                ('likes', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Event',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('start_dt', models.DateTimeField()),
+                ('end_dt', models.DateTimeField()),
+                ('dt', models.DateTimeField()),
+                ('challenge', models.CharField(max_length=200)),
+                ('icon', models.FileField(null=True, upload_to='event_icon')),
+            ],
+            options={
+                'ordering': ['-start_dt'],
+            },
+        ),
+        migrations.CreateModel(
+            name='EventStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('photos', models.IntegerField(default=0)),
+                ('uploaders', models.IntegerField(default=0)),
+                ('likes', models.IntegerField(default=0)),
+                ('event', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='eventphotos.Event')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Like',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dt', models.DateTimeField()),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='like_set', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-dt'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Photo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('upload_dt', models.DateTimeField()),
+                ('photo_dt', models.DateTimeField()),
+                ('visible', models.BooleanField(default=False)),
+                ('photo', models.FileField(upload_to='photos')),
+                ('hash_md5', models.CharField(max_length=200)),
+                ('crc32', models.BigIntegerField(null=True)),
+                ('thumbnail', models.FileField(null=True, upload_to='thumbnail')),
+                ('web_photo', models.FileField(null=True, upload_to='web_photo')),
+                ('comment', models.CharField(blank=True, max_length=500)),
+                ('phash', models.BigIntegerField(null=True)),
+                ('duplicate_of', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='eventphotos.Photo')),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='photos', to='eventphotos.Event')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='photos', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-upload_dt'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PhotoStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('likes', models.IntegerField(default=0)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='photo_stats', to='eventphotos.Event')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='photo_stats', to=settings.AUTH_USER_MODEL)),
+                ('photo', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='stats', to='eventphotos.Photo')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserAuthenticatedForEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dt', models.DateTimeField()),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='authenticated_users', to='eventphotos.Event')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='authenticated_events', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-dt'],
+            },
+        ),
+        migrations.AddField(
+            model_name='like',
+            name='photo',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='like_set', to='eventphotos.Photo'),
+        ),
+        migrations.AddField(
+            model_name='contributorstats',
+            name='event',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contributor_stats', to='eventphotos.Event'),
+        ),
+        migrations.AddField(
+            model_name='contributorstats',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contributor_stats', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='bestphoto',
+            name='event',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='best_photos', to='eventphotos.Event'),
+        ),
+        migrations.AddField(
+            model_name='bestphoto',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='best_photos', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='bestphoto',
+            name='photo',
+            field=models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='best', to='eventphotos.Photo'),
+        ),
+        migrations.AddIndex(
+            model_name='photostats',
+            index=models.Index(fields=['event', 'likes', 'photo'], name='eventphotos_event_i_a5d0b8_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='like',
+            unique_together=set([('photo', 'owner')]),
+        ),
+        migrations.AddIndex(
+            model_name='contributorstats',
+            index=models.Index(fields=['event', 'photos', 'likes'], name='eventphotos_event_i_301cdd_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='contributorstats',
+            unique_together=set([('event', 'user')]),
+        ),
+        migrations.AddIndex(
+            model_name='bestphoto',
+            index=models.Index(fields=['event', 'rank'], name='eventphotos_event_i_434b1a_idx'),
+        ),
+    ]
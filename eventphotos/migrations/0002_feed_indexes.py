@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 16:18
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def remove_duplicate_authorisations(apps, schema_editor):
+    # an event could be authorised repeatedly for the same user before (user, event) became unique
+    model = apps.get_model('eventphotos', 'UserAuthenticatedForEvent')
+    authorisations = model.objects.using(schema_editor.connection.alias).order_by()
+    first = authorisations.values('user', 'event').annotate(first=Min('pk')).values_list('first', flat=True)
+    authorisations.exclude(pk__in=list(first)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('eventphotos', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_authorisations, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='userauthenticatedforevent',
+            unique_together=set([('user', 'event')]),
+        ),
+        migrations.AddIndex(
+            model_name='like',
+            index=models.Index(fields=['owner', 'photo'], name='eventphotos_owner_i_f441d8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='like',
+            index=models.Index(fields=['dt'], name='eventphotos_dt_af9e06_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['event', 'visible', 'upload_dt'], name='eventphotos_event_i_b0d1f3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['event', 'visible', 'photo_dt'], name='eventphotos_event_i_e0d94a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['event', 'upload_dt'], name='eventphotos_event_i_f1d823_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['event', 'photo_dt'], name='eventphotos_event_i_1d47b6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['owner', 'upload_dt'], name='eventphotos_owner_i_56e69f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['upload_dt'], name='eventphotos_upload__ce8fd7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['photo_dt'], name='eventphotos_photo_d_e094b1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['photo'], name='eventphotos_photo_111540_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['thumbnail'], name='eventphotos_thumbna_5b41b5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['web_photo'], name='eventphotos_web_pho_2ebbc2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userauthenticatedforevent',
+            index=models.Index(fields=['event', 'user'], name='eventphotos_event_i_63d735_idx'),
+        ),
+    ]
@@ -1,5 +1,11 @@
 import hashlib
+import operator
 import os
+import threading
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from functools import reduce
 from io import BytesIO
 from typing import Tuple
 
@@ -7,16 +13,21 @@ import dateutil.parser
 from PIL import Image
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.files.base import ContentFile
-from django.db import models
-from django.db.models import FileField, BooleanField
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.core.files.storage import default_storage
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, models, transaction
+from django.db.models import Case, Count, F, FileField, BooleanField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver, Signal
 from django.utils import timezone
 from rest_framework.authtoken.models import Token
 from rest_framework.exceptions import ValidationError
 
+from eventphotos import perceptualhash, sharding
 from eventserver.settings import THUMBNAIL_SIZE, WEB_PHOTO_SIZE
+from eventserver.sqlite import write_queue
 
 
 # from: http://www.django-rest-framework.org/api-guide/authentication/
@@ -47,18 +58,37 @@ class Event(models.Model):
         return '{} - {}'.format(self.pk, self.name)
 
 
+@receiver(post_delete, sender=Event)
+def delete_event_database(sender, instance=None, **kwargs):
+    # photos, likes and authorisations of the event are not reached by the cascade
+    if sharding.is_enabled():
+        photos = sharding.using_event(Photo.objects, instance.pk)
+        names = [name for row in photos.values_list('photo', 'thumbnail', 'web_photo').iterator() for name in row]
+        sharding.drop_event_database(instance.pk)
+        delete_unreferenced_files(names, 'default')
+
+
 class UserAuthenticatedForEvent(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='authenticated_events')
     event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='authenticated_users')
     dt = models.DateTimeField()
 
     class Meta:
+        unique_together = ('user', 'event')
+        indexes = [
+            # photo feed of a user without event id: event -> authorised users
+            models.Index(fields=['event', 'user']),
+        ]
         ordering = ['-dt']
 
     def save(self, *args, **kwargs):
         # set dt
         self.dt = timezone.now()
 
+        # authorisations live in the database of their event
+        if sharding.is_enabled():
+            kwargs['using'] = sharding.event_database(self.event_id)
+
         super(UserAuthenticatedForEvent, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -68,7 +98,33 @@ class UserAuthenticatedForEvent(models.Model):
     def is_user_authenticated_for_event(user: User, event: Event):
         if not user.is_authenticated():
             return False
-        return UserAuthenticatedForEvent.objects.filter(user=user, event=event).exists()
+        queryset = sharding.using_event(UserAuthenticatedForEvent.objects, event.pk)
+        return queryset.filter(user=user, event=event).exists()
+
+    @staticmethod
+    def cache_key(user_pk: int, event_pk: int) -> str:
+        return 'event-auth:{}:{}'.format(user_pk, event_pk)
+
+    @staticmethod
+    def is_user_authenticated_for_event_cached(user: User, event: Event):
+        """
+        Like is_user_authenticated_for_event, but the result is cached for EVENT_AUTH_CACHE_TIMEOUT seconds.
+        """
+        if not user.is_authenticated():
+            return False
+
+        key = UserAuthenticatedForEvent.cache_key(user.pk, event.pk)
+        authenticated = cache.get(key)
+        if authenticated is None:
+            authenticated = UserAuthenticatedForEvent.is_user_authenticated_for_event(user, event)
+            cache.set(key, authenticated, settings.EVENT_AUTH_CACHE_TIMEOUT)
+        return authenticated
+
+
+@receiver(post_save, sender=UserAuthenticatedForEvent)
+@receiver(post_delete, sender=UserAuthenticatedForEvent)
+def invalidate_event_authentication(sender, instance=None, **kwargs):
+    cache.delete(UserAuthenticatedForEvent.cache_key(instance.user_id, instance.event_id))
 
 
 class Photo(models.Model):
@@ -83,30 +139,74 @@ class Photo(models.Model):
 
     photo = FileField(upload_to='photos')
     hash_md5 = models.CharField(max_length=200)
+    # CRC-32 of the original, zip exports (eventphotos.export) write it before the data
+    crc32 = models.BigIntegerField(null=True)
     thumbnail = FileField(upload_to='thumbnail', null=True)
     web_photo = FileField(upload_to='web_photo', null=True)
 
     comment = models.CharField(max_length=500, blank=True)
 
+    # perceptual hash of the thumbnail (see eventphotos.perceptualhash)
+    # and the earlier photo this one is a near-duplicate of
+    phash = models.BigIntegerField(null=True)
+    duplicate_of = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, related_name='duplicates')
+
     class Meta:
+        indexes = [
+            # photo feed of an event, sorted by upload or creation date
+            models.Index(fields=['event', 'visible', 'upload_dt']),
+            models.Index(fields=['event', 'visible', 'photo_dt']),
+            models.Index(fields=['event', 'upload_dt']),
+            models.Index(fields=['event', 'photo_dt']),
+            # photos of a user
+            models.Index(fields=['owner', 'upload_dt']),
+            # unfiltered photo feed (super user)
+            models.Index(fields=['upload_dt']),
+            models.Index(fields=['photo_dt']),
+            # media files -> photo
+            models.Index(fields=['photo']),
+            models.Index(fields=['thumbnail']),
+            models.Index(fields=['web_photo']),
+        ]
         ordering = ['-upload_dt']
 
     def save(self, *args, **kwargs):
         # check md5sum
         self.photo.seek(0)
-        local_md5 = self.compute_md5(self.photo)
+        local_md5, self.crc32 = self.compute_checksums(self.photo)
         if self.hash_md5 == "!IGNORE!":
             self.hash_md5 = local_md5
         elif self.hash_md5.strip() != local_md5:
             raise ValidationError('md5 mismatch: {} != {}'.format(self.hash_md5, local_md5))
         self.photo.seek(0)
 
+        # files replaced by this update, deleted after the write
+        replaced = []
+        if self.pk is not None:
+            replaced = [self.thumbnail.name, self.web_photo.name]
+            if not self.photo._committed:
+                replaced += sharding.using_pk(Photo.objects, self.pk).filter(pk=self.pk).values_list('photo', flat=True)
+
+        # content-hashed file names: a media url always refers to the same content and can be cached forever
+        if not self.photo._committed:
+            self.photo.name = local_md5 + os.path.splitext(self.photo.name)[1].lower()
+
         # try to create a thumbnail
         self.save_scaled_version(source=self.photo, size=THUMBNAIL_SIZE, prefix='_thumbnail', target=self.thumbnail)
 
         # try to create a scaled version for web
         self.save_scaled_version(source=self.photo, size=WEB_PHOTO_SIZE, prefix='_web', target=self.web_photo)
 
+        # flag re-encoded copies of photos of the event (resent through messengers)
+        self.phash = None
+        if self.thumbnail:
+            self.thumbnail.seek(0)
+            value = perceptualhash.dhash(Image.open(self.thumbnail))
+            self.phash = perceptualhash.to_signed(value)
+            if self.pk is None:
+                self.duplicate_of_id = perceptualhash.find_original(self.event_id, value,
+                                                                    settings.PHOTO_DUPLICATE_DISTANCE)
+
         # find creation date
         image = Image.open(self.photo)
         try:
@@ -120,14 +220,32 @@ class Photo(models.Model):
         # upload dt
         self.upload_dt = timezone.now()
 
-        super(Photo, self).save(*args, **kwargs)
+        # photos live in the database of their event
+        if sharding.is_enabled():
+            kwargs['using'] = sharding.event_database(self.event_id)
+
+        # only the insert/update goes through the write queue, the image processing above does not
+        write_queue.submit(lambda: super(Photo, self).save(*args, **kwargs),
+                           using=kwargs.get('using') or self._state.db or DEFAULT_DB_ALIAS)
+
+        current = (self.photo.name, self.thumbnail.name, self.web_photo.name)
+        delete_unreferenced_files([name for name in replaced if name not in current], self._state.db)
 
     @staticmethod
     def compute_md5(f: FileField) -> str:
+        return Photo.compute_checksums(f)[0]
+
+    @staticmethod
+    def compute_checksums(f: FileField) -> Tuple[str, int]:
+        """
+        Returns the md5 (hex) and the CRC-32 of the file, read once.
+        """
         hash_md5 = hashlib.md5()
-        for chunk in iter(lambda: f.read(4096), b''):
+        crc = 0
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
             hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+            crc = zlib.crc32(chunk, crc)
+        return hash_md5.hexdigest(), crc
 
     @staticmethod
     def save_scaled_version(source: FileField, size: Tuple[int, int], prefix: str, target: FileField) -> bool:
@@ -155,7 +273,6 @@ class Photo(models.Model):
 
         source_name, source_extension = os.path.splitext(source.name)
         source_extension = source_extension.lower()
-        scaled_filename = source_name + prefix + source_extension
 
         if source_extension in ['.jpg', '.jpeg']:
             file_type = 'JPEG'
@@ -169,10 +286,14 @@ class Photo(models.Model):
         # Save thumbnail to in-memory file as BytesIO
         temp_scaled = BytesIO()
         image.save(temp_scaled, file_type)
-        temp_scaled.seek(0)
+        content = temp_scaled.getvalue()
+
+        # content-hashed, like the source
+        content_hash = hashlib.md5(content).hexdigest()[:12]
+        scaled_filename = '{}{}.{}{}'.format(os.path.basename(source_name), prefix, content_hash, source_extension)
 
         # set save=False, otherwise it will run in an infinite loop
-        target.save(scaled_filename, ContentFile(temp_scaled.read()), save=False)
+        target.save(scaled_filename, ContentFile(content), save=False)
         temp_scaled.close()
 
         return True
@@ -181,6 +302,81 @@ class Photo(models.Model):
         return '{} ({})'.format(self.photo.name, self.pk)
 
 
+class ArchivedFile(models.Model):
+    """
+    Index of a media file moved into a cold storage container (see eventphotos.coldstorage):
+    its content are the size bytes at offset of the container file below COLD_STORAGE_ROOT,
+    or the compressed_size bytes there if it is zlib compressed.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    container = models.CharField(max_length=255)
+    offset = models.BigIntegerField()
+    size = models.BigIntegerField()
+    compressed_size = models.BigIntegerField(null=True)
+    dt = models.DateTimeField()
+
+    def save(self, *args, **kwargs):
+        # set dt
+        self.dt = timezone.now()
+
+        super(ArchivedFile, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return '{} ({} @ {})'.format(self.name, self.container, self.offset)
+
+
+# media files referenced by the database: (model, file field)
+MEDIA_FIELDS = [(Event, 'icon'), (Photo, 'photo'), (Photo, 'thumbnail'), (Photo, 'web_photo')]
+
+
+def media_directories():
+    """
+    Returns the (sorted) top level directories of the files of MEDIA_FIELDS.
+    """
+    return sorted({model._meta.get_field(field).upload_to for model, field in MEDIA_FIELDS})
+
+
+def is_media_file_referenced(name: str, using: str) -> bool:
+    """
+    Checks whether an event or a photo (in the database using) refers to the file.
+    """
+    return Event.objects.filter(icon=name).exists() or \
+        Photo.objects.using(using).filter(Q(photo=name) | Q(thumbnail=name) | Q(web_photo=name)).exists()
+
+
+def delete_unreferenced_files(names, using: str):
+    """
+    Deletes the media files once the current transaction is committed, unless they are still referenced.
+    Only files below media_directories() are deleted, never files which were assigned by path.
+    """
+    directories = tuple(directory + '/' for directory in media_directories())
+    names = [name for name in names if name and name.startswith(directories)]
+    if not names:
+        return
+
+    def delete():
+        for name in names:
+            if not is_media_file_referenced(name, using):
+                default_storage.delete(name)
+
+    transaction.on_commit(delete, using=using)
+
+
+@receiver(post_delete, sender=Event)
+def delete_event_icon(sender, instance=None, using=None, **kwargs):
+    delete_unreferenced_files([instance.icon.name], using)
+
+
+@receiver(post_delete, sender=Photo)
+def delete_photo_files(sender, instance=None, using=None, **kwargs):
+    delete_unreferenced_files([instance.photo.name, instance.thumbnail.name, instance.web_photo.name], using)
+
+
+@receiver(post_delete, sender=Photo)
+def invalidate_hash_index(sender, instance=None, **kwargs):
+    perceptualhash.invalidate(instance.event_id)
+
+
 class Like(models.Model):
     photo = models.ForeignKey(Photo, on_delete=models.CASCADE, related_name='like_set')
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='like_set')
@@ -188,13 +384,295 @@ class Like(models.Model):
 
     class Meta:
         unique_together = ('photo', 'owner')
+        indexes = [
+            # likes of a user
+            models.Index(fields=['owner', 'photo']),
+            models.Index(fields=['dt']),
+        ]
         ordering = ['-dt']
 
     def save(self, *args, **kwargs):
         # set dt
         self.dt = timezone.now()
 
+        # likes live in the database of the event of their photo
+        if sharding.is_enabled():
+            kwargs['using'] = sharding.event_database(sharding.event_id_for_pk(self.photo_id))
+
         super(Like, self).save(*args, **kwargs)
 
     def __str__(self):
         return '{} ({})'.format(self.photo.photo.name, self.pk)
+
+    @staticmethod
+    def set_like(user: User, photo: Photo, like: bool, is_liked: bool):
+        """
+        Creates or deletes the like of the user, is_liked is the current state.
+        """
+        if is_liked and not like:
+            write_queue.submit(lambda: photo.like_set.filter(owner=user).delete(), using=photo._state.db)
+        elif not is_liked and like:
+            write_queue.submit(lambda: photo.like_set.create(owner=user), using=photo._state.db)
+
+
+class EventStats(models.Model):
+    """
+    Counters of an event, maintained incrementally by the receivers below (see eventphotos.stats).
+    """
+    event = models.OneToOneField(Event, on_delete=models.CASCADE, related_name='stats')
+    photos = models.IntegerField(default=0)
+    uploaders = models.IntegerField(default=0)
+    likes = models.IntegerField(default=0)
+
+    def __str__(self):
+        return '{}: {} photos, {} uploaders, {} likes'.format(self.event_id, self.photos, self.uploaders, self.likes)
+
+
+class ContributorStats(models.Model):
+    """
+    Photos of a user in an event and the likes they received.
+    """
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='contributor_stats')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='contributor_stats')
+    photos = models.IntegerField(default=0)
+    likes = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('event', 'user')
+        indexes = [
+            # top contributors
+            models.Index(fields=['event', 'photos', 'likes']),
+        ]
+
+    def __str__(self):
+        return '{} - {}: {} photos, {} likes'.format(self.event_id, self.user_id, self.photos, self.likes)
+
+
+class PhotoStats(models.Model):
+    """
+    Like count of a photo. Deleted by the photo's receiver rather than the cascade,
+    so the likes deleted along with the photo are still counted down.
+    """
+    photo = models.OneToOneField(Photo, on_delete=models.DO_NOTHING, db_constraint=False, related_name='stats')
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='photo_stats')
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='photo_stats')
+    likes = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # top photos
+            models.Index(fields=['event', 'likes', 'photo']),
+        ]
+
+    def __str__(self):
+        return '{}: {} likes'.format(self.photo_id, self.likes)
+
+
+class BestPhoto(models.Model):
+    """
+    Materialised "best of" ranking of an event: its BEST_PHOTOS_COUNT best photos (see eventphotos.ranking).
+    score is the photo's own score, rank the position after the uploader diversity penalty.
+    Deleted by the ranking's receiver rather than the cascade, like PhotoStats.
+    """
+    photo = models.OneToOneField(Photo, on_delete=models.DO_NOTHING, db_constraint=False, related_name='best')
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='best_photos')
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='best_photos')
+    score = models.FloatField()
+    rank = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['event', 'rank']),
+        ]
+        ordering = ['rank']
+
+    def __str__(self):
+        return '{} - {}: {}'.format(self.event_id, self.rank, self.photo_id)
+
+
+# sent after the like counts of the photos changed
+likes_counted = Signal(providing_args=['photo_pks', 'using'])
+
+# the counts collected by batched_counts, per thread: {database: (photo deltas, like deltas)}
+_batch = threading.local()
+
+# rows per UPDATE of add_counts (SQLite limits the number of query parameters)
+COUNTS_CHUNK_SIZE = 100
+
+
+def add_counts(model, using: str, key_fields: tuple, deltas: dict):
+    """
+    Adds the deltas ({key values: {field: delta}}, key values in the order of key_fields) to the counters of the
+    rows identified by the keys, with one UPDATE for all of them. Missing rows are created for positive deltas,
+    rows with negative deltas may be missing (e.g. deleted along with their event).
+    """
+    deltas = [(key, row_deltas) for key, row_deltas in deltas.items() if any(row_deltas.values())]
+    for start in range(0, len(deltas), COUNTS_CHUNK_SIZE):
+        chunk = deltas[start:start + COUNTS_CHUNK_SIZE]
+        if _update_counts(model, using, key_fields, chunk) == len(chunk):
+            continue
+
+        # the UPDATE holds the write lock (SQLite), rows missing now were not updated
+        rows = model.objects.using(using).filter(reduce(operator.or_, (Q(**dict(zip(key_fields, key)))
+                                                                       for key, _ in chunk)))
+        existing = set(rows.values_list(*key_fields))
+        _create_counts(model, using, key_fields, [(key, row_deltas) for key, row_deltas in chunk
+                                                  if key not in existing and min(row_deltas.values()) >= 0])
+
+
+def _create_counts(model, using: str, key_fields: tuple, deltas: list):
+    """
+    Inserts the rows with the deltas as counters, rows which another writer created meanwhile
+    (e.g. without a database write lock) are added to instead.
+    """
+    conflicts = []
+    for key, row_deltas in deltas:
+        try:
+            with transaction.atomic(using=using):
+                model.objects.using(using).create(**dict(zip(key_fields, key)), **row_deltas)
+        except IntegrityError:
+            if not model.objects.using(using).filter(**dict(zip(key_fields, key))).exists():
+                raise
+            conflicts.append((key, row_deltas))
+    if conflicts:
+        _update_counts(model, using, key_fields, conflicts)
+
+
+def _update_counts(model, using: str, key_fields: tuple, deltas: list) -> int:
+    chunk = [(Q(**dict(zip(key_fields, key))), row_deltas) for key, row_deltas in deltas]
+    rows = model.objects.using(using).filter(reduce(operator.or_, (condition for condition, _ in chunk)))
+    fields = {field for _, row_deltas in chunk for field in row_deltas}
+    return rows.update(**{
+        field: F(field) + Case(*(When(condition, then=Value(row_deltas.get(field, 0)))
+                                 for condition, row_deltas in chunk),
+                               default=Value(0), output_field=models.IntegerField())
+        for field in fields})
+
+
+@contextmanager
+def batched_counts():
+    """
+    Collects the photos and likes counted within (in this thread) and writes them on exit, with one UPDATE
+    per statistics table and database. Nested uses write on exit of the outermost one, nothing is written
+    if it raises.
+    """
+    if getattr(_batch, 'counts', None) is not None:
+        yield
+        return
+
+    _batch.counts = counts = {}
+    try:
+        yield
+    finally:
+        _batch.counts = None
+
+    for using, (photos, likes) in counts.items():
+        with transaction.atomic(using=using, savepoint=False):
+            # photos before their likes, but a deleted photo's likes are counted down before its PhotoStats go
+            _write_photo_counts({pk: photo for pk, photo in photos.items() if photo[2] > 0}, using)
+            _write_like_counts(likes, using)
+            _write_photo_counts({pk: photo for pk, photo in photos.items() if photo[2] < 0}, using)
+        if any(likes.values()):
+            likes_counted.send(sender=Like, photo_pks=[pk for pk, delta in likes.items() if delta], using=using)
+
+
+def _counts(using: str):
+    return _batch.counts.setdefault(using, ({}, Counter()))
+
+
+def _write_photo_counts(photos: dict, using: str):
+    """
+    Writes the counts of {photo pk: (event pk, owner pk, delta)}.
+    """
+    contributors = Counter()
+    for event_pk, owner_pk, delta in photos.values():
+        contributors[(event_pk, owner_pk)] += delta
+    contributors = {key: delta for key, delta in contributors.items() if delta}
+    if not contributors:
+        return
+
+    events = Counter()
+    for (event_pk, _), delta in contributors.items():
+        events[(event_pk,)] += delta
+    add_counts(ContributorStats, using, ('event_id', 'user_id'),
+               {key: {'photos': delta} for key, delta in contributors.items()})
+    add_counts(EventStats, using, ('event_id',), {key: {'photos': delta} for key, delta in events.items()})
+
+    # users with photos are uploaders, counted within the UPDATE rather than from counts read before
+    # (which a concurrent writer could change meanwhile)
+    uploaders = ContributorStats.objects.using(using).filter(event_id=OuterRef('event_id'), photos__gt=0) \
+        .order_by().values('event_id').annotate(count=Count('pk')).values('count')
+    EventStats.objects.using(using).filter(event_id__in=[key[0] for key in events]) \
+        .update(uploaders=Coalesce(Subquery(uploaders, output_field=models.IntegerField()), 0))
+
+    PhotoStats.objects.using(using).bulk_create(
+        PhotoStats(photo_id=pk, event_id=event_pk, owner_id=owner_pk)
+        for pk, (event_pk, owner_pk, delta) in photos.items() if delta > 0)
+    deleted_pks = [pk for pk, (_, _, delta) in photos.items() if delta < 0]
+    if deleted_pks:
+        PhotoStats.objects.using(using).filter(photo_id__in=deleted_pks).delete()
+
+
+def _write_like_counts(likes: Counter, using: str):
+    """
+    Writes the counts of {photo pk: delta}.
+    """
+    likes = {photo_pk: delta for photo_pk, delta in likes.items() if delta}
+    if not likes:
+        return
+
+    contributor_likes = Counter()
+    event_likes = Counter()
+    photo_likes = {}
+    for photo_pk, event_pk, owner_pk in PhotoStats.objects.using(using).filter(photo_id__in=likes) \
+            .values_list('photo_id', 'event_id', 'owner_id'):
+        photo_likes[(photo_pk,)] = {'likes': likes[photo_pk]}
+        contributor_likes[(event_pk, owner_pk)] += likes[photo_pk]
+        event_likes[(event_pk,)] += likes[photo_pk]
+
+    add_counts(PhotoStats, using, ('photo_id',), photo_likes)
+    add_counts(ContributorStats, using, ('event_id', 'user_id'),
+               {key: {'likes': delta} for key, delta in contributor_likes.items()})
+    add_counts(EventStats, using, ('event_id',), {key: {'likes': delta} for key, delta in event_likes.items()})
+
+
+def count_photo(photo: Photo, delta: int, using: str):
+    """
+    Counts the photo up (delta 1) or down (delta -1).
+    """
+    with batched_counts():
+        photos, _ = _counts(using)
+        _, _, count = photos.get(photo.pk, (None, None, 0))
+        photos[photo.pk] = (photo.event_id, photo.owner_id, count + delta)
+
+
+def count_likes(photo_pks, delta: int, using: str):
+    """
+    Counts a like of each of the photos (repeated for several likes) up (delta 1) or down (delta -1).
+    """
+    with batched_counts():
+        _, likes = _counts(using)
+        for photo_pk in photo_pks:
+            likes[photo_pk] += delta
+
+
+@receiver(post_save, sender=Photo)
+def count_saved_photo(sender, instance=None, created=False, using=None, **kwargs):
+    if created:
+        count_photo(instance, 1, using)
+
+
+@receiver(post_delete, sender=Photo)
+def count_deleted_photo(sender, instance=None, using=None, **kwargs):
+    count_photo(instance, -1, using)
+
+
+@receiver(post_save, sender=Like)
+def count_saved_like(sender, instance=None, created=False, using=None, **kwargs):
+    if created:
+        count_likes([instance.photo_id], 1, using)
+
+
+@receiver(post_delete, sender=Like)
+def count_deleted_like(sender, instance=None, using=None, **kwargs):
+    count_likes([instance.photo_id], -1, using)
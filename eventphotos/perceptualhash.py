@@ -0,0 +1,164 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+
+from eventphotos import sharding
+
+
+def dhash(image: Image.Image) -> int:
+    """
+    64 bit difference hash: one bit per horizontally adjacent pixel pair of the 9x8 grayscale image,
+    set if the right pixel is brighter. Survives re-encoding and rescaling (messenger copies).
+    """
+    pixels = np.asarray(image.convert('L').resize((9, 8), Image.ANTIALIAS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def to_signed(value: int) -> int:
+    """
+    Stores the hash in a (signed) 64 bit integer column.
+    """
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+class MultiIndexHash(object):
+    """
+    Multi-index hashing for Hamming radius searches of 64 bit hashes: the bits are split into
+    max_distance + 1 substrings, and two hashes within max_distance agree on at least one of them
+    (pigeonhole principle). So a query only compares the hashes which share a substring with it,
+    found in one dict per substring, instead of all of them.
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        count = max_distance + 1
+        bounds = [64 * i // count for i in range(count + 1)]
+        # (shift, mask) of every substring
+        self.substrings = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self.tables = [{} for _ in self.substrings]
+        self.size = 0
+
+    def add(self, value: int, pk):
+        for table, (shift, mask) in zip(self.tables, self.substrings):
+            table.setdefault((value >> shift) & mask, []).append((value, pk))
+        self.size += 1
+
+    def query(self, value: int, max_distance: int = None):
+        """
+        Returns (pk, distance) of all hashes within max_distance (at most the one of the index),
+        nearest (then lowest pk) first.
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        elif max_distance > self.max_distance:
+            raise ValueError('the index supports distances up to {}'.format(self.max_distance))
+
+        matches = {}
+        compared = set()
+        for table, (shift, mask) in zip(self.tables, self.substrings):
+            for other, pk in table.get((value >> shift) & mask, ()):
+                if pk in compared:
+                    continue
+                compared.add(pk)
+                distance = hamming(value, other)
+                if distance <= max_distance:
+                    matches[pk] = distance
+        return sorted(matches.items(), key=lambda match: (match[1], match[0]))
+
+
+class EventHashIndex(object):
+    """
+    Index of the hashes of an event's photos up to photo max_pk, valid for one generation of the event.
+    lock guards loading new photos into it.
+    """
+
+    def __init__(self, generation: str, max_distance: int):
+        self.generation = generation
+        self.hashes = MultiIndexHash(max_distance)
+        self.max_pk = 0
+        self.lock = threading.Lock()
+
+
+# event pk -> EventHashIndex of this process, least recently used first (at most PHOTO_DUPLICATE_INDEX_EVENTS)
+_indexes = OrderedDict()
+# guards _indexes only, the photos are loaded under the lock of the event's index
+_lock = threading.Lock()
+
+
+def generation_key(event_pk: int) -> str:
+    return 'phash-generation:{}'.format(event_pk)
+
+
+def generation(event_pk: int) -> str:
+    key = generation_key(event_pk)
+    cache.add(key, uuid.uuid4().hex, None)
+    return cache.get(key)
+
+
+def invalidate(event_pk: int):
+    """
+    Makes every process rebuild the index of the event (the index does not support removal).
+    """
+    cache.set(generation_key(event_pk), uuid.uuid4().hex, None)
+
+
+def event_photos(event_pk: int):
+    photo_model = apps.get_model('eventphotos.photo')
+    return sharding.using_event(photo_model.objects, event_pk).filter(event_id=event_pk, phash__isnull=False)
+
+
+def event_index(event_pk: int, max_distance: int) -> EventHashIndex:
+    """
+    Returns the index of the event for searches up to max_distance,
+    new photos (higher pks) are added to it incrementally.
+    """
+    current_generation = generation(event_pk)
+    with _lock:
+        index = _indexes.get(event_pk, None)
+        if index is None or index.generation != current_generation or index.hashes.max_distance != max_distance:
+            index = _indexes[event_pk] = EventHashIndex(current_generation, max_distance)
+        _indexes.move_to_end(event_pk)
+        while len(_indexes) > settings.PHOTO_DUPLICATE_INDEX_EVENTS:
+            _indexes.popitem(last=False)
+
+    # uploads to other events don't wait for the database
+    with index.lock:
+        for pk, value in event_photos(event_pk).filter(pk__gt=index.max_pk).order_by('pk') \
+                .values_list('pk', 'phash').iterator():
+            index.hashes.add(to_unsigned(value), pk)
+            index.max_pk = pk
+        return index
+
+
+def find_original(event_pk: int, value: int, max_distance: int):
+    """
+    Returns the pk of the photo of the event the hash is a near-duplicate of (the nearest, earliest one,
+    or the photo that one duplicates), None if there is none.
+    """
+    matches = event_index(event_pk, max_distance).hashes.query(value)
+    if not matches:
+        return None
+
+    # the index of this process may be stale (deleted photos whose invalidation was missed)
+    rows = {pk: (phash, duplicate_of_pk) for pk, phash, duplicate_of_pk in
+            event_photos(event_pk).filter(pk__in=[pk for pk, _ in matches])
+            .values_list('pk', 'phash', 'duplicate_of_id')}
+    for pk, _ in matches:
+        if pk in rows and hamming(to_unsigned(rows[pk][0]), value) <= max_distance:
+            return rows[pk][1] or pk
+    return None
@@ -0,0 +1,231 @@
+import heapq
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, FloatField, Value, When
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from eventphotos import sharding
+from eventphotos.models import BestPhoto, Photo, likes_counted
+
+# "best of" ranking of the photos of an event, materialised in BestPhoto. The score of a photo is
+#   BEST_PHOTOS_LIKES_WEIGHT * log2(1 + likes) + upload time / BEST_PHOTOS_HALF_LIFE
+# i.e. doubling the likes (+1) is worth BEST_PHOTOS_HALF_LIFE seconds of recency. Scores of different photos
+# do not drift apart over time, so the ranking can be updated incrementally when likes and photos change.
+# For uploader diversity every further photo of the same uploader in the ranking loses
+# BEST_PHOTOS_OWNER_PENALTY. manage.py rank_best_photos recomputes the rankings (periodically, e.g. cron).
+# The changes of a request are applied to the rankings at once (BatchedRankingMiddleware).
+
+# the changes collected by batched_ranking, per thread: {database: (changed photo pks, events to recompute)}
+_batch = threading.local()
+
+
+def scores(likes, timestamps):
+    """
+    Scores of photos with the given like counts and upload times (unix timestamps), vectorised.
+    """
+    return settings.BEST_PHOTOS_LIKES_WEIGHT * np.log2(1 + np.asarray(likes, dtype=np.float64)) + \
+        np.asarray(timestamps, dtype=np.float64) / settings.BEST_PHOTOS_HALF_LIFE
+
+
+def diversify(candidates, count: int):
+    """
+    Selects the best count of the (pk, owner pk, score) candidates, every photo of an owner after the first
+    loses BEST_PHOTOS_OWNER_PENALTY per photo of the owner ranked before it. Returns (pk, owner pk, score) by rank.
+    """
+    penalty = settings.BEST_PHOTOS_OWNER_PENALTY
+    taken = Counter()
+    # (-penalised score, pk, owner pk, score, number of photos of the owner the penalty accounts for)
+    heap = [(-score, pk, owner_pk, score, 0) for pk, owner_pk, score in candidates]
+    heapq.heapify(heap)
+
+    selected = []
+    while heap and len(selected) < count:
+        _, pk, owner_pk, score, counted = heapq.heappop(heap)
+        if counted != taken[owner_pk]:
+            # another photo of the owner was selected meanwhile
+            heapq.heappush(heap, (-(score - penalty * taken[owner_pk]), pk, owner_pk, score, taken[owner_pk]))
+            continue
+        selected.append((pk, owner_pk, score))
+        taken[owner_pk] += 1
+    return selected
+
+
+def candidates(photos):
+    """
+    Photos which may be ranked: visible ones which are no near-duplicate of another one.
+    """
+    return photos.filter(visible=True, duplicate_of__isnull=True)
+
+
+def ranking(event_pk: int, using: str):
+    """
+    The stored ranking of the event as (pk, owner pk, score) by rank.
+    """
+    return list(BestPhoto.objects.using(using).filter(event_id=event_pk).order_by('rank')
+                .values_list('photo_id', 'owner_id', 'score'))
+
+
+def save_ranking(event_pk: int, selected, using: str, current=None):
+    """
+    Stores the selected (pk, owner pk, score) by rank as the ranking of the event, current is the stored one if known.
+    """
+    if current is None:
+        current = ranking(event_pk, using)
+    current = [(pk, score) for pk, _, score in current]
+    if [pk for pk, _ in current] == [pk for pk, _, _ in selected]:
+        # same order, only the scores changed
+        current_scores = dict(current)
+        save_scores({pk: score for pk, _, score in selected if current_scores[pk] != score}, using)
+        return
+
+    with transaction.atomic(using=using):
+        BestPhoto.objects.using(using).filter(event_id=event_pk).delete()
+        BestPhoto.objects.using(using).bulk_create(
+            BestPhoto(photo_id=pk, event_id=event_pk, owner_id=owner_pk, score=score, rank=rank)
+            for rank, (pk, owner_pk, score) in enumerate(selected))
+
+
+def save_scores(photo_scores: dict, using: str):
+    """
+    Stores the changed scores ({pk: score}) of ranked photos with one UPDATE.
+    """
+    if photo_scores:
+        BestPhoto.objects.using(using).filter(photo_id__in=photo_scores).update(
+            score=Case(*(When(photo_id=pk, then=Value(score)) for pk, score in photo_scores.items()),
+                       output_field=FloatField()))
+
+
+def rank_event(event_pk: int):
+    """
+    Recomputes the ranking of the event from all of its photos.
+    """
+    photos = candidates(sharding.using_event(Photo.objects, event_pk).filter(event_id=event_pk))
+    rows = list(photos.values_list('pk', 'owner_id', 'upload_dt', 'stats__likes'))
+
+    count = settings.BEST_PHOTOS_COUNT
+    if rows:
+        pks, owner_pks, upload_dts, likes = zip(*rows)
+        photo_scores = scores([like_count or 0 for like_count in likes], [dt.timestamp() for dt in upload_dts])
+        # the diversity penalty only reorders the best few times count photos
+        pool = min(len(rows), count * 4)
+        best = np.argpartition(-photo_scores, pool - 1)[:pool]
+        selected = diversify([(pks[i], owner_pks[i], float(photo_scores[i])) for i in best], count)
+    else:
+        selected = []
+
+    save_ranking(event_pk, selected, photos.db)
+
+
+def update_photos(photo_pks, using: str):
+    """
+    Updates the rankings for changes of the photos (likes, new photos, visibility): a changed photo enters
+    the ranking if it scores better than the last ranked one. Full rankings in which a photo scores worse
+    or is no candidate any more are recomputed, as a photo outside of them may be better now.
+    """
+    rows = Photo.objects.using(using).filter(pk__in=photo_pks) \
+        .values_list('pk', 'event_id', 'owner_id', 'upload_dt', 'stats__likes', 'visible', 'duplicate_of_id')
+    changes = {}
+    for pk, event_pk, owner_pk, upload_dt, likes, visible, duplicate_of_pk in rows:
+        score = float(scores(likes or 0, upload_dt.timestamp())) if visible and duplicate_of_pk is None else None
+        changes.setdefault(event_pk, []).append((pk, owner_pk, score))
+    if not changes:
+        return
+
+    rankings = {}
+    for event_pk, pk, owner_pk, score in BestPhoto.objects.using(using).filter(event_id__in=changes) \
+            .order_by('event_id', 'rank').values_list('event_id', 'photo_id', 'owner_id', 'score'):
+        rankings.setdefault(event_pk, []).append((pk, owner_pk, score))
+
+    count = settings.BEST_PHOTOS_COUNT
+    changed_scores = {}
+    for event_pk, event_changes in changes.items():
+        current = rankings.get(event_pk, [])
+        ranked = {pk: (owner_pk, score) for pk, owner_pk, score in current}
+        worse = [(pk, score) for pk, _, score in event_changes
+                 if pk in ranked and (score is None or score < ranked[pk][1])]
+        if worse and len(ranked) >= count:
+            rank_event(event_pk)
+            continue
+
+        # a ranking which is not full has all candidates
+        for pk, score in worse:
+            if score is None:
+                del ranked[pk]
+        threshold = min(score for _, score in ranked.values()) if len(ranked) >= count else float('-inf')
+        for pk, owner_pk, score in event_changes:
+            if score is not None and (pk in ranked or score > threshold):
+                ranked[pk] = (owner_pk, score)
+
+        selected = diversify([(pk, owner_pk, score) for pk, (owner_pk, score) in ranked.items()], count)
+        if [pk for pk, _, _ in current] == [pk for pk, _, _ in selected]:
+            # same order: the scores of all events at once
+            current_scores = {pk: score for pk, _, score in current}
+            changed_scores.update((pk, score) for pk, _, score in selected if current_scores[pk] != score)
+        else:
+            save_ranking(event_pk, selected, using, current)
+
+    save_scores(changed_scores, using)
+
+
+@contextmanager
+def batched_ranking():
+    """
+    Collects the photos changed within (in this thread) and updates the rankings once on exit.
+    Nested uses update on exit of the outermost one, nothing is updated if it raises.
+    """
+    if getattr(_batch, 'changes', None) is not None:
+        yield
+        return
+
+    _batch.changes = changes = {}
+    try:
+        yield
+    finally:
+        _batch.changes = None
+
+    for using, (photo_pks, event_pks) in changes.items():
+        for event_pk in event_pks:
+            rank_event(event_pk)
+        update_photos(photo_pks, using)
+
+
+def _changes(using: str):
+    return _batch.changes.setdefault(using, (set(), set()))
+
+
+class BatchedRankingMiddleware(object):
+    """
+    Updates the rankings once per request, for all photos and likes it changed.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with batched_ranking():
+            return self.get_response(request)
+
+
+@receiver(likes_counted)
+def rank_liked_photos(sender, photo_pks=None, using=None, **kwargs):
+    with batched_ranking():
+        _changes(using)[0].update(photo_pks)
+
+
+@receiver(post_save, sender=Photo)
+def rank_saved_photo(sender, instance=None, using=None, **kwargs):
+    with batched_ranking():
+        _changes(using)[0].add(instance.pk)
+
+
+@receiver(post_delete, sender=Photo)
+def rank_deleted_photo(sender, instance=None, using=None, **kwargs):
+    if BestPhoto.objects.using(using).filter(photo_id=instance.pk).delete()[0]:
+        with batched_ranking():
+            _changes(using)[1].add(instance.event_id)
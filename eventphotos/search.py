@@ -0,0 +1,153 @@
+import functools
+import logging
+import re
+import sqlite3
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.models.signals import post_init, post_migrate, post_save, post_delete
+from django.dispatch import receiver
+
+from eventphotos import sharding
+from eventphotos.models import Event, Photo
+
+# SQLite FTS5 index of the comments and owner names of the photos, one row per photo (rowid = photo id)
+# in the database of the photo. The table is created by migrate and along with the event databases,
+# kept in sync by the receivers below, manage.py rebuild_search_index creates it in existing databases
+# and indexes photos which existed before. Without FTS5 in SQLite there is no search.
+TABLE = 'eventphotos_photosearch'
+
+logger = logging.getLogger(__name__)
+
+
+def is_available(using: str = 'default') -> bool:
+    """
+    Whether the database is SQLite and the SQLite library has FTS5.
+    """
+    return connections[using].vendor == 'sqlite' and has_fts5()
+
+
+@functools.lru_cache()
+def has_fts5() -> bool:
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute('CREATE VIRTUAL TABLE test USING fts5(text)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
+
+def create_table(using: str):
+    """
+    Creates the index table in the SQLite database unless it exists.
+    """
+    if not is_available(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5('
+                       'comment, owner_name, event_id UNINDEXED, '
+                       'tokenize = "unicode61 remove_diacritics 2")'.format(TABLE))
+
+
+@receiver(post_migrate)
+def create_migrated_table(sender, using=None, **kwargs):
+    # replicas get the table from their primary
+    if sender.name == 'eventphotos' and using not in settings.DATABASE_REPLICAS:
+        if not is_available(using):
+            logger.warning('%s is not SQLite with FTS5, photo search is not available', using)
+        create_table(using)
+
+
+@receiver(sharding.event_database_created)
+def create_event_table(sender, using=None, **kwargs):
+    create_table(using)
+
+
+def match_expression(query: str):
+    """
+    FTS5 query for the words of the user's query (all of them, as prefixes), None if there are none.
+    """
+    words = re.findall(r'\w+', query)[:settings.PHOTO_SEARCH_MAX_TERMS]
+    if not words:
+        return None
+    return ' '.join('"{}"*'.format(word) for word in words)
+
+
+def search(queryset, query: str, event_pk: int, ranked: bool = True):
+    """
+    Restricts the photo queryset to the photos of the event matching the query,
+    their relevance (lower is better) is annotated as search_rank and, if ranked, the best matches come first.
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return queryset.none()
+
+    queryset = queryset.extra(
+        select={'search_rank': '{}.rank'.format(TABLE)},
+        tables=[TABLE],
+        where=['{}.rowid = {}.id'.format(TABLE, Photo._meta.db_table),
+               '{} MATCH %s'.format(TABLE),
+               '{}.event_id = %s'.format(TABLE)],
+        params=[expression, event_pk])
+    return queryset.order_by('search_rank', '-upload_dt') if ranked else queryset
+
+
+def index_photos(rows, using: str):
+    """
+    (Re)indexes the photos given as (pk, comment, owner name, event pk).
+    """
+    rows = list(rows)
+    with connections[using].cursor() as cursor:
+        cursor.executemany('DELETE FROM {} WHERE rowid = %s'.format(TABLE), [(row[0],) for row in rows])
+        cursor.executemany('INSERT INTO {} (rowid, comment, owner_name, event_id) VALUES (%s, %s, %s, %s)'
+                           .format(TABLE), rows)
+
+
+def photo_databases():
+    """
+    Returns the databases with photos: the existing event databases or 'default'.
+    """
+    if not sharding.is_enabled():
+        return ['default']
+    return [sharding.event_database(event_pk) for event_pk in Event.objects.values_list('pk', flat=True)
+            if sharding.has_event_database(event_pk)]
+
+
+@receiver(post_save, sender=Photo)
+def index_photo(sender, instance=None, using=None, **kwargs):
+    if not is_available(using):
+        return
+    index_photos([(instance.pk, instance.comment, instance.owner.first_name, instance.event_id)], using)
+
+
+@receiver(post_delete, sender=Photo)
+def unindex_photo(sender, instance=None, using=None, **kwargs):
+    if not is_available(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute('DELETE FROM {} WHERE rowid = %s'.format(TABLE), [instance.pk])
+
+
+@receiver(post_init, sender=User)
+def remember_owner_name(sender, instance=None, **kwargs):
+    instance._indexed_first_name = instance.first_name
+
+
+@receiver(post_save, sender=User)
+def rename_owner(sender, instance=None, created=False, **kwargs):
+    # only renames touch the event databases, not e.g. logins or password changes
+    renamed = instance.first_name != instance._indexed_first_name
+    instance._indexed_first_name = instance.first_name
+    if created or not renamed:
+        return
+
+    for using in photo_databases():
+        if not is_available(using):
+            continue
+        with connections[using].cursor() as cursor:
+            cursor.execute('UPDATE {} SET owner_name = %s WHERE rowid IN (SELECT id FROM {} WHERE owner_id = %s) '
+                           'AND owner_name != %s'.format(TABLE, Photo._meta.db_table),
+                           [instance.first_name, instance.pk, instance.first_name])
@@ -1,11 +1,70 @@
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import models
 from rest_framework import serializers
+from rest_framework.reverse import reverse
 
+from eventserver.settings import USER_PHOTO_PREVIEW_SIZE
+
+from eventphotos import sharding
+from eventphotos.media import sign_media_url
+from eventphotos.likebuffer import like_buffer
 from eventphotos.models import Photo, Like, Event, UserAuthenticatedForEvent
 
 
-class LikeSerializer(serializers.ModelSerializer):
+class TimestampDateTimeField(serializers.DateTimeField):
+    """
+    Date time field which is rendered as integer unix timestamp for binary formats (MessagePack)
+    and as usual (ISO 8601) for everything else.
+    """
+    binary_formats = ('msgpack',)
+
+    def to_representation(self, value):
+        request = self.context.get('request', None)
+        renderer = getattr(request, 'accepted_renderer', None)
+        if value and getattr(renderer, 'format', None) in self.binary_formats:
+            return int(value.timestamp())
+        return super(TimestampDateTimeField, self).to_representation(value)
+
+
+class SignedFileField(serializers.FileField):
+    """
+    File field whose url is signed (see eventphotos.media.sign_media_url),
+    so the media view serves it without authentication.
+    """
+
+    def to_representation(self, value):
+        url = super(SignedFileField, self).to_representation(value)
+        if url and settings.MEDIA_SIGNED_URLS:
+            url = sign_media_url(url, value.name)
+        return url
+
+
+class ModelSerializer(serializers.ModelSerializer):
+    serializer_field_mapping = dict(serializers.ModelSerializer.serializer_field_mapping)
+    serializer_field_mapping[models.DateTimeField] = TimestampDateTimeField
+
+
+class PhotoPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Looks the photo up in the database of its event.
+    """
+
+    def to_internal_value(self, data):
+        if not sharding.is_enabled():
+            return super(PhotoPrimaryKeyRelatedField, self).to_internal_value(data)
+        try:
+            return sharding.using_pk(self.get_queryset(), data).get(pk=data)
+        except ObjectDoesNotExist:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
+class LikeSerializer(ModelSerializer):
     owner_name = serializers.ReadOnlyField(source='owner.first_name')
+    photo = PhotoPrimaryKeyRelatedField(queryset=Photo.objects.all())
 
     class Meta:
         model = Like
@@ -20,10 +79,13 @@ class LikeSerializer(serializers.ModelSerializer):
         return data
 
 
-class PhotoSerializer(serializers.ModelSerializer):
+class PhotoSerializer(ModelSerializer):
+    serializer_field_mapping = dict(ModelSerializer.serializer_field_mapping)
+    serializer_field_mapping[models.FileField] = SignedFileField
+
     owner_name = serializers.ReadOnlyField(source='owner.first_name')
     comment = serializers.CharField(allow_blank=True)
-    likes = serializers.IntegerField(source='like_set.count', read_only=True)
+    likes = serializers.SerializerMethodField()
     liked_by_current_user = serializers.SerializerMethodField()
 
     class Meta:
@@ -32,8 +94,8 @@ class PhotoSerializer(serializers.ModelSerializer):
             'id', 'url', 'event', 'owner', 'owner_name',
             'upload_dt', 'photo_dt', 'visible', 'photo',
             'hash_md5', 'thumbnail', 'web_photo', 'comment',
-            'likes', 'liked_by_current_user')
-        read_only_fields = ('id', 'owner', 'thumbnail', 'web_photo', 'upload_dt', 'photo_dt')
+            'likes', 'liked_by_current_user', 'duplicate_of')
+        read_only_fields = ('id', 'owner', 'thumbnail', 'web_photo', 'upload_dt', 'photo_dt', 'duplicate_of')
 
     def validate(self, data):
         # only check if user <-> event if event gets indeed updated
@@ -44,30 +106,67 @@ class PhotoSerializer(serializers.ModelSerializer):
                 raise serializers.ValidationError('user not authorised for this event')
         return data
 
+    def get_likes(self, obj):
+        likes = obj.like_set.count()
+        if like_buffer.is_enabled():
+            likes += like_buffer.like_delta(obj.pk)
+        return likes
+
     def get_liked_by_current_user(self, obj):
         if not self.context['request'].user.is_authenticated():
             return False
         else:
-            return Like.objects.filter(photo=obj, owner=self.context['request'].user).exists()
+            if like_buffer.is_enabled():
+                is_liked = like_buffer.is_liked(self.context['request'].user.pk, obj.pk)
+                if is_liked is not None:
+                    return is_liked
+            return obj.like_set.filter(owner=self.context['request'].user).exists()
 
 
-class UserAuthenticatedForEventSerializer(serializers.ModelSerializer):
+class UserAuthenticatedForEventSerializer(ModelSerializer):
     class Meta:
         model = UserAuthenticatedForEvent
         fields = ('id', 'url', 'user', 'event')
 
 
-class EventSerializer(serializers.ModelSerializer):
+class EventSerializer(ModelSerializer):
     class Meta:
         model = Event
         fields = ('id', 'url', 'name', 'challenge', 'start_dt', 'end_dt', 'icon', 'dt')
         read_only_fields = ('id', 'dt')
 
 
-class UserSerializer(serializers.ModelSerializer):
-    photos = PhotoSerializer(many=True, read_only=True)
+class PhotoPreviewSerializer(ModelSerializer):
+    serializer_field_mapping = PhotoSerializer.serializer_field_mapping
+
+    class Meta:
+        model = Photo
+        fields = ('id', 'url', 'event', 'thumbnail')
+
+
+class UserSerializer(ModelSerializer):
+    photo_count = serializers.SerializerMethodField()
+    photos_url = serializers.SerializerMethodField()
+    photo_preview = serializers.SerializerMethodField()
 
     class Meta:
         model = User
-        fields = ('id', 'url', 'username', 'photos', 'first_name')
-        depth = 1
+        fields = ('id', 'url', 'username', 'photo_count', 'photos_url', 'photo_preview', 'first_name')
+
+    def get_photo_count(self, obj):
+        # annotated by UserViewSet, fall back to a query otherwise
+        if hasattr(obj, 'photo_count'):
+            return obj.photo_count
+        return obj.photos.count()
+
+    def get_photos_url(self, obj):
+        url = reverse('photo-list', request=self.context.get('request', None))
+        return '{}?owner_id={}'.format(url, obj.pk)
+
+    def get_photo_preview(self, obj):
+        # prefetched by UserViewSet, fall back to a query otherwise
+        if hasattr(obj, 'photo_preview'):
+            photos = obj.photo_preview[:USER_PHOTO_PREVIEW_SIZE]
+        else:
+            photos = obj.photos.all()[:USER_PHOTO_PREVIEW_SIZE]
+        return PhotoPreviewSerializer(photos, many=True, context=self.context).data
@@ -0,0 +1,226 @@
+import heapq
+import itertools
+import os
+import threading
+from operator import attrgetter
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections
+from django.dispatch import Signal
+
+# models which live in the database of their event, everything else (Event, User, ...) stays in 'default'
+SHARDED_MODELS = {'eventphotos.photo', 'eventphotos.like', 'eventphotos.userauthenticatedforevent',
+                  'eventphotos.eventstats', 'eventphotos.contributorstats', 'eventphotos.photostats',
+                  'eventphotos.bestphoto'}
+
+# primary keys of sharded models start at event id << PK_SHIFT, so that the event of a photo can be
+# derived from its id and ids are unique across all event databases
+PK_SHIFT = 32
+
+# guards the registration and creation of event databases,
+# aliases which are registered and whose tables exist -> their path
+_lock = threading.Lock()
+_ready = {}
+
+# sent after the tables of a new event database were created (e.g. to add tables of other modules)
+event_database_created = Signal(providing_args=['using', 'event_id'])
+
+
+def is_enabled() -> bool:
+    return getattr(settings, 'EVENT_SHARDING', False)
+
+
+def is_sharded(model) -> bool:
+    return model._meta.label_lower in SHARDED_MODELS
+
+
+def event_id_for_pk(pk) -> int:
+    return int(pk) >> PK_SHIFT
+
+
+def event_database(event_id) -> str:
+    """
+    Returns the database alias of the event, the SQLite file (and its tables) is created on first use.
+    Raises Event.DoesNotExist for unknown events.
+    """
+    event_id = int(event_id)
+    alias = 'event_{}'.format(event_id)
+    path = event_database_path(event_id)
+
+    if _ready.get(alias) == path:
+        return alias
+
+    with _lock:
+        # another thread may have created it meanwhile
+        if _ready.get(alias) == path:
+            return alias
+
+        exists = os.path.exists(path)
+        if not exists:
+            event_model = apps.get_model('eventphotos.event')
+            if not event_model.objects.filter(pk=event_id).exists():
+                raise event_model.DoesNotExist('event {} does not exist'.format(event_id))
+
+        os.makedirs(settings.EVENT_SHARD_ROOT, exist_ok=True)
+        if alias in connections.databases:
+            # EVENT_SHARD_ROOT changed
+            close_event_database(alias)
+        connections.databases[alias] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': path,
+        }
+        if not exists:
+            try:
+                _create_tables(alias, event_id)
+                event_database_created.send(sender=None, using=alias, event_id=event_id)
+            except Exception:
+                # do not leave a database without tables behind
+                os.remove(close_event_database(alias)['NAME'])
+                raise
+        _ready[alias] = path
+
+    return alias
+
+
+def event_database_path(event_id) -> str:
+    return os.path.join(settings.EVENT_SHARD_ROOT, 'event_{}.sqlite3'.format(int(event_id)))
+
+
+def has_event_database(event_id) -> bool:
+    return os.path.exists(event_database_path(event_id))
+
+
+def _create_tables(alias: str, event_id: int):
+    connection = connections[alias]
+    with connection.schema_editor() as editor:
+        for label in sorted(SHARDED_MODELS):
+            editor.create_model(apps.get_model(label))
+
+    with connection.cursor() as cursor:
+        for label in SHARDED_MODELS:
+            cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)',
+                           [apps.get_model(label)._meta.db_table, event_id << PK_SHIFT])
+
+
+def close_event_database(alias: str):
+    _ready.pop(alias, None)
+    connections[alias].close()
+    del connections[alias]
+    return connections.databases.pop(alias)
+
+
+def drop_event_database(event_id):
+    try:
+        alias = event_database(event_id)
+    except ObjectDoesNotExist:
+        # the event has no database yet
+        return
+    os.remove(close_event_database(alias)['NAME'])
+
+
+def using_event(queryset, event_id):
+    """
+    Routes the queryset to the database of the event (if sharding is enabled).
+    """
+    if not is_enabled():
+        return queryset
+    try:
+        return queryset.using(event_database(event_id))
+    except ObjectDoesNotExist:
+        return queryset.none()
+
+
+def using_pk(queryset, pk):
+    """
+    Routes the queryset to the database of the event of the object with the given primary key.
+    """
+    return using_event(queryset, event_id_for_pk(pk))
+
+
+def event_id_for_instance(instance):
+    if instance._meta.label_lower == 'eventphotos.event':
+        return instance.pk
+    elif hasattr(instance, 'event_id'):
+        return instance.event_id
+    elif hasattr(instance, 'photo_id'):
+        return event_id_for_pk(instance.photo_id)
+    return None
+
+
+class EventShardRouter(object):
+    """
+    Sends photos, likes and event authorisations to the database of their event (if EVENT_SHARDING is set).
+    Queries without an instance hint have to be routed explicitly with using_event/using_pk.
+    """
+
+    def _db(self, model, **hints):
+        if not is_enabled() or not is_sharded(model):
+            return None
+
+        instance = hints.get('instance', None)
+        if instance is None:
+            return None
+        if is_sharded(type(instance)) and instance._state.db is not None:
+            return instance._state.db
+
+        event_id = event_id_for_instance(instance)
+        return None if event_id is None else event_database(event_id)
+
+    def db_for_read(self, model, **hints):
+        return self._db(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # relations between the catalogue (events, users) and the event databases are fine
+        if is_enabled():
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db.startswith('event_'):
+            return '{}.{}'.format(app_label, model_name) in SHARDED_MODELS
+        return None
+
+
+class FanOutQuerySet(object):
+    """
+    Read-only, paginatable merge of equally ordered querysets of several event databases.
+    """
+    ordered = True
+
+    def __init__(self, querysets):
+        self.querysets = list(querysets)
+
+        ordering = []
+        if self.querysets:
+            ordering = self.querysets[0].query.order_by or self.querysets[0].model._meta.ordering
+        fields = [field.lstrip('-') for field in ordering]
+        self.reverse = bool(ordering) and ordering[0].startswith('-')
+        if any(field.startswith('-') != self.reverse for field in ordering):
+            raise ValueError('fan out requires a uniform sort direction: {}'.format(ordering))
+        self.key = attrgetter(*fields) if fields else None
+
+    def count(self) -> int:
+        return sum(queryset.count() for queryset in self.querysets)
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return self._merge(self.querysets)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            # every database contributes at most k.stop objects
+            querysets = self.querysets if k.stop is None else [queryset[:k.stop] for queryset in self.querysets]
+            return list(itertools.islice(self._merge(querysets), k.start, k.stop, k.step))
+        return self[k:k + 1][0]
+
+    def _merge(self, querysets):
+        if self.key is None:
+            return itertools.chain(*querysets)
+        return heapq.merge(*querysets, key=self.key, reverse=self.reverse)
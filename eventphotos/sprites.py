@@ -0,0 +1,70 @@
+import hashlib
+from io import BytesIO
+
+from PIL import Image
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+SPRITE_DIR = 'sprites'
+
+
+def sprite_sheet(photos, event_id) -> dict:
+    """
+    Returns the sprite sheet of the thumbnails of the photos (one page of a grid, in its order):
+    {'name': storage name of the image, 'width': ..., 'height': ..., 'photos': {photo id: [x, y, w, h]}}.
+
+    The name is derived from the photo ids and thumbnails of the page, so a changed page gets a new sheet.
+    The sheet is (re)written whenever its coordinates are cached for PHOTO_SPRITE_CACHE_TIMEOUT seconds,
+    so sheets which are older than that (e.g. of pages which changed since) are unused and deleted by
+    manage.py reconcile_media.
+    """
+    photos = [photo for photo in photos if photo.thumbnail]
+    layout = '\n'.join('{}:{}'.format(photo.pk, photo.thumbnail.name) for photo in photos)
+    key = hashlib.md5('{}\n{}'.format(settings.PHOTO_SPRITE_CELL_SIZE, layout).encode('utf8')).hexdigest()
+    cache_key = 'photo-sprite:{}'.format(key)
+
+    sheet = cache.get(cache_key)
+    if sheet is None:
+        name = '{}/{}/{}.jpg'.format(SPRITE_DIR, event_id, key)
+        image, coordinates = build_sprite_sheet(photos)
+
+        content = BytesIO()
+        image.save(content, 'JPEG', quality=settings.PHOTO_SPRITE_QUALITY)
+        if default_storage.exists(name):
+            default_storage.delete(name)
+        default_storage.save(name, ContentFile(content.getvalue()))
+
+        sheet = {'name': name, 'width': image.width, 'height': image.height, 'photos': coordinates}
+        cache.set(cache_key, sheet, settings.PHOTO_SPRITE_CACHE_TIMEOUT)
+    return sheet
+
+
+def build_sprite_sheet(photos):
+    """
+    Places the thumbnails row by row in cells of PHOTO_SPRITE_CELL_SIZE (scaled down if necessary,
+    centred), PHOTO_SPRITE_COLUMNS per row. Returns the image and {photo id: [x, y, w, h]}.
+    """
+    cell_width, cell_height = settings.PHOTO_SPRITE_CELL_SIZE
+    columns = max(min(settings.PHOTO_SPRITE_COLUMNS, len(photos)), 1)
+    rows = max((len(photos) + columns - 1) // columns, 1)
+
+    sheet = Image.new('RGB', (columns * cell_width, rows * cell_height), (255, 255, 255))
+    coordinates = {}
+    for i, photo in enumerate(photos):
+        try:
+            with photo.thumbnail.storage.open(photo.thumbnail.name, 'rb') as f:
+                image = Image.open(f)
+                image = image.convert('RGB')
+        except (OSError, ValueError):
+            # thumbnail missing or broken, its cell stays empty
+            continue
+        image.thumbnail((cell_width, cell_height), Image.ANTIALIAS)
+
+        x = (i % columns) * cell_width + (cell_width - image.width) // 2
+        y = (i // columns) * cell_height + (cell_height - image.height) // 2
+        sheet.paste(image, (x, y))
+        coordinates[photo.pk] = [x, y, image.width, image.height]
+
+    return sheet, coordinates
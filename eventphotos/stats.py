@@ -0,0 +1,110 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count
+
+from eventphotos import sharding
+from eventphotos.models import ContributorStats, EventStats, Like, Photo, PhotoStats
+
+
+def event_stats(event_pk: int) -> dict:
+    """
+    Returns the counters of the event and its EVENT_STATS_TOP photos (most likes) and contributors
+    (most photos): one row and two index range scans, regardless of the size of the event.
+    """
+    stats = sharding.using_event(EventStats.objects, event_pk).filter(event_id=event_pk).first()
+
+    top_photos = sharding.using_event(PhotoStats.objects, event_pk).filter(event_id=event_pk) \
+        .order_by('-likes', '-photo_id').values_list('photo_id', 'likes')[:settings.EVENT_STATS_TOP]
+
+    top_contributors = list(sharding.using_event(ContributorStats.objects, event_pk)
+                            .filter(event_id=event_pk, photos__gt=0).order_by('-photos', '-likes', 'user_id')
+                            .values_list('user_id', 'photos', 'likes')[:settings.EVENT_STATS_TOP])
+    names = dict(User.objects.filter(pk__in=[row[0] for row in top_contributors]).values_list('pk', 'first_name'))
+
+    return {
+        'event': event_pk,
+        'photos': stats.photos if stats else 0,
+        'uploaders': stats.uploaders if stats else 0,
+        'likes': stats.likes if stats else 0,
+        'top_photos': [{'photo': photo_pk, 'likes': likes} for photo_pk, likes in top_photos],
+        'top_contributors': [{'user': user_pk, 'name': names.get(user_pk, ''), 'photos': photos, 'likes': likes}
+                             for user_pk, photos, likes in top_contributors],
+    }
+
+
+def counted_stats(event_pk: int) -> dict:
+    """
+    Counts the rows of all counters of the event from the photos and likes.
+    """
+    photos = sharding.using_event(Photo.objects, event_pk).filter(event_id=event_pk)
+    owners = dict(photos.values_list('pk', 'owner_id'))
+    likes = dict(sharding.using_event(Like.objects, event_pk).filter(photo__event_id=event_pk)
+                 .values_list('photo_id').annotate(count=Count('pk')).order_by())
+
+    contributors = {}
+    for photo_pk, owner_pk in owners.items():
+        photo_count, like_count = contributors.get(owner_pk, (0, 0))
+        contributors[owner_pk] = (photo_count + 1, like_count + likes.get(photo_pk, 0))
+
+    return {
+        'event': (len(owners), len(contributors), sum(likes.values())),
+        'contributors': contributors,
+        'photos': {photo_pk: (owner_pk, likes.get(photo_pk, 0)) for photo_pk, owner_pk in owners.items()},
+    }
+
+
+def stored_stats(event_pk: int) -> dict:
+    """
+    Returns the counters of the event like counted_stats, contributors without photos and likes are left out.
+    """
+    stats = sharding.using_event(EventStats.objects, event_pk).filter(event_id=event_pk) \
+        .values_list('photos', 'uploaders', 'likes').first()
+    contributors = sharding.using_event(ContributorStats.objects, event_pk).filter(event_id=event_pk) \
+        .exclude(photos=0, likes=0).values_list('user_id', 'photos', 'likes')
+    photos = sharding.using_event(PhotoStats.objects, event_pk).filter(event_id=event_pk) \
+        .values_list('photo_id', 'owner_id', 'likes')
+
+    return {
+        'event': stats or (0, 0, 0),
+        'contributors': {user_pk: (photo_count, like_count) for user_pk, photo_count, like_count in contributors},
+        'photos': {photo_pk: (owner_pk, like_count) for photo_pk, owner_pk, like_count in photos},
+    }
+
+
+def verify_event_stats(event_pk: int):
+    """
+    Returns the differences between the stored and the counted statistics of the event as
+    (counter, key, stored, counted), empty if they are consistent.
+    """
+    stored, counted = stored_stats(event_pk), counted_stats(event_pk)
+    differences = []
+    if stored['event'] != counted['event']:
+        differences.append(('event', event_pk, stored['event'], counted['event']))
+    for counter in ('contributors', 'photos'):
+        for key in sorted(set(stored[counter]) | set(counted[counter])):
+            if stored[counter].get(key) != counted[counter].get(key):
+                differences.append((counter, key, stored[counter].get(key), counted[counter].get(key)))
+    return differences
+
+
+def rebuild_event_stats(event_pk: int):
+    """
+    Replaces the statistics of the event with the counted ones.
+    """
+    counted = counted_stats(event_pk)
+    using = sharding.using_event(EventStats.objects, event_pk).db
+
+    with transaction.atomic(using=using):
+        for model in (EventStats, ContributorStats, PhotoStats):
+            model.objects.using(using).filter(event_id=event_pk).delete()
+
+        photo_count, uploaders, like_count = counted['event']
+        EventStats.objects.using(using).create(event_id=event_pk, photos=photo_count, uploaders=uploaders,
+                                               likes=like_count)
+        ContributorStats.objects.using(using).bulk_create(
+            ContributorStats(event_id=event_pk, user_id=user_pk, photos=photo_count, likes=like_count)
+            for user_pk, (photo_count, like_count) in counted['contributors'].items())
+        PhotoStats.objects.using(using).bulk_create(
+            PhotoStats(photo_id=photo_pk, event_id=event_pk, owner_id=owner_pk, likes=like_count)
+            for photo_pk, (owner_pk, like_count) in counted['photos'].items())
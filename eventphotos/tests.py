@@ -1,20 +1,68 @@
+import asyncio
+import email
+import fcntl
 import hashlib
+import json
 import os
+import shutil
+import struct
 import tempfile
-
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import BytesIO, StringIO
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import msgpack
+import numpy as np
 from PIL import Image
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.db.models import Count, Q
+from django.test import override_settings, SimpleTestCase, TransactionTestCase
+from django.test.client import encode_multipart, BOUNDARY, MULTIPART_CONTENT
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APITestCase, APIRequestFactory, APITransactionTestCase
 
 # Create your tests here.
-from eventphotos.models import Event, UserAuthenticatedForEvent, Photo, Like
+from eventphotos import models, perceptualhash, sharding, sprites, timeline
+from eventphotos.admission import Admission
+from eventphotos.likebuffer import LikeBuffer, like_buffer
+from eventphotos.media import media_signature
+from eventphotos.perceptualhash import MultiIndexHash, hamming
+from eventphotos.models import ArchivedFile, ContributorStats, Event, EventStats, UserAuthenticatedForEvent, Photo, \
+    PhotoStats, Like, batched_counts
+from eventphotos.serializers import PhotoSerializer
+from eventphotos.views import PhotoViewSet, LikeViewSet
+from eventserver.asgi import ASGIHandler
+from eventserver.renderers import MessagePackRenderer
+from eventserver.routers import ReplicaRouter
+from eventserver.settings import USER_PHOTO_PREVIEW_SIZE
+from eventserver.sqlite import write_queue
+from eventserver.storage import S3Storage
 
 
 class ApiTest(APITestCase):
     def setUp(self):
+        # upload admission slots in a temporary directory
+        slot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, slot_dir)
+        slot_settings = override_settings(UPLOAD_ADMISSION_LOCK_DIR=slot_dir)
+        slot_settings.enable()
+        self.addCleanup(slot_settings.disable)
+
         # test photo
         image_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'media/test_heart.jpg')
 
@@ -692,3 +740,1967 @@ class ApiTest(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(Like.objects.count(), initial_like_count)
+
+    def test_list_photos_msgpack(self):
+        # get user
+        user = User.objects.get(username='user3')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user.auth_token.key)
+
+        url = reverse('photo-list')
+        response = self.client.get(url, HTTP_ACCEPT='application/msgpack')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+
+        data = msgpack.unpackb(response.content, raw=False)
+        self.assertEqual(data['count'], 3)
+
+        # timestamps are integers
+        photo = Photo.objects.get(pk=data['results'][0]['id'])
+        self.assertEqual(data['results'][0]['upload_dt'], int(photo.upload_dt.timestamp()))
+
+    def test_like_photo_msgpack(self):
+        initial_like_count = Like.objects.count()
+
+        # get user
+        user = User.objects.get(username='user3')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user.auth_token.key)
+
+        # get photo
+        photo = Photo.objects.first()
+
+        url = reverse('like-photo')
+        body = msgpack.packb({'photo_id': photo.id, 'like': True}, use_bin_type=True)
+        response = self.client.post(url, body, content_type='application/msgpack')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Like.objects.count(), initial_like_count + 1)
+        self.assertEqual(response.data['liked_by_current_user'], True)
+
+    def test_list_users(self):
+        # get admin
+        admin = User.objects.get(username='admin1')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + admin.auth_token.key)
+
+        # give user3 more photos than the preview holds
+        user3 = User.objects.get(username='user3')
+        photo = Photo.objects.first()
+        for i in range(USER_PHOTO_PREVIEW_SIZE + 2):
+            photo.pk = None
+            photo.save()
+
+        url = reverse('user-list')
+        # token, count, users, preview photos
+        with self.assertNumQueries(4):
+            response = self.client.get(url, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        users = {u['username']: u for u in response.data['results']}
+        self.assertEqual(users['user3']['photo_count'], USER_PHOTO_PREVIEW_SIZE + 5)
+        self.assertEqual(len(users['user3']['photo_preview']), USER_PHOTO_PREVIEW_SIZE)
+        self.assertEqual(users['user1']['photo_count'], 0)
+        self.assertEqual(users['user1']['photo_preview'], [])
+
+        # the photos link lists exactly the photos of the user
+        response = self.client.get(users['user3']['photos_url'], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], USER_PHOTO_PREVIEW_SIZE + 5)
+        self.assertTrue(all(p['owner'] == user3.pk for p in response.data['results']))
+
+    def test_like_photos_bulk(self):
+        # get user
+        user = User.objects.get(username='user3')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user.auth_token.key)
+
+        # get photos
+        photo3, photo2, photo1 = Photo.objects.all()
+
+        # like one of them already
+        Like.objects.create(owner=user, photo=photo1)
+        Like.objects.create(owner=User.objects.get(username='admin1'), photo=photo2)
+
+        url = reverse('like-photos')
+        data = {'likes': [
+            {'photo_id': photo1.id, 'like': False},
+            {'photo_id': photo2.id, 'like': True},
+            {'photo_id': photo3.id, 'like': False},
+            {'photo_id': photo3.id, 'like': True},
+        ]}
+        # token, auth check, savepoint, existing likes, insert, delete, release, counts,
+        # the deleted like (loaded for its post_delete signal), the statistics of all likes at once: their photos
+        # and one update per table, and the best of rankings once per request: the photos, the rankings of their
+        # events and the changed scores
+        with self.assertNumQueries(8 + 1 + 4 + 3):
+            response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        result = {r['photo_id']: r for r in response.data}
+        self.assertEqual(result[photo1.id]['likes'], 0)
+        self.assertEqual(result[photo2.id]['likes'], 2)
+        self.assertEqual(result[photo3.id]['likes'], 1)
+        self.assertEqual(result[photo3.id]['liked_by_current_user'], True)
+        self.assertEqual(set(Like.objects.filter(owner=user).values_list('photo__pk', flat=True)),
+                         {photo2.id, photo3.id})
+
+    def test_like_photos_bulk_unauthenticated_photo(self):
+        initial_like_count = Like.objects.count()
+
+        # get user
+        user = User.objects.get(username='user1')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user.auth_token.key)
+
+        # get photos
+        photo3, photo2, photo1 = Photo.objects.all()
+
+        # user1 may only access one of the events
+        UserAuthenticatedForEvent.objects.create(user=user, event=photo1.event)
+
+        url = reverse('like-photos')
+        data = {'likes': [
+            {'photo_id': photo1.id, 'like': True},
+            {'photo_id': photo2.id, 'like': True},
+        ]}
+        response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Like.objects.count(), initial_like_count)
+
+    @override_settings(LIKE_WRITE_BEHIND=True, LIKE_WRITE_BEHIND_FLUSH_INTERVAL=0)
+    def test_like_photo_write_behind(self):
+        initial_like_count = Like.objects.count()
+
+        # get user
+        user = User.objects.get(username='user3')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user.auth_token.key)
+
+        # get photo
+        photo = Photo.objects.first()
+
+        # like, unlike, like: last write wins
+        url = reverse('like-photo')
+        for like in [True, False, True]:
+            response = self.client.post(url, {'photo_id': photo.id, 'like': like}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # nothing written yet, but the user sees the like
+        self.assertEqual(Like.objects.count(), initial_like_count)
+        self.assertEqual(response.data['likes'], 1)
+        self.assertEqual(response.data['liked_by_current_user'], True)
+
+        url = reverse('photo-detail', kwargs={'pk': photo.pk})
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.data['likes'], 1)
+        self.assertEqual(response.data['liked_by_current_user'], True)
+
+        # flush writes a single like
+        like_buffer.flush()
+        self.assertEqual(Like.objects.count(), initial_like_count + 1)
+        self.assertTrue(Like.objects.filter(owner=user, photo=photo).exists())
+
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.data['likes'], 1)
+        self.assertEqual(response.data['liked_by_current_user'], True)
+
+    def test_like_write_behind_journal(self):
+        user = User.objects.get(username='user3')
+        photo3, photo2, photo1 = Photo.objects.all()
+
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        path = os.path.join(journal_dir, 'likes.journal')
+
+        def write_journal(journal_path, photo):
+            with open(journal_path, 'w') as f:
+                f.write(json.dumps({'user': user.pk, 'photo': photo.pk, 'like': True}) + '\n')
+
+        # a process which is gone and one which is running (its journal is locked)
+        write_journal(path + '.999999999', photo1)
+        write_journal(path + '.1', photo2)
+        running = open(path + '.1')
+        self.addCleanup(running.close)
+        fcntl.flock(running.fileno(), fcntl.LOCK_EX)
+
+        with override_settings(LIKE_WRITE_BEHIND=True, LIKE_WRITE_BEHIND_FLUSH_INTERVAL=0,
+                               LIKE_WRITE_BEHIND_JOURNAL=path):
+            buffer = LikeBuffer()
+            self.addCleanup(lambda: buffer.journal.close())
+            buffer.add(user.pk, photo3.pk, True, False)
+
+            # the toggles of the process which is gone are taken over
+            self.assertTrue(buffer.is_liked(user.pk, photo1.pk))
+            self.assertIsNone(buffer.is_liked(user.pk, photo2.pk))
+            self.assertFalse(os.path.exists(path + '.999999999'))
+            with open('{}.{}'.format(path, os.getpid())) as f:
+                self.assertEqual(len(f.readlines()), 2)
+
+            # a flush only truncates the journal of this process
+            buffer.flush()
+            self.assertEqual(set(Like.objects.filter(owner=user).values_list('photo_id', flat=True)),
+                             {photo1.pk, photo3.pk})
+            self.assertEqual(os.path.getsize('{}.{}'.format(path, os.getpid())), 0)
+            self.assertGreater(os.path.getsize(path + '.1'), 0)
+
+    @override_settings(LIKE_WRITE_BEHIND=True, LIKE_WRITE_BEHIND_FLUSH_INTERVAL=0, LIKE_WRITE_BEHIND_MAX_PENDING=2)
+    def test_like_photos_write_behind_max_pending(self):
+        # get user
+        user = User.objects.get(username='user3')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user.auth_token.key)
+
+        # get photos
+        photo3, photo2, photo1 = Photo.objects.all()
+
+        # like it
+        Like.objects.create(owner=user, photo=photo1)
+
+        url = reverse('like-photos')
+        data = {'likes': [
+            {'photo_id': photo1.id, 'like': False},
+        ]}
+        response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]['likes'], 0)
+        self.assertTrue(Like.objects.filter(owner=user, photo=photo1).exists())
+
+        # the second pending toggle triggers a flush
+        data = {'likes': [
+            {'photo_id': photo2.id, 'like': True},
+        ]}
+        response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]['likes'], 1)
+        self.assertEqual(set(Like.objects.filter(owner=user).values_list('photo__pk', flat=True)), {photo2.id})
+
+    def test_cached_token_authentication(self):
+        # get user
+        user = User.objects.get(username='user3')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user.auth_token.key)
+
+        url = reverse('photo-detail', kwargs={'pk': Photo.objects.first().pk})
+
+        def token_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return len([q for q in queries if 'authtoken_token' in q['sql']])
+
+        self.assertEqual(token_queries(), 1)
+        self.assertEqual(token_queries(), 0)
+
+        # changing the user invalidates the cached token
+        user.first_name = 'user3 renamed'
+        user.save()
+        self.assertEqual(token_queries(), 1)
+        self.assertEqual(self.client.get(url, format='json').data['owner_name'], 'user3 renamed')
+
+        # so does deleting the token
+        user.auth_token.delete()
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def upload_photo(self, user, event):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user.auth_token.key)
+
+        image = Image.new('RGB', (100, 100))
+        tmp_file = tempfile.NamedTemporaryFile(suffix='.jpg')
+        image.save(tmp_file)
+        tmp_file.seek(0)
+
+        url = reverse('photo-list')
+        photo_data = {
+            'event': event.id,
+            'visible': True,
+            'photo': tmp_file,
+            'hash_md5': '78ef68043f5aed0de916c936e3d8fb2f',
+            'comment': 'abc',
+        }
+        response = self.client.post(url, photo_data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return Photo.objects.get(pk=response.data['id'])
+
+    def get_media(self, path, **headers):
+        response = self.client.get(reverse('media', kwargs={'path': path}), **headers)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, content
+
+    def test_media(self):
+        cache.clear()
+
+        user1 = User.objects.get(username='user1')
+        user3 = User.objects.get(username='user3')
+        event = Event.objects.get(name='My Amazing Wedding 3')
+        photo = self.upload_photo(user3, event)
+
+        with open(photo.thumbnail.path, 'rb') as f:
+            thumbnail = f.read()
+
+        # authorised user
+        response, content = self.get_media(photo.thumbnail.name)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(content, thumbnail)
+
+        # not modified
+        response, content = self.get_media(photo.thumbnail.name, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # ranges
+        response, content = self.get_media(photo.thumbnail.name, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/{}'.format(len(thumbnail)))
+        self.assertEqual(content, thumbnail[10:20])
+
+        response, content = self.get_media(photo.thumbnail.name, HTTP_RANGE='bytes=-10')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(content, thumbnail[-10:])
+
+        response, content = self.get_media(photo.thumbnail.name, HTTP_RANGE='bytes={}-'.format(len(thumbnail)))
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+        # front-end server transfer
+        with override_settings(MEDIA_ACCEL='nginx'):
+            response, content = self.get_media(photo.web_photo.name)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + photo.web_photo.name)
+        self.assertEqual(content, b'')
+
+        # user not authorised for the event
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user1.auth_token.key)
+        response, content = self.get_media(photo.photo.name)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        # no way around the checks with .. (the icons are public), absolute paths or backslashes
+        for path in ['event_icon/../' + photo.photo.name, 'event_icon/x/../../' + photo.photo.name,
+                     '/' + photo.photo.name, 'event_icon\\..\\' + photo.photo.name]:
+            response, content = self.get_media(path)
+            self.assertIn(response.status_code, (status.HTTP_403_FORBIDDEN, status.HTTP_404_NOT_FOUND), path)
+
+        # authorising the user invalidates the cached check
+        UserAuthenticatedForEvent.objects.create(user=user1, event=event)
+        response, content = self.get_media(photo.photo.name)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # no user
+        self.client.credentials()
+        response, content = self.get_media(photo.photo.name)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_signed_media_urls(self):
+        user1 = User.objects.get(username='user1')
+        user3 = User.objects.get(username='user3')
+        event = Event.objects.get(name='My Amazing Wedding 3')
+        photo = self.upload_photo(user3, event)
+
+        # content-hashed file names
+        self.assertTrue(os.path.basename(photo.photo.name).startswith('78ef68043f5aed0de916c936e3d8fb2f'))
+        with open(photo.thumbnail.path, 'rb') as f:
+            thumbnail = f.read()
+        self.assertIn(hashlib.md5(thumbnail).hexdigest()[:12], photo.thumbnail.name)
+
+        response = self.client.get(reverse('photo-detail', kwargs={'pk': photo.pk}))
+        url = urlparse(response.data['thumbnail'])
+        query = parse_qs(url.query)
+        self.assertEqual(url.path, '/media/' + photo.thumbnail.name)
+
+        # every authorised user gets the same url
+        UserAuthenticatedForEvent.objects.create(user=user1, event=event)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user1.auth_token.key)
+        response = self.client.get(reverse('photo-detail', kwargs={'pk': photo.pk}))
+        self.assertEqual(urlparse(response.data['thumbnail']), url)
+
+        # no authentication needed, shared caches may store the response until the url expires
+        self.client.credentials()
+        response, content = self.get_media(photo.thumbnail.name, QUERY_STRING=url.query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(content, thumbnail)
+        self.assertTrue(response['Cache-Control'].startswith('public, max-age='))
+        self.assertLessEqual(int(response['Cache-Control'].split('=')[1].split(',')[0]),
+                             2 * settings.MEDIA_URL_BUCKET_SECONDS)
+
+        # signature of another file
+        response, content = self.get_media(photo.web_photo.name, QUERY_STRING=url.query)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # expired
+        expires = int(time.time()) - 1
+        response, content = self.get_media(photo.thumbnail.name, QUERY_STRING=urlencode({
+            'expires': expires, 'signature': media_signature(photo.thumbnail.name, expires)}))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # tampered expiry
+        response, content = self.get_media(photo.thumbnail.name, QUERY_STRING=urlencode({
+            'expires': int(query['expires'][0]) + 1, 'signature': query['signature'][0]}))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_export_event_photos(self):
+        user1 = User.objects.get(username='user1')
+        user3 = User.objects.get(username='user3')
+        event = Event.objects.get(name='My Amazing Wedding 3')
+        photo = self.upload_photo(user3, event)
+        Photo.objects.filter(event=event).exclude(pk=photo.pk).update(photo_dt=timezone.now() - timedelta(days=2),
+                                                                      crc32=None)
+        url = reverse('export-event-photos', kwargs={'event_id': event.id})
+
+        def get(**kwargs):
+            response = self.client.get(url, kwargs.pop('data', None), **kwargs)
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+            return response, content
+
+        response, content = get()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertEqual(int(response['Content-Length']), len(content))
+        etag = response['ETag']
+        with zipfile.ZipFile(BytesIO(content)) as archive:
+            self.assertIsNone(archive.testzip())
+            infos = archive.infolist()
+            self.assertEqual(len(infos), 2)
+            self.assertTrue(all(info.compress_type == zipfile.ZIP_STORED for info in infos))
+            # crc and sizes in the local headers, for streaming unzippers
+            self.assertTrue(all(info.flag_bits & 0x08 == 0 for info in infos))
+            for info in infos:
+                self.assertEqual(struct.unpack_from('<III', content, info.header_offset + 14),
+                                 (info.CRC, info.file_size, info.file_size))
+            with open(photo.photo.path, 'rb') as f:
+                self.assertEqual(archive.read(infos[1]), f.read())
+        # the CRC is stored with the photo, missing ones are computed by the export
+        self.assertEqual(Photo.objects.get(pk=photo.pk).crc32, infos[1].CRC)
+        self.assertEqual(Photo.objects.get(pk=infos[0].filename.split('_')[2].split('.')[0]).crc32, infos[0].CRC)
+
+        # filters
+        response, filtered = get(data={'from': (timezone.now() - timedelta(days=1)).isoformat()})
+        with zipfile.ZipFile(BytesIO(filtered)) as archive:
+            self.assertEqual(len(archive.infolist()), 1)
+        response, filtered = get(data={'owner_id': user1.pk})
+        with zipfile.ZipFile(BytesIO(filtered)) as archive:
+            self.assertEqual(len(archive.infolist()), 0)
+        response, filtered = get(data={'to': 'tomorrow'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # resume
+        response, part = get(HTTP_RANGE='bytes=100-', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(part, content[100:])
+        response, part = get(HTTP_RANGE='bytes=100-', HTTP_IF_RANGE='"changed"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(part, content)
+
+        # management command writes the same archive
+        with tempfile.NamedTemporaryFile(suffix='.zip') as f:
+            call_command('export_event', str(event.id), f.name, stderr=StringIO())
+            self.assertEqual(f.read(), content)
+
+        # user not authorised for the event
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user1.auth_token.key)
+        response, content = get()
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_photo_sprite(self):
+        cache.clear()
+
+        user1 = User.objects.get(username='user1')
+        user3 = User.objects.get(username='user3')
+        event = Event.objects.get(name='My Amazing Wedding 3')
+        photos = [self.upload_photo(user3, event) for _ in range(3)]
+        url = reverse('photo-sprite')
+        data = {'event_id': event.id, 'sort_order': 'uploaded', 'page_size': 2}
+
+        response = self.client.get(url, data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # the first page of the list
+        list_response = self.client.get(reverse('photo-list'), data)
+        self.assertEqual(list(response.data['photos']), [photo['id'] for photo in list_response.data['results']])
+        self.assertEqual(response.data['next'], list_response.data['next'].replace('/photos/', '/photos/sprite/'))
+
+        # one cell per photo
+        x, y, width, height = response.data['photos'][photos[-1].pk]
+        self.assertEqual((x, y), ((128 - width) // 2, (128 - height) // 2))
+        self.assertEqual((response.data['width'], response.data['height']), (256, 128))
+
+        # sheet is served (signed) and reused for the same page
+        sprite_url = urlparse(response.data['sprite'])
+        self.client.credentials()
+        response_sheet, content = self.get_media(sprite_url.path[len('/media/'):], QUERY_STRING=sprite_url.query)
+        self.assertEqual(response_sheet.status_code, status.HTTP_200_OK)
+        self.assertEqual(Image.open(BytesIO(content)).size, (256, 128))
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user3.auth_token.key)
+        self.assertEqual(self.client.get(url, data).data['sprite'], response.data['sprite'])
+
+        # unsigned: only for users authorised for the event
+        response_sheet, content = self.get_media(sprite_url.path[len('/media/'):])
+        self.assertEqual(response_sheet.status_code, status.HTTP_200_OK)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user1.auth_token.key)
+        response_sheet, content = self.get_media(sprite_url.path[len('/media/'):])
+        self.assertEqual(response_sheet.status_code, status.HTTP_404_NOT_FOUND)
+        # and no sheet for them
+        sheets = os.listdir(default_storage.path(os.path.dirname(sprite_url.path[len('/media/'):])))
+        self.assertEqual(self.client.get(url, data).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(os.listdir(default_storage.path(os.path.dirname(sprite_url.path[len('/media/'):]))), sheets)
+        # nor other files through the sheets of events they may see
+        other_event = Event.objects.get(name='My Amazing Wedding 1')
+        UserAuthenticatedForEvent.objects.create(user=user1, event=other_event)
+        for path in ['{}/{}/../../{}'.format(sprites.SPRITE_DIR, other_event.pk, photos[0].photo.name),
+                     '{}/{}/{}'.format(sprites.SPRITE_DIR, other_event.pk, photos[0].photo.name)]:
+            response_sheet, content = self.get_media(path)
+            self.assertEqual(response_sheet.status_code, status.HTTP_404_NOT_FOUND)
+
+        # a changed page gets a new sheet
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user3.auth_token.key)
+        photos[-1].delete()
+        changed = self.client.get(url, data)
+        self.assertNotEqual(changed.data['sprite'], response.data['sprite'])
+        self.assertNotIn(photos[-1].pk, changed.data['photos'])
+
+    def test_photo_files(self):
+        user1 = User.objects.get(username='user1')
+        user3 = User.objects.get(username='user3')
+        event = Event.objects.get(name='My Amazing Wedding 3')
+        photos = [self.upload_photo(user3, event) for _ in range(2)]
+        url = reverse('photo-files')
+        ids = [photos[1].pk, photos[0].pk, 999999, photos[1].pk]
+
+        def thumbnail(photo):
+            with open(photo.thumbnail.path, 'rb') as f:
+                return f.read()
+
+        def get(data, **headers):
+            response = self.client.post(url, data, format='json', **headers)
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+            return response, content
+
+        # length prefixed, in request order, unknown photos left out
+        response, content = get({'ids': ids, 'rendition': 'thumbnail'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(int(response['Content-Length']), len(content))
+        files = []
+        while content:
+            photo_pk, length = struct.unpack('>QI', content[:12])
+            files.append((photo_pk, content[12:12 + length]))
+            content = content[12 + length:]
+        self.assertEqual(files, [(photos[1].pk, thumbnail(photos[1])), (photos[0].pk, thumbnail(photos[0]))])
+
+        # multipart
+        response, content = get({'ids': ids, 'rendition': 'web_photo'}, HTTP_ACCEPT='multipart/mixed')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        message = email.message_from_bytes(
+            'Content-Type: {}\r\n\r\n'.format(response['Content-Type']).encode('ascii') + content)
+        parts = message.get_payload()
+        self.assertEqual([part['Content-ID'] for part in parts], ['<{}>'.format(photos[1].pk), '<{}>'.format(photos[0].pk)])
+        with open(photos[1].web_photo.path, 'rb') as f:
+            self.assertEqual(parts[0].get_payload(decode=True), f.read())
+
+        response, content = get({'ids': ids, 'rendition': 'hash_md5'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for invalid in [{}, {'ids': '123'}, {'ids': 5}, {'ids': [1, 'x']}, {'ids': [True]}, {'ids': None}]:
+            response, content = get(invalid)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, invalid)
+
+        # user not authorised for the event
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user1.auth_token.key)
+        response, content = get({'ids': ids})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(content, b'')
+
+    def test_idempotency_key(self):
+        caches['idempotency'].clear()
+
+        user3 = User.objects.get(username='user3')
+        event = Event.objects.get(name='My Amazing Wedding 3')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user3.auth_token.key)
+
+        image = BytesIO()
+        Image.new('RGB', (100, 100)).save(image, 'JPEG')
+
+        def upload(key, comment='abc'):
+            data = {
+                'event': event.id,
+                'visible': True,
+                'photo': SimpleUploadedFile('upload.jpg', image.getvalue()),
+                'hash_md5': hashlib.md5(image.getvalue()).hexdigest(),
+                'comment': comment,
+            }
+            return self.client.post(reverse('photo-list'), data, format='multipart', HTTP_IDEMPOTENCY_KEY=key)
+
+        # a retry gets the response of the first attempt, only one photo is created
+        count = Photo.objects.count()
+        response = upload('upload-1')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        retry = upload('upload-1')
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data, response.data)
+        self.assertEqual(Photo.objects.count(), count + 1)
+        # kept in the database, where the other processes find it
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM {}'.format(settings.CACHES['idempotency']['LOCATION']))
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+        # same key, different request
+        response = upload('upload-1', comment='other')
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        # another key is another upload
+        response = upload('upload-2')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Photo.objects.count(), count + 2)
+
+        # keys are per user
+        photo = Photo.objects.get(pk=response.data['id'])
+        user1 = User.objects.get(username='user1')
+        UserAuthenticatedForEvent.objects.create(user=user1, event=event)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user1.auth_token.key)
+        url = reverse('like-photo')
+        response = self.client.post(url, {'photo_id': photo.pk, 'like': True}, format='json',
+                                    HTTP_IDEMPOTENCY_KEY='upload-1')
+        self.assertEqual(response.data['likes'], 1)
+
+        # a replayed like does not toggle again
+        Like.objects.filter(photo=photo).delete()
+        response = self.client.post(url, {'photo_id': photo.pk, 'like': True}, format='json',
+                                    HTTP_IDEMPOTENCY_KEY='upload-1')
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(Like.objects.filter(photo=photo).count(), 0)
+
+        # failed requests do not use up the key
+        response = self.client.post(url, {'photo_id': 999999, 'like': True}, format='json',
+                                    HTTP_IDEMPOTENCY_KEY='like-2')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(url, {'photo_id': photo.pk, 'like': True}, format='json',
+                                    HTTP_IDEMPOTENCY_KEY='like-2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.has_header('Idempotent-Replayed'))
+
+    @override_settings(UPLOAD_ADMISSION_RETRY_AFTER=7,
+                       UPLOAD_ADMISSION_GLOBAL_LIMIT=2, UPLOAD_ADMISSION_WORKERS=4, UPLOAD_ADMISSION_READ_RESERVE=0.5)
+    def test_upload_admission(self):
+        user3 = User.objects.get(username='user3')
+        event = Event.objects.get(name='My Amazing Wedding 3')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user3.auth_token.key)
+
+        uploads = []
+
+        def held(*admissions):
+            for admission in admissions:
+                self.assertTrue(admission.try_acquire())
+            return admissions
+
+        def upload(**extra):
+            image = BytesIO()
+            Image.new('RGB', (100, 100), (len(uploads), 0, 0)).save(image, 'JPEG')
+            uploads.append(image)
+            data = {
+                'event': event.id,
+                'visible': True,
+                'photo': SimpleUploadedFile('upload.jpg', image.getvalue()),
+                'hash_md5': hashlib.md5(image.getvalue()).hexdigest(),
+                'comment': 'abc',
+            }
+            return self.client.post(reverse('photo-list'), data, format='multipart', **extra)
+
+        # global limit: two uploads of other users are in progress
+        admissions = held(Admission(-1), Admission(-2))
+        # rejected at once, before the body is parsed (also with an Idempotency-Key)
+        load_data_and_files = Request._load_data_and_files
+
+        def unexpected_load_data_and_files(request):
+            raise AssertionError('request body parsed')
+
+        Request._load_data_and_files = unexpected_load_data_and_files
+        try:
+            response = upload(HTTP_IDEMPOTENCY_KEY='upload-1')
+        finally:
+            Request._load_data_and_files = load_data_and_files
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '7')
+        # reads are not affected
+        self.assertEqual(self.client.get(reverse('photo-list')).status_code, status.HTTP_200_OK)
+        for admission in admissions:
+            admission.release()
+        self.assertEqual(upload().status_code, status.HTTP_201_CREATED)
+
+        # per process limit: half of the 4 workers are reserved for reads
+        with override_settings(UPLOAD_ADMISSION_GLOBAL_LIMIT=10):
+            admissions = held(Admission(-1), Admission(-2))
+            self.assertEqual(upload().status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            for admission in admissions:
+                admission.release()
+
+        # per user and per event limits
+        with override_settings(UPLOAD_ADMISSION_USER_LIMITS={user3.pk: 1}), held(Admission(user3.pk))[0]:
+            self.assertEqual(upload().status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        with override_settings(UPLOAD_ADMISSION_EVENT_LIMITS={event.pk: 1}), held(Admission(-1, event.pk))[0]:
+            self.assertEqual(upload().status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        with held(Admission(-1, event.pk))[0]:
+            self.assertEqual(upload().status_code, status.HTTP_201_CREATED)
+
+        # the slots of rejected uploads are released
+        self.assertEqual(upload().status_code, status.HTTP_201_CREATED)
+
+    def test_event_stats(self):
+        user1 = User.objects.get(username='user1')
+        user3 = User.objects.get(username='user3')
+        event = Event.objects.get(name='My Amazing Wedding 1')
+        photo31 = Photo.objects.get(event=event)
+        image_path = photo31.photo.name
+        url = reverse('event-stats', args=[event.pk])
+
+        # only for users authorised for the event
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user1.auth_token.key)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        UserAuthenticatedForEvent.objects.create(user=user1, event=event)
+        photo11 = Photo.objects.create(owner=user1, event=event, photo=image_path, visible=True,
+                                       hash_md5='6f96ecc6e845a7a3838d83497133ba3d')
+        photo12 = Photo.objects.create(owner=user1, event=event, photo=image_path, visible=True,
+                                       hash_md5='6f96ecc6e845a7a3838d83497133ba3d')
+        Like.objects.create(owner=user1, photo=photo31)
+        Like.objects.create(owner=user3, photo=photo31)
+        Like.objects.create(owner=user3, photo=photo12)
+
+        # event, authorisation, counter row, two index scans and contributor names, regardless of the event size
+        with self.assertNumQueries(6):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['photos'], 3)
+        self.assertEqual(response.data['uploaders'], 2)
+        self.assertEqual(response.data['likes'], 3)
+        self.assertEqual(response.data['top_photos'], [{'photo': photo31.pk, 'likes': 2},
+                                                       {'photo': photo12.pk, 'likes': 1},
+                                                       {'photo': photo11.pk, 'likes': 0}])
+        self.assertEqual(response.data['top_contributors'],
+                         [{'user': user1.pk, 'name': 'user1', 'photos': 2, 'likes': 1},
+                          {'user': user3.pk, 'name': 'user3', 'photos': 1, 'likes': 2}])
+
+        # deleting photos counts their likes down, the last photo of a user makes them no uploader,
+        # also if the counts are written at once
+        with batched_counts():
+            photo12.delete()
+            photo11.delete()
+            self.assertEqual(EventStats.objects.get(event=event).photos, 3)
+        Like.objects.filter(owner=user1).delete()
+        response = self.client.get(url)
+        self.assertEqual((response.data['photos'], response.data['uploaders'], response.data['likes']), (1, 1, 1))
+        self.assertEqual(response.data['top_contributors'],
+                         [{'user': user3.pk, 'name': 'user3', 'photos': 1, 'likes': 1}])
+
+        # likes written behind
+        with override_settings(LIKE_WRITE_BEHIND=True, LIKE_WRITE_BEHIND_FLUSH_INTERVAL=0):
+            response = self.client.post(reverse('like-photo'), {'photo_id': photo31.pk, 'like': True}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            like_buffer.flush()
+        self.assertEqual(self.client.get(url).data['likes'], 2)
+
+        # verification and rebuild
+        out = StringIO()
+        call_command('event_stats', stdout=out)
+        self.assertEqual(out.getvalue().splitlines()[-1], '3 events, 0 inconsistent')
+
+        EventStats.objects.filter(event=event).update(likes=5)
+        PhotoStats.objects.filter(photo=photo31).delete()
+        out = StringIO()
+        call_command('event_stats', '--rebuild', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertIn('event {}: event {}: stored (1, 1, 5), counted (1, 1, 2)'.format(event.pk, event.pk), lines)
+        self.assertIn('event {}: photos {}: stored None, counted ({}, 2)'.format(event.pk, photo31.pk, user3.pk), lines)
+        self.assertEqual(lines[-1], '3 events, 1 inconsistent (rebuilt)')
+        response = self.client.get(url)
+        self.assertEqual(response.data['likes'], 2)
+        self.assertEqual(response.data['top_photos'], [{'photo': photo31.pk, 'likes': 2}])
+
+        # another process counts a first photo of the same user before its row is inserted
+        user2 = User.objects.get(username='user2')
+        create_counts = models._create_counts
+
+        def concurrent_count(model, *args):
+            if model is ContributorStats:
+                ContributorStats.objects.create(event=event, user=user2, photos=1)
+                models._create_counts = create_counts
+            return create_counts(model, *args)
+
+        models._create_counts = concurrent_count
+        self.addCleanup(setattr, models, '_create_counts', create_counts)
+        Photo.objects.create(owner=user2, event=event, photo=image_path, visible=True,
+                             hash_md5='6f96ecc6e845a7a3838d83497133ba3d')
+        self.assertEqual(ContributorStats.objects.get(event=event, user=user2).photos, 2)
+        self.assertEqual(EventStats.objects.get(event=event).uploaders, 2)
+
+    def test_photo_histogram(self):
+        user1 = User.objects.get(username='user1')
+        user3 = User.objects.get(username='user3')
+        event = Event.objects.get(name='My Amazing Wedding 3')
+        for _ in range(4):
+            self.upload_photo(user3, event)
+
+        # photos at 20:00, 20:05, 20:12, 20:31 and 20:33
+        start = datetime(2026, 6, 1, 20, 0, tzinfo=dt_timezone.utc)
+        photos = list(Photo.objects.filter(event=event).order_by('pk'))
+        for photo, minutes in zip(photos, [0, 5, 12, 31, 33]):
+            Photo.objects.filter(pk=photo.pk).update(photo_dt=start + timedelta(minutes=minutes))
+
+        url = reverse('photo-histogram')
+        data = {'event_id': event.id, 'bucket': 600, 'page_size': 2}
+        response = self.client.get(url, data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['sort_order'], 'created')
+        self.assertEqual([(bucket['start'], bucket['count'], bucket['page']) for bucket in response.data['buckets']],
+                         [(start, 2, 2), (start + timedelta(minutes=10), 1, 2), (start + timedelta(minutes=30), 2, 1)])
+
+        # the page of a bucket starts with its newest photo
+        page = self.client.get(reverse('photo-list'),
+                               {'event_id': event.id, 'sort_order': 'created', 'page_size': 2, 'page': 2})
+        self.assertEqual(page.data['results'][0]['id'], photos[2].pk)
+
+        # upload dates, filters
+        response = self.client.get(url, {'event_id': event.id, 'field': 'upload_dt', 'owner_id': user1.pk})
+        self.assertEqual(response.data['bucket'], settings.PHOTO_HISTOGRAM_BUCKET)
+        self.assertEqual(response.data['buckets'], [])
+        response = self.client.get(url, {'event_id': event.id, 'field': 'upload_dt'})
+        self.assertEqual(sum(bucket['count'] for bucket in response.data['buckets']), 5)
+
+        # invalid parameters, not authorised
+        for invalid in [{}, {'event_id': event.id, 'field': 'dt'}, {'event_id': event.id, 'bucket': 1}]:
+            self.assertEqual(self.client.get(url, invalid).status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user1.auth_token.key)
+        self.assertEqual(self.client.get(url, data).data['buckets'], [])
+
+    def test_photo_search(self):
+        user1 = User.objects.get(username='user1')
+        user3 = User.objects.get(username='user3')
+        event = Event.objects.get(name='My Amazing Wedding 3')
+        photo33 = Photo.objects.get(event=event)
+
+        def create_photo(comment):
+            return Photo.objects.create(owner=user3, event=event, photo=photo33.photo.name, visible=True,
+                                        hash_md5='6f96ecc6e845a7a3838d83497133ba3d', comment=comment)
+
+        first_dance = create_photo('The first dance')
+        dancing = create_photo('Dance, dance, dance!')
+        create_photo('Wedding cake')
+        # other events are not searched
+        photo_in_event1 = Photo.objects.create(owner=user3, event=Event.objects.get(name='My Amazing Wedding 1'),
+                                               photo=photo33.photo.name, hash_md5='!IGNORE!', comment='dance')
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user3.auth_token.key)
+        url = reverse('photo-list')
+
+        def search(query, **params):
+            response = self.client.get(url, dict(params, event_id=event.pk, search=query))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return [photo['id'] for photo in response.data['results']]
+
+        # ranked, words are prefixes
+        self.assertEqual(search('dance'), [dancing.pk, first_dance.pk])
+        self.assertEqual(search('DANC'), [dancing.pk, first_dance.pk])
+        self.assertEqual(search('first danc'), [first_dance.pk])
+        self.assertEqual(search('"first" OR'), [])
+        self.assertEqual(search('!!'), [])
+        self.assertEqual(search('dance', page_size=1), [dancing.pk])
+        self.assertEqual(search('dance', sort_order='uploaded'), [dancing.pk, first_dance.pk])
+
+        # owner names, also after a rename
+        self.assertEqual(len(search('user3')), 4)
+        user3.first_name = 'Zoë'
+        user3.save()
+        self.assertEqual(len(search('zoe')), 4)
+        self.assertEqual(search('user3'), [])
+
+        # comment changes and deletion
+        first_dance.comment = 'speeches'
+        first_dance.save()
+        self.assertEqual(search('dance'), [dancing.pk])
+        dancing.delete()
+        self.assertEqual(search('dance'), [])
+
+        # rebuild
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM eventphotos_photosearch')
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'indexed {} photos'.format(Photo.objects.count()))
+        self.assertEqual(search('speeches'), [first_dance.pk])
+        self.assertEqual(search('dance', event_id=photo_in_event1.event_id), [])
+
+        # event authorisation
+        response = self.client.get(url, {'search': 'dance'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user1.auth_token.key)
+        self.assertEqual(search('speeches'), [])
+
+        # other databases than SQLite have no index
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user3.auth_token.key)
+        connection.vendor = 'postgresql'
+        try:
+            create_photo('first kiss')
+            response = self.client.get(url, {'event_id': event.pk, 'search': 'kiss'})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        finally:
+            del connection.vendor
+        self.assertEqual(search('kiss'), [])
+
+    def test_near_duplicates(self):
+        cache.clear()
+
+        user3 = User.objects.get(username='user3')
+        event = Event.objects.get(name='My Amazing Wedding 3')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user3.auth_token.key)
+
+        def picture(seed):
+            # coarse random pattern, like the structure of a photo
+            pattern = np.random.RandomState(seed).randint(0, 256, (6, 8, 3)).astype(np.uint8)
+            return Image.fromarray(pattern).resize((400, 300), Image.BILINEAR)
+
+        def upload(image, quality=95):
+            content = BytesIO()
+            image.save(content, 'JPEG', quality=quality)
+            data = {
+                'event': event.id,
+                'visible': True,
+                'photo': SimpleUploadedFile('upload.jpg', content.getvalue()),
+                'hash_md5': hashlib.md5(content.getvalue()).hexdigest(),
+                'comment': 'abc',
+            }
+            response = self.client.post(reverse('photo-list'), data, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            return response.data
+
+        original = upload(picture(1))
+        self.assertIsNone(original['duplicate_of'])
+        # re-encoded and scaled down by a messenger: different md5, same perceptual hash (nearly)
+        resent = upload(picture(1).resize((200, 150)), quality=40)
+        self.assertEqual(resent['duplicate_of'], original['id'])
+        # duplicates of duplicates refer to the original
+        self.assertEqual(upload(picture(1).resize((300, 225)), quality=60)['duplicate_of'], original['id'])
+        other = upload(picture(2))
+        self.assertIsNone(other['duplicate_of'])
+
+        url = reverse('photo-list')
+        response = self.client.get(url, {'event_id': event.id, 'collapse_duplicates': 'true', 'page_size': 100})
+        ids = [photo['id'] for photo in response.data['results']]
+        self.assertIn(original['id'], ids)
+        self.assertIn(other['id'], ids)
+        self.assertNotIn(resent['id'], ids)
+        response = self.client.get(url, {'event_id': event.id, 'page_size': 100})
+        self.assertIn(resent['id'], [photo['id'] for photo in response.data['results']])
+
+        # deleting the original makes the index forget it
+        Photo.objects.get(pk=original['id']).delete()
+        self.assertIsNone(Photo.objects.get(pk=resent['id']).duplicate_of_id)
+        self.assertEqual(upload(picture(1), quality=50)['duplicate_of'], resent['id'])
+
+        # loading the photos of an event into its index does not block the other events
+        other_event = Event.objects.get(name='My Amazing Wedding 1')
+        with perceptualhash.event_index(event.pk, settings.PHOTO_DUPLICATE_DISTANCE).lock:
+            perceptualhash.event_index(other_event.pk, settings.PHOTO_DUPLICATE_DISTANCE)
+
+        # the indexes of the least recently used events are dropped
+        with override_settings(PHOTO_DUPLICATE_INDEX_EVENTS=1):
+            perceptualhash.event_index(other_event.pk, settings.PHOTO_DUPLICATE_DISTANCE)
+            self.assertEqual(list(perceptualhash._indexes), [other_event.pk])
+        self.assertEqual(upload(picture(1), quality=60)['duplicate_of'], resent['id'])
+
+    def test_best_photos(self):
+        user1 = User.objects.get(username='user1')
+        user3 = User.objects.get(username='user3')
+        admin1 = User.objects.get(username='admin1')
+        event = Event.objects.get(name='My Amazing Wedding 1')
+        UserAuthenticatedForEvent.objects.create(user=user1, event=event)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + user1.auth_token.key)
+        image_path = Photo.objects.get(event=event).photo.name
+        Photo.objects.filter(event=event).delete()
+        now = timezone.now()
+        half_life = settings.BEST_PHOTOS_HALF_LIFE
+
+        def photo(owner, half_lives, visible=True):
+            created = Photo.objects.create(owner=owner, event=event, photo=image_path, visible=visible,
+                                           hash_md5='6f96ecc6e845a7a3838d83497133ba3d')
+            # the same image would be a near-duplicate
+            Photo.objects.filter(pk=created.pk).update(upload_dt=now - timedelta(seconds=half_lives * half_life),
+                                                       duplicate_of=None)
+            return created
+
+        def best():
+            response = self.client.get(reverse('photo-list'), {'event_id': event.pk, 'sort_order': 'best'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return [p['id'] for p in response.data['results']]
+
+        a = photo(user1, 0)
+        b = photo(user1, 0.5)
+        c = photo(user3, 1)
+        hidden = photo(user3, 0, visible=False)
+        duplicate = photo(user3, 0)
+        Photo.objects.filter(pk=duplicate.pk).update(duplicate_of=a)
+        out = StringIO()
+        call_command('rank_best_photos', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'ranked 3 events')
+        # the second photo of user1 loses a half-life against the photo of user3
+        self.assertEqual(best(), [a.pk, c.pk, b.pk])
+
+        # likes move photos up incrementally: 3 likes are worth two half-lives
+        for owner in (user1, user3, admin1):
+            Like.objects.create(owner=owner, photo=c)
+        self.assertEqual(best(), [c.pk, a.pk, b.pk])
+
+        # photos which become visible enter the ranking (saving makes it a new upload)
+        hidden.refresh_from_db()
+        hidden.visible = True
+        hidden.save()
+        self.assertEqual(best(), [c.pk, a.pk, hidden.pk, b.pk])
+
+        # only the best BEST_PHOTOS_COUNT
+        with override_settings(BEST_PHOTOS_COUNT=2):
+            call_command('rank_best_photos', '--event', event.pk, stdout=StringIO())
+            self.assertEqual(best(), [c.pk, a.pk])
+            # recomputed when a ranked photo scores worse (unliked in a request or not):
+            # the newest upload, no longer behind c of user3, takes its place
+            self.client.credentials(HTTP_AUTHORIZATION='Token ' + user3.auth_token.key)
+            response = self.client.post(reverse('like-photos'), {'likes': [{'photo_id': c.pk, 'like': False}]},
+                                        format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.client.credentials(HTTP_AUTHORIZATION='Token ' + user1.auth_token.key)
+            Like.objects.filter(photo=c).delete()
+            self.assertEqual(best(), [hidden.pk, a.pk])
+            # refilled when a ranked photo is deleted
+            a.delete()
+            self.assertEqual(best(), [hidden.pk, b.pk])
+
+        # rankings are per event
+        response = self.client.get(reverse('photo-list'), {'sort_order': 'best'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RendererBenchmark(APITestCase):
+    """
+    Compares render time and payload size of JSON and MessagePack on a 1000 photo page.
+    """
+    page_size = 1000
+
+    def setUp(self):
+        image_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'media/test_heart.jpg')
+
+        self.user = User.objects.create_user('user1', '', 'abc123abc', first_name='user1')
+        event = Event.objects.create(name='My Amazing Wedding 1',
+                                     start_dt=timezone.now(),
+                                     end_dt=timezone.now(),
+                                     challenge='challenge',
+                                     icon=image_path)
+        UserAuthenticatedForEvent.objects.create(user=self.user, event=event)
+
+        # bulk_create does not call Photo.save, hence no image processing
+        now = timezone.now()
+        Photo.objects.bulk_create(Photo(owner=self.user, event=event, upload_dt=now, photo_dt=now, visible=True,
+                                        photo='photos/test_heart.jpg', hash_md5='6f96ecc6e845a7a3838d83497133ba3d',
+                                        thumbnail='thumbnail/test_heart_thumbnail.jpg',
+                                        web_photo='web_photo/test_heart_web.jpg', comment='abc')
+                                  for _ in range(self.page_size))
+
+    def render(self, renderer_class):
+        request = APIRequestFactory().get('/api/photos/')
+        request.user = self.user
+        request.accepted_renderer = renderer_class()
+        data = PhotoSerializer(Photo.objects.all(), many=True, context={'request': request}).data
+
+        start = time.perf_counter()
+        content = renderer_class().render(data)
+        return content, time.perf_counter() - start
+
+    def test_msgpack_vs_json(self):
+        json_content, json_time = self.render(JSONRenderer)
+        msgpack_content, msgpack_time = self.render(MessagePackRenderer)
+
+        print("render {} photos: json {} bytes in {:.2f}ms, msgpack {} bytes in {:.2f}ms".format(
+            self.page_size, len(json_content), json_time * 1000, len(msgpack_content), msgpack_time * 1000))
+
+        self.assertEqual(len(json.loads(json_content.decode('utf8'))), self.page_size)
+        self.assertEqual(len(msgpack.unpackb(msgpack_content, raw=False)), self.page_size)
+        self.assertLess(len(msgpack_content), len(json_content))
+
+
+class PerceptualHashBenchmark(SimpleTestCase):
+    """
+    Builds the multi-index hash of 100k perceptual hashes and compares near-duplicate queries with a linear scan.
+    """
+    size = 100000
+    max_distance = 6
+
+    def test_multi_index_hash(self):
+        random = np.random.RandomState(0)
+        hashes = [int(value) for value in random.randint(0, 1 << 63, self.size, dtype=np.int64) * 2 + 1]
+        # some near-duplicates: a few flipped bits
+        for i in range(0, self.size, 1000):
+            hashes[i + 1] = hashes[i] ^ (1 << int(random.randint(64))) ^ (1 << int(random.randint(64)))
+
+        start = time.perf_counter()
+        index = MultiIndexHash(self.max_distance)
+        for pk, value in enumerate(hashes):
+            index.add(value, pk)
+        build_time = time.perf_counter() - start
+
+        queries = hashes[:10000:1000]
+        start = time.perf_counter()
+        matches = [index.query(value) for value in queries]
+        query_time = (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        expected = [sorted((pk, hamming(value, other)) for pk, other in enumerate(hashes)
+                           if hamming(value, other) <= self.max_distance) for value in queries[:3]]
+        scan_time = (time.perf_counter() - start) / 3
+
+        print("multi-index hash of {} hashes: built in {:.0f}ms, query {:.2f}ms, linear scan {:.2f}ms".format(
+            self.size, build_time * 1000, query_time * 1000, scan_time * 1000))
+
+        self.assertEqual(index.size, self.size)
+        self.assertEqual([sorted(m, key=lambda match: match[0]) for m in matches[:3]], expected)
+        self.assertTrue(all({match[0] for match in m} >= {i * 1000, i * 1000 + 1} for i, m in enumerate(matches)))
+        self.assertLess(query_time, scan_time)
+
+
+class QueryPlanTest(APITestCase):
+    """
+    Runs EXPLAIN QUERY PLAN on the query shapes of the photo feed and fails on full table scans.
+    """
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin1', '', 'abc123abc', first_name='admin1')
+        self.user = User.objects.create_user('user1', '', 'abc123abc', first_name='user1')
+        self.event = Event.objects.create(name='My Amazing Wedding 1',
+                                          start_dt=timezone.now(),
+                                          end_dt=timezone.now(),
+                                          challenge='challenge')
+        UserAuthenticatedForEvent.objects.create(user=self.user, event=self.event)
+        UserAuthenticatedForEvent.objects.create(user=self.admin, event=self.event)
+
+    def get_queryset(self, viewset_class, user, query):
+        viewset = viewset_class()
+        viewset.request = Request(APIRequestFactory().get('/api/?' + query))
+        viewset.request.user = user
+        viewset.format_kwarg = None
+        return viewset.get_queryset()
+
+    def assertNoFullTableScan(self, queryset, name):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+
+        for step in plan:
+            if step.startswith('SCAN') and 'USING' not in step and 'CONSTANT ROW' not in step:
+                self.fail('full table scan for {}: {}\n{}'.format(name, step, '\n'.join(plan)))
+
+    def test_photo_feed(self):
+        event_query = 'event_id={}'.format(self.event.pk)
+        owner_query = 'owner_id={}'.format(self.user.pk)
+        for user in [self.user, self.admin]:
+            for query in ['', event_query, owner_query, event_query + '&' + owner_query]:
+                for only_visible in ['', '&only_visible=true']:
+                    for sort_order in ['', '&sort_order=uploaded', '&sort_order=created', '&sort_order=likes',
+                                       '&sort_order=best']:
+                        shape = query + only_visible + sort_order
+                        if user == self.admin and not query and sort_order == '&sort_order=likes':
+                            # ranking all photos of all events has to look at all photos
+                            continue
+                        if 'event_id' not in query and sort_order == '&sort_order=best':
+                            # rankings are per event
+                            continue
+                        queryset = self.get_queryset(PhotoViewSet, user, shape)
+                        self.assertNoFullTableScan(queryset[:20], '{}: {}'.format(user.username, shape))
+
+    def test_photo_likes(self):
+        photo = Photo(owner=self.user, event=self.event)
+        photo.pk = 1
+
+        self.assertNoFullTableScan(photo.like_set.all(), 'like count')
+        self.assertNoFullTableScan(Like.objects.filter(photo=photo, owner=self.user), 'liked by current user')
+        self.assertNoFullTableScan(UserAuthenticatedForEvent.objects.filter(user=self.user, event=self.event),
+                                   'event authorisation')
+        self.assertNoFullTableScan(Photo.objects.filter(pk__in=[1, 2], event__authenticated_users__user=self.user),
+                                   'bulk event authorisation')
+        self.assertNoFullTableScan(Like.objects.filter(owner=self.user, photo__pk__in=[1, 2]), 'likes of user')
+        self.assertNoFullTableScan(Photo.objects.filter(Q(photo='a') | Q(thumbnail='a') | Q(web_photo='a')),
+                                   'media file')
+
+    def test_photo_histogram(self):
+        event_query = 'event_id={}'.format(self.event.pk)
+        for only_visible in ['', '&only_visible=true']:
+            for field in timeline.FEED_SORT_ORDERS:
+                queryset = self.get_queryset(PhotoViewSet, self.user, event_query + only_visible)
+                rows = queryset.order_by().annotate(bucket=timeline.EpochBucket(field, 600)) \
+                    .values_list('bucket').annotate(Count('pk'))
+                self.assertNoFullTableScan(rows, 'histogram of {}{}'.format(field, only_visible))
+
+    def test_like_feed(self):
+        event_query = 'event_id={}'.format(self.event.pk)
+        for user in [self.user, self.admin]:
+            for query in ['', event_query]:
+                for only_visible in ['', '&only_visible=true']:
+                    shape = query + only_visible
+                    queryset = self.get_queryset(LikeViewSet, user, shape)
+                    self.assertNoFullTableScan(queryset[:20], '{}: {}'.format(user.username, shape))
+
+    def test_create_indexes(self):
+        # a database created before the feed indexes and the unique authorisations
+        authorisation_table = UserAuthenticatedForEvent._meta.db_table
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, authorisation_table)
+            unique = [name for name, constraint in constraints.items()
+                      if constraint['unique'] and constraint['columns'] == ['user_id', 'event_id']]
+            cursor.execute('DROP INDEX {}'.format(unique[0]))
+            cursor.execute('DROP INDEX {}'.format(Photo._meta.indexes[0].name))
+        UserAuthenticatedForEvent.objects.create(user=self.user, event=self.event)
+
+        out = StringIO()
+        call_command('create_indexes', '--dry-run', stdout=out)
+        self.assertIn('would create 2 indexes, 0 duplicates removed', out.getvalue())
+        self.assertEqual(UserAuthenticatedForEvent.objects.filter(user=self.user).count(), 2)
+
+        out = StringIO()
+        call_command('create_indexes', stdout=out)
+        self.assertIn('created 2 indexes, 1 duplicates removed', out.getvalue())
+        self.assertEqual(UserAuthenticatedForEvent.objects.filter(user=self.user).count(), 1)
+        self.test_photo_feed()
+
+        out = StringIO()
+        call_command('create_indexes', stdout=out)
+        self.assertIn('created 0 indexes, 0 duplicates removed', out.getvalue())
+
+
+class SQLiteTest(TransactionTestCase):
+    def test_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 5000)
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+    @override_settings(SQLITE_WRITE_QUEUE=True)
+    def test_write_queue(self):
+        users = [User.objects.create_user('user{}'.format(i), '', 'abc123abc') for i in range(8)]
+        event = Event.objects.create(name='My Amazing Wedding 1',
+                                     start_dt=timezone.now(),
+                                     end_dt=timezone.now(),
+                                     challenge='challenge')
+        now = timezone.now()
+        Photo.objects.bulk_create(Photo(owner=users[0], event=event, upload_dt=now, photo_dt=now,
+                                        photo='photos/test_heart.jpg', hash_md5='') for _ in range(4))
+        photos = list(Photo.objects.all())
+
+        def like_all(user):
+            try:
+                for photo in photos:
+                    Like.set_like(user, photo, True, False)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=like_all, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(Like.objects.count(), len(users) * len(photos))
+
+        # exceptions are raised in the submitting thread, the failing job is rolled back
+        def fail():
+            Like.objects.all().delete()
+            raise ValueError('fail')
+
+        with self.assertRaises(ValueError):
+            write_queue.submit(fail)
+        self.assertEqual(Like.objects.count(), len(users) * len(photos))
+
+    @override_settings(SQLITE_WRITE_QUEUE=True, EVENT_SHARDING=True)
+    def test_write_queue_event_database(self):
+        shard_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shard_root)
+        event = Event.objects.create(name='My Amazing Wedding 1',
+                                     start_dt=timezone.now(),
+                                     end_dt=timezone.now(),
+                                     challenge='challenge')
+        with override_settings(EVENT_SHARD_ROOT=shard_root):
+            alias = sharding.event_database(event.pk)
+            self.addCleanup(sharding.close_event_database, alias)
+
+            # jobs on an event database run in the writer thread
+            self.assertIs(write_queue.submit(threading.current_thread, using=alias), write_queue.thread)
+
+            # unless the caller has a transaction open on it, which the writer could not see
+            with transaction.atomic(using=alias):
+                self.assertIs(write_queue.submit(threading.current_thread, using=alias), threading.current_thread())
+
+
+@override_settings(ASGI_READ_THREADS=2, ASGI_WRITE_THREADS=1)
+class ASGITest(APITransactionTestCase):
+    def setUp(self):
+        slot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, slot_dir)
+        slot_settings = override_settings(UPLOAD_ADMISSION_LOCK_DIR=slot_dir)
+        slot_settings.enable()
+        self.addCleanup(slot_settings.disable)
+
+        self.image_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                       'media/test_heart.jpg')
+        self.user = User.objects.create_user('user1', '', 'abc123abc', first_name='user1')
+        self.event = Event.objects.create(name='My Amazing Wedding 1',
+                                          start_dt=timezone.now(),
+                                          end_dt=timezone.now(),
+                                          challenge='challenge',
+                                          icon=self.image_path)
+        UserAuthenticatedForEvent.objects.create(user=self.user, event=self.event)
+
+        self.handler = ASGIHandler()
+        self.addCleanup(self.handler.shutdown)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    async def request(self, method, path, query_string=b'', body=b'', content_type=None, chunks=1,
+                      receive_delay=0, receiving=None):
+        """
+        Sends the request through the handler like a client which sends the body in chunks
+        and takes receive_delay seconds to receive the response body, returns the status and the body.
+        """
+        headers = [(b'host', b'testserver'),
+                   (b'authorization', 'Token {}'.format(self.user.auth_token.key).encode())]
+        if content_type:
+            headers.append((b'content-type', content_type.encode()))
+        scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'path': path,
+                 'query_string': query_string, 'headers': headers, 'server': ('testserver', 80)}
+
+        size = len(body) // chunks + 1
+        messages = [{'type': 'http.request', 'body': body[i:i + size], 'more_body': i + size < len(body)}
+                    for i in range(0, max(len(body), 1), size)]
+        response = {'body': b''}
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                return
+            if receiving is not None:
+                receiving.append(1)
+                receiving[0] = max(receiving[0], len(receiving) - 1)
+            await asyncio.sleep(receive_delay)
+            if receiving is not None:
+                receiving.pop()
+            response['body'] += message.get('body', b'')
+
+        await self.handler(scope, receive, send)
+        return response['status'], response['body']
+
+    def test_slow_clients(self):
+        # clients which receive their responses slowly only hold a connection, not a thread:
+        # the connections of a process are no longer limited by its threads
+        clients = 20 * settings.ASGI_READ_THREADS
+        receiving = [0]
+        requests = [self.request('GET', reverse('events-metadata'), receive_delay=0.5, receiving=receiving)
+                    for _ in range(clients)]
+        responses = self.loop.run_until_complete(asyncio.gather(*requests, loop=self.loop))
+
+        self.assertEqual({status_code for status_code, _ in responses}, {status.HTTP_200_OK})
+        self.assertEqual(json.loads(responses[0][1].decode())[0]['id'], self.event.pk)
+        self.assertGreaterEqual(receiving[0], 10 * settings.ASGI_READ_THREADS)
+
+    def test_upload_and_feed(self):
+        with open(self.image_path, 'rb') as f:
+            image = f.read()
+        body = encode_multipart(BOUNDARY, {
+            'event': self.event.pk,
+            'visible': True,
+            'photo': SimpleUploadedFile('upload.jpg', image),
+            'hash_md5': hashlib.md5(image).hexdigest(),
+            'comment': 'abc',
+        })
+
+        # the (sync) upload path, the body sent in chunks by a slow client
+        status_code, content = self.loop.run_until_complete(
+            self.request('POST', reverse('photo-list'), body=body, content_type=MULTIPART_CONTENT, chunks=5))
+        self.assertEqual(status_code, status.HTTP_201_CREATED, content)
+        photo_id = json.loads(content.decode())['id']
+
+        status_code, content = self.loop.run_until_complete(
+            self.request('GET', reverse('photo-list'), query_string='event_id={}'.format(self.event.pk).encode()))
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual([photo['id'] for photo in json.loads(content.decode())['results']], [photo_id])
+
+        status_code, content = self.loop.run_until_complete(
+            self.request('GET', reverse('photo-detail', args=[photo_id])))
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(content.decode())['comment'], 'abc')
+
+        # the feed runs in the read pool, the upload in the write pool
+        self.assertIs(self.handler.pool({'method': 'GET', 'path': reverse('photo-list')}), self.handler.read_pool)
+        self.assertIs(self.handler.pool({'method': 'POST', 'path': reverse('photo-list')}), self.handler.write_pool)
+        self.assertIs(self.handler.pool({'method': 'GET', 'path': reverse('like-list')}), self.handler.write_pool)
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'])
+class ReplicaRouterTest(APITestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.user = User.objects.create_user('user1', '', 'abc123abc', first_name='user1')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user.auth_token.key)
+        self.reads = []
+
+        # record where the router sends reads during the request, but read from the test database
+        db_for_read = ReplicaRouter.db_for_read
+
+        def record_db_for_read(router, model, **hints):
+            self.reads.append(db_for_read(router, model, **hints))
+            return 'default'
+
+        ReplicaRouter.db_for_read = record_db_for_read
+        self.addCleanup(setattr, ReplicaRouter, 'db_for_read', db_for_read)
+
+    def test_outside_request(self):
+        self.assertEqual(self.router.db_for_read(Photo), 'default')
+        self.assertEqual(self.router.db_for_write(Photo), 'default')
+
+    def test_replica_views(self):
+        self.client.get(reverse('photo-list'), format='json')
+
+        self.assertTrue(self.reads)
+        self.assertTrue(all(db in ['replica1', 'replica2'] for db in self.reads))
+
+    def test_one_replica_per_request(self):
+        for _ in range(10):
+            self.reads = []
+            self.client.get(reverse('photo-list'), format='json')
+            self.assertEqual(len(set(self.reads)), 1)
+
+    def test_other_views(self):
+        self.client.get(reverse('single-event-metadata', kwargs={'event_id': 1}), format='json')
+
+        self.assertTrue(self.reads)
+        self.assertTrue(all(db == 'default' for db in self.reads))
+
+    def test_read_after_write(self):
+        # a write pins the client to the primary
+        event = Event.objects.create(name='My Amazing Wedding 1',
+                                     start_dt=timezone.now(),
+                                     end_dt=timezone.now(),
+                                     challenge='challenge')
+        challenge_for_user = '{token}${challenge}'.format(token=self.user.auth_token.key, challenge='challenge')
+        hashed_challenge = hashlib.md5(challenge_for_user.encode('utf8')).hexdigest()
+        url = reverse('auth-user-for-event', kwargs={'event_id': event.id})
+        response = self.client.post(url, {'hashed_challenge': hashed_challenge}, format='json')
+        self.assertIn(settings.DATABASE_REPLICA_PIN_COOKIE, response.cookies)
+
+        self.reads = []
+        self.client.get(reverse('photo-list'), format='json')
+
+        self.assertTrue(self.reads)
+        self.assertTrue(all(db == 'default' for db in self.reads))
+
+
+class EventDatabaseTest(TransactionTestCase):
+    def test_concurrent_first_use(self):
+        shard_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shard_root)
+        event = Event.objects.create(name='My Amazing Wedding 1',
+                                     start_dt=timezone.now(),
+                                     end_dt=timezone.now(),
+                                     challenge='challenge')
+
+        # slow table creation, so that all threads ask for the new database meanwhile
+        created = []
+        create_tables = sharding._create_tables
+
+        def slow_create_tables(alias, event_id):
+            created.append(alias)
+            time.sleep(0.1)
+            create_tables(alias, event_id)
+
+        sharding._create_tables = slow_create_tables
+        self.addCleanup(setattr, sharding, '_create_tables', create_tables)
+
+        barrier = threading.Barrier(8)
+        results = []
+
+        def first_use():
+            try:
+                barrier.wait()
+                alias = sharding.event_database(event.pk)
+                results.append((alias, Photo.objects.using(alias).count()))
+            finally:
+                connection.close()
+
+        with override_settings(EVENT_SHARDING=True, EVENT_SHARD_ROOT=shard_root):
+            threads = [threading.Thread(target=first_use) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            sharding.close_event_database(sharding.event_database(event.pk))
+
+        self.assertEqual(created, ['event_{}'.format(event.pk)])
+        self.assertEqual(results, [('event_{}'.format(event.pk), 0)] * 8)
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'], SQLITE_WRITE_QUEUE=True)
+class ReplicaPinningTest(APITransactionTestCase):
+    """
+    Pinning with the write queue, whose writes run in the writer thread (outside TestCase's atomic block).
+    """
+
+    def setUp(self):
+        image_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'media/test_heart.jpg')
+        self.user = User.objects.create_user('user1', '', 'abc123abc', first_name='user1')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user.auth_token.key)
+        event = Event.objects.create(name='My Amazing Wedding 1',
+                                     start_dt=timezone.now(),
+                                     end_dt=timezone.now(),
+                                     challenge='challenge',
+                                     icon=image_path)
+        UserAuthenticatedForEvent.objects.create(user=self.user, event=event)
+        self.photo = Photo.objects.create(owner=self.user, event=event, photo=image_path, visible=True,
+                                          hash_md5='6f96ecc6e845a7a3838d83497133ba3d', comment='abc')
+
+    def test_like_pins_client(self):
+        # record the threads the like is written in
+        threads = []
+        submit = write_queue.submit
+
+        def record_submit(fn, **kwargs):
+            return submit(lambda: threads.append(threading.current_thread()) or fn(), **kwargs)
+
+        write_queue.submit = record_submit
+        self.addCleanup(setattr, write_queue, 'submit', submit)
+
+        response = self.client.post(reverse('like-photo'), {'photo_id': self.photo.pk, 'like': True}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(threads, [write_queue.thread])
+        self.assertIn(settings.DATABASE_REPLICA_PIN_COOKIE, response.cookies)
+
+    def test_failed_write_does_not_pin(self):
+        response = self.client.post(reverse('like-photo'), {'photo_id': 0, 'like': True}, format='json')
+        self.assertGreaterEqual(response.status_code, 400)
+        self.assertNotIn(settings.DATABASE_REPLICA_PIN_COOKIE, response.cookies)
+
+
+class ShardingTest(APITestCase):
+    def setUp(self):
+        image_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'media/test_heart.jpg')
+
+        # one database per event in a temporary directory
+        shard_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shard_root)
+        sharding_settings = override_settings(EVENT_SHARDING=True, EVENT_SHARD_ROOT=shard_root)
+        sharding_settings.enable()
+        self.addCleanup(sharding_settings.disable)
+        self.addCleanup(self.close_event_databases)
+
+        self.admin = User.objects.create_superuser('admin1', '', 'abc123abc', first_name='admin1')
+        self.user1 = User.objects.create_user('user1', '', 'abc123abc', first_name='user1')
+        self.user3 = User.objects.create_user('user3', '', 'abc123abc', first_name='user3')
+
+        self.event1, self.event2 = [Event.objects.create(name='My Amazing Wedding {}'.format(i),
+                                                         start_dt=timezone.now(),
+                                                         end_dt=timezone.now(),
+                                                         challenge='challenge',
+                                                         icon=image_path) for i in [1, 2]]
+
+        UserAuthenticatedForEvent.objects.create(user=self.user1, event=self.event1)
+        UserAuthenticatedForEvent.objects.create(user=self.user3, event=self.event1)
+        UserAuthenticatedForEvent.objects.create(user=self.user3, event=self.event2)
+
+        self.photo1, self.photo2a, self.photo2b = [Photo.objects.create(
+            owner=self.user3,
+            event=event,
+            photo=image_path,
+            visible=True,
+            hash_md5='6f96ecc6e845a7a3838d83497133ba3d',
+            comment='abc',
+        ) for event in [self.event1, self.event2, self.event2]]
+
+    @staticmethod
+    def close_event_databases():
+        for alias in list(connections.databases):
+            if alias.startswith('event_'):
+                sharding.close_event_database(alias)
+
+    def test_placement(self):
+        # nothing is stored in the catalogue
+        self.assertEqual(Photo.objects.using('default').count(), 0)
+        self.assertEqual(UserAuthenticatedForEvent.objects.using('default').count(), 0)
+
+        # photo ids encode the event
+        self.assertEqual(self.photo1._state.db, 'event_{}'.format(self.event1.pk))
+        self.assertEqual(sharding.event_id_for_pk(self.photo1.pk), self.event1.pk)
+        self.assertEqual(sharding.event_id_for_pk(self.photo2b.pk), self.event2.pk)
+        self.assertNotEqual(self.photo1.pk, self.photo2a.pk)
+
+        # relations work across databases
+        self.assertEqual(self.photo2a.event, self.event2)
+        self.assertEqual(self.photo2a.owner, self.user3)
+        self.assertEqual(self.event2.photos.count(), 2)
+
+    def test_list_photos(self):
+        url = reverse('photo-list')
+
+        # fan out over the events of the user
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user1.auth_token.key)
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.data['count'], 1)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user3.auth_token.key)
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual([p['id'] for p in response.data['results']],
+                         [self.photo2b.pk, self.photo2a.pk, self.photo1.pk])
+
+        response = self.client.get(url + '?event_id={}'.format(self.event2.pk), format='json')
+        self.assertEqual(response.data['count'], 2)
+
+        # detail of a photo of another event
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user1.auth_token.key)
+        response = self.client.get(reverse('photo-detail', kwargs={'pk': self.photo2a.pk}), format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(reverse('photo-detail', kwargs={'pk': self.photo1.pk}), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_upload_photo(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user1.auth_token.key)
+
+        image = Image.new('RGB', (100, 100))
+        tmp_file = tempfile.NamedTemporaryFile(suffix='.jpg')
+        image.save(tmp_file)
+        tmp_file.seek(0)
+
+        url = reverse('photo-list')
+        photo_data = {
+            'event': self.event1.id,
+            'visible': True,
+            'photo': tmp_file,
+            'hash_md5': '78ef68043f5aed0de916c936e3d8fb2f',
+            'comment': 'abc',
+        }
+        response = self.client.post(url, photo_data, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(sharding.event_id_for_pk(response.data['id']), self.event1.pk)
+        self.assertEqual(self.event1.photos.count(), 2)
+
+    def test_like_photos(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user1.auth_token.key)
+
+        url = reverse('like-photo')
+        response = self.client.post(url, {'photo_id': self.photo1.id, 'like': True}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['likes'], 1)
+        self.assertEqual(response.data['liked_by_current_user'], True)
+
+        response = self.client.post(url, {'photo_id': self.photo2a.id, 'like': True}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # bulk likes across events
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user3.auth_token.key)
+        url = reverse('like-photos')
+        data = {'likes': [
+            {'photo_id': self.photo1.id, 'like': True},
+            {'photo_id': self.photo2a.id, 'like': True},
+        ]}
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({r['photo_id']: r['likes'] for r in response.data}, {self.photo1.id: 2, self.photo2a.id: 1})
+
+        # super user fan out sorted by likes
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.admin.auth_token.key)
+        response = self.client.get(reverse('photo-list') + '?sort_order=likes', format='json')
+        self.assertEqual([p['likes'] for p in response.data['results']], [2, 1, 0])
+
+        response = self.client.get(reverse('like-list'), format='json')
+        self.assertEqual(response.data['count'], 3)
+
+    def test_delete_event(self):
+        path = connections.databases[sharding.event_database(self.event2.pk)]['NAME']
+        self.assertTrue(os.path.exists(path))
+
+        self.event2.delete()
+        self.assertFalse(os.path.exists(path))
+
+    def test_search(self):
+        # the index table is created along with the event databases
+        alias = sharding.event_database(self.event2.pk)
+        self.assertIn('eventphotos_photosearch', connections[alias].introspection.table_names())
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user3.auth_token.key)
+
+        def search(query):
+            response = self.client.get(reverse('photo-list'), {'event_id': self.event2.pk, 'search': query})
+            return {photo['id'] for photo in response.data['results']}
+
+        self.assertEqual(search('abc'), {self.photo2a.pk, self.photo2b.pk})
+
+        # saving users touches the event databases only for renames
+        user3 = User.objects.get(pk=self.user3.pk)
+        user3.last_login = timezone.now()
+        with self.assertNumQueries(0, using=alias):
+            user3.save()
+        user3.first_name = 'Zoë'
+        with self.assertNumQueries(1, using=alias):
+            user3.save()
+        self.assertEqual(search('zoe'), {self.photo2a.pk, self.photo2b.pk})
+
+
+class LocalS3Client(object):
+    """
+    In-memory stand-in for the boto3 S3 client methods used by S3Storage.
+    """
+
+    class NotFound(Exception):
+        response = {'Error': {'Code': 'NoSuchKey'}}
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.objects[(Bucket, Key)] = bytes(Body)
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.NotFound()
+        return {'Body': BytesIO(self.objects[(Bucket, Key)])}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.NotFound()
+        return {'ContentLength': len(self.objects[(Bucket, Key)]), 'LastModified': timezone.now()}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter):
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        prefixes = sorted({Prefix + key[len(Prefix):].split(Delimiter)[0] + Delimiter
+                           for key in keys if Delimiter in key[len(Prefix):]})
+        return {'CommonPrefixes': [{'Prefix': prefix} for prefix in prefixes],
+                'Contents': [{'Key': key} for key in keys if Delimiter not in key[len(Prefix):]]}
+
+    def generate_presigned_url(self, method, Params, ExpiresIn):
+        return 'https://s3.example.com/{}/{}?expires={}'.format(Params['Bucket'], Params['Key'], ExpiresIn)
+
+
+class StorageTest(APITransactionTestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        self.user = User.objects.create_user('user1', '', 'abc123abc', first_name='user1')
+        self.event = Event.objects.create(name='My Amazing Wedding 1', start_dt=timezone.now(),
+                                          end_dt=timezone.now(), challenge='challenge')
+        UserAuthenticatedForEvent.objects.create(user=self.user, event=self.event)
+
+        image = BytesIO()
+        Image.new('RGB', (100, 100)).save(image, 'JPEG')
+        self.photo = Photo.objects.create(owner=self.user, event=self.event, visible=True, hash_md5='!IGNORE!',
+                                          photo=SimpleUploadedFile('upload.jpg', image.getvalue()))
+
+    def use_s3(self):
+        client = LocalS3Client()
+        storage = default_storage._wrapped
+        default_storage._wrapped = S3Storage(bucket='test', client=client)
+        self.addCleanup(setattr, default_storage, '_wrapped', storage)
+        return client
+
+    def test_hashed_layout(self):
+        for field in [self.photo.photo, self.photo.thumbnail, self.photo.web_photo]:
+            upload_to, first, second, basename = field.name.split('/')
+            digest = hashlib.md5(basename.encode('utf8')).hexdigest()
+            self.assertEqual((first, second), (digest[:2], digest[2:4]))
+            self.assertTrue(os.path.isfile(field.path))
+
+    def test_migrate_media_layout(self):
+        # move the files to the flat layout
+        flat_names = {}
+        for field in ['photo', 'thumbnail', 'web_photo']:
+            name = getattr(self.photo, field).name
+            flat_names[field] = '{}/{}'.format(name.split('/')[0], os.path.basename(name))
+            os.renames(default_storage.path(name), default_storage.path(flat_names[field]))
+        Photo.objects.filter(pk=self.photo.pk).update(**flat_names)
+
+        call_command('migrate_media_layout', '--dry-run', stdout=StringIO())
+        self.assertEqual(Photo.objects.filter(**flat_names).count(), 1)
+
+        out = StringIO()
+        call_command('migrate_media_layout', stdout=out)
+        self.assertIn('moved 3 files, 0 missing', out.getvalue())
+        photo = Photo.objects.get(pk=self.photo.pk)
+        for field in ['photo', 'thumbnail', 'web_photo']:
+            self.assertEqual(getattr(photo, field).name, getattr(self.photo, field).name)
+            self.assertTrue(default_storage.exists(getattr(photo, field).name))
+            self.assertFalse(default_storage.exists(flat_names[field]))
+
+        # nothing left to do
+        out = StringIO()
+        call_command('migrate_media_layout', stdout=out)
+        self.assertIn('moved 0 files', out.getvalue())
+
+    def test_s3_storage(self):
+        client = self.use_s3()
+
+        # the local files are copied into the bucket
+        out = StringIO()
+        call_command('migrate_media_layout', '--from-local', stdout=out)
+        self.assertIn('moved 3 files', out.getvalue())
+        self.assertEqual(len(client.objects), 3)
+
+        photo = Photo.objects.get(pk=self.photo.pk)
+        with photo.thumbnail.storage.open(photo.thumbnail.name) as f:
+            self.assertEqual(f.read(), client.objects[('test', photo.thumbnail.name)])
+        self.assertEqual(default_storage.size(photo.web_photo.name), len(client.objects[('test', photo.web_photo.name)]))
+
+        directory = photo.photo.name.rsplit('/', 1)[0]
+        self.assertEqual(default_storage.listdir(directory), ([], [os.path.basename(photo.photo.name)]))
+        self.assertEqual(default_storage.listdir('photos')[0], [directory.split('/')[1]])
+
+        # the media view redirects to the object store
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse('media', kwargs={'path': photo.thumbnail.name}))
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertTrue(response['Location'].startswith('https://s3.example.com/test/' + photo.thumbnail.name))
+
+        # uploads go to the bucket as well
+        photo.thumbnail.save('new.jpg', ContentFile(b'abc'), save=False)
+        self.assertEqual(photo.thumbnail.name, S3Storage.fan_out('thumbnail/new.jpg'))
+        self.assertEqual(client.objects[('test', photo.thumbnail.name)], b'abc')
+        photo.thumbnail.delete(save=False)
+        self.assertEqual(len(client.objects), 3)
+
+    def test_delete_unreferenced_files(self):
+        # an update replaces the scaled versions
+        old_names = [self.photo.thumbnail.name, self.photo.web_photo.name]
+        self.photo.comment = 'changed'
+        self.photo.save()
+        self.assertNotIn(self.photo.thumbnail.name, old_names)
+        self.assertTrue(default_storage.exists(self.photo.thumbnail.name))
+        self.assertFalse(any(default_storage.exists(name) for name in old_names))
+
+        # files still referenced by another photo are kept
+        names = [self.photo.photo.name, self.photo.thumbnail.name, self.photo.web_photo.name]
+        copy = Photo.objects.get(pk=self.photo.pk)
+        copy.pk = None
+        Photo.objects.bulk_create([copy])
+        self.photo.delete()
+        self.assertTrue(all(default_storage.exists(name) for name in names))
+
+        Photo.objects.all().delete()
+        self.assertFalse(any(default_storage.exists(name) for name in names))
+
+        # event icons
+        self.event.icon.save('icon.png', ContentFile(b'icon'))
+        icon = self.event.icon.name
+        self.assertTrue(default_storage.exists(icon))
+        self.event.delete()
+        self.assertFalse(default_storage.exists(icon))
+
+    def test_reconcile_media(self):
+        orphan = default_storage.save('photos/00/00/orphan.jpg', ContentFile(b'orphan'))
+        sprite = default_storage.save('sprites/1/sprite.jpg', ContentFile(b'sprite'))
+        expired_sprite = default_storage.save('sprites/1/expired.jpg', ContentFile(b'sprite'))
+        expired = time.time() - settings.PHOTO_SPRITE_CACHE_TIMEOUT - 60
+        os.utime(default_storage.path(expired_sprite), (expired, expired))
+        os.remove(default_storage.path(self.photo.web_photo.name))
+
+        # too young
+        out = StringIO()
+        call_command('reconcile_media', '--delete', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), [
+            'missing {}'.format(self.photo.web_photo.name),
+            '2 sprite sheets, 0 expired (0 deleted)',
+            '3 files, 0 orphaned (0 deleted), 1 missing',
+        ])
+
+        out = StringIO()
+        call_command('reconcile_media', '--min-age', '-1', stdout=out)
+        self.assertIn('orphaned {}'.format(orphan), out.getvalue().splitlines())
+        self.assertTrue(default_storage.exists(orphan))
+
+        out = StringIO()
+        call_command('reconcile_media', '--min-age', '-1', '--delete', stdout=out)
+        self.assertIn('3 files, 1 orphaned (1 deleted), 1 missing', out.getvalue())
+        self.assertFalse(default_storage.exists(orphan))
+        # sprite sheets which may still be handed out are kept
+        self.assertIn('2 sprite sheets, 1 expired (1 deleted)', out.getvalue())
+        self.assertTrue(default_storage.exists(sprite))
+        self.assertFalse(default_storage.exists(expired_sprite))
+        self.assertTrue(default_storage.exists(self.photo.photo.name))
+
+        # an original both on hot storage and archived (interrupted archive_originals) is one referenced file
+        ArchivedFile.objects.create(name=self.photo.photo.name, container='event_1/000001.pack', offset=0,
+                                    size=default_storage.size(self.photo.photo.name))
+        out = StringIO()
+        call_command('reconcile_media', '--min-age', '-1', '--delete', stdout=out)
+        self.assertIn('2 files, 0 orphaned (0 deleted), 1 missing', out.getvalue())
+        self.assertTrue(os.path.exists(default_storage.path(self.photo.photo.name)))
+        self.assertTrue(ArchivedFile.objects.filter(name=self.photo.photo.name).exists())
+
+    def test_archive_originals(self):
+        cold_storage_settings = override_settings(COLD_STORAGE_ROOT=os.path.join(settings.MEDIA_ROOT, 'cold'))
+        cold_storage_settings.enable()
+        self.addCleanup(cold_storage_settings.disable)
+
+        # an uncompressed PNG
+        image = BytesIO()
+        Image.new('RGB', (200, 200), (255, 0, 0)).save(image, 'PNG', compress_level=0)
+        png = Photo.objects.create(owner=self.user, event=self.event, visible=True, hash_md5='!IGNORE!',
+                                   photo=SimpleUploadedFile('upload.png', image.getvalue()))
+        with open(self.photo.photo.path, 'rb') as f:
+            jpeg = f.read()
+
+        # the event has not ended long enough
+        out = StringIO()
+        call_command('archive_originals', stdout=out)
+        self.assertIn('archived 0 originals', out.getvalue())
+
+        Event.objects.filter(pk=self.event.pk).update(end_dt=timezone.now() - timedelta(days=100))
+        out = StringIO()
+        call_command('archive_originals', stdout=out)
+        self.assertIn('archived 2 originals', out.getvalue())
+
+        # hot tier: only the scaled versions are left
+        self.assertFalse(os.path.exists(default_storage.path(self.photo.photo.name)))
+        self.assertFalse(os.path.exists(default_storage.path(png.photo.name)))
+        self.assertTrue(os.path.exists(default_storage.path(png.thumbnail.name)))
+        self.assertEqual(len(os.listdir(os.path.join(settings.COLD_STORAGE_ROOT, 'event_{}'.format(self.event.pk)))), 1)
+
+        # archived originals are read from the container
+        with default_storage.open(self.photo.photo.name) as f:
+            self.assertEqual(f.read(), jpeg)
+        # the uncompressed PNG is stored compressed
+        self.assertLess(ArchivedFile.objects.get(name=png.photo.name).compressed_size, len(image.getvalue()))
+        # and read back byte for byte (no re-encoding which could drop their metadata chunks)
+        png = Photo.objects.get(pk=png.pk)
+        with default_storage.open(png.photo.name) as f:
+            self.assertEqual(f.read(), image.getvalue())
+        self.assertEqual(png.hash_md5, hashlib.md5(image.getvalue()).hexdigest())
+        png.comment = 'updated'
+        png.save()
+
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse('media', kwargs={'path': self.photo.photo.name}), HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), jpeg[10:20])
+        response.close()
+        response = self.client.get(reverse('media', kwargs={'path': png.photo.name}), HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), image.getvalue()[100:200])
+        response.close()
+
+        out = StringIO()
+        call_command('reconcile_media', stdout=out)
+        self.assertIn('6 files, 0 orphaned (0 deleted), 0 missing', out.getvalue())
+
+        # nothing left to archive
+        out = StringIO()
+        call_command('archive_originals', stdout=out)
+        self.assertIn('archived 0 originals', out.getvalue())
+
+        self.photo.delete()
+        self.assertFalse(ArchivedFile.objects.filter(name=self.photo.photo.name).exists())
@@ -1,19 +1,35 @@
 import hashlib
 import string
+from collections import OrderedDict
 from random import choice
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import Count
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Prefetch, Subquery, Q
+from django.db.models.functions import Coalesce
+from django.http import Http404
+from django.utils import timezone
 from rest_framework import viewsets, status
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.exceptions import ValidationError
+from rest_framework.decorators import api_view, detail_route, list_route, permission_classes, renderer_classes
+from rest_framework.exceptions import NotAuthenticated, PermissionDenied, ValidationError
 from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
-from eventphotos.models import Photo, Like, Event, UserAuthenticatedForEvent
+from eventphotos import export, search, sharding, sprites, timeline
+from eventphotos.admission import admission_controlled
+from eventphotos.idempotency import idempotent
+from eventphotos.likebuffer import like_buffer
+from eventphotos import media as media_files
+from eventphotos.models import Photo, Like, Event, UserAuthenticatedForEvent, batched_counts, count_likes
 from eventphotos.permissions import IsOwnerOrAuthorisedForEventConstructor
 from eventphotos.serializers import UserSerializer, PhotoSerializer, LikeSerializer, EventSerializer, \
     UserAuthenticatedForEventSerializer
+from eventphotos.stats import event_stats
+from eventserver.renderers import AnyMediaTypeRenderer
+from eventserver.settings import USER_PHOTO_PREVIEW_SIZE
 
 
 @api_view(['POST'])
@@ -102,7 +118,7 @@ def authenticate_user_for_event(request, **kwargs):
     if hashed_challenge != expected_challenge:
         raise ValidationError("challenged failed")
 
-    UserAuthenticatedForEvent.objects.create(user=user, event=event)
+    UserAuthenticatedForEvent.objects.get_or_create(user=user, event=event)
 
     return Response(EventSerializer(event, context={'request': request}).data,
                     status=status.HTTP_201_CREATED)
@@ -110,6 +126,7 @@ def authenticate_user_for_event(request, **kwargs):
 
 @api_view(['POST'])
 @permission_classes((IsAuthenticated,))
+@idempotent
 def like_photo(request, **kwargs):
     user = request.user
     photo_pk = request.data['photo_id']
@@ -119,33 +136,322 @@ def like_photo(request, **kwargs):
     like = bool(like)
 
     try:
-        photo = Photo.objects.get(pk=photo_pk)
+        photo = sharding.using_pk(Photo.objects, photo_pk).get(pk=photo_pk)
     except:
         raise ValidationError("photo not found")
 
     if not UserAuthenticatedForEvent.is_user_authenticated_for_event(user, photo.event):
         raise ValidationError("photo not found")
 
-    is_liked = Like.objects.filter(photo=photo, owner=user).exists()
+    is_liked = photo.like_set.filter(owner=user).exists()
 
-    if is_liked and not like:
-        # delete like
-        Like.objects.filter(photo=photo, owner=user).delete()
-    elif not is_liked and like:
-        Like.objects.create(photo=photo, owner=user)
+    if like_buffer.is_enabled():
+        # write-behind: the like is written by the next flush
+        like_buffer.add(user.pk, photo.pk, like, is_liked)
+    else:
+        Like.set_like(user, photo, like, is_liked)
 
     return Response(PhotoSerializer(photo, context={'request': request}).data,
                     status=status.HTTP_200_OK)
 
+
+@api_view(['POST'])
+@permission_classes((IsAuthenticated,))
+def like_photos(request, **kwargs):
+    """
+    Bulk version of like_photo: takes {"likes": [{"photo_id": ..., "like": ...}, ...]},
+    applies all changes at once and returns the like counts of all affected photos.
+    """
+    user = request.user
+
+    # later entries win
+    try:
+        likes = {int(item['photo_id']): bool(item['like']) for item in request.data['likes']}
+    except (KeyError, TypeError, ValueError):
+        raise ValidationError("invalid likes")
+
+    if sharding.is_enabled():
+        # photos of different events live in different databases
+        likes_by_event = {}
+        for photo_pk, like in likes.items():
+            likes_by_event.setdefault(sharding.event_id_for_pk(photo_pk), {})[photo_pk] = like
+    else:
+        likes_by_event = {None: likes}
+
+    data = []
+    for event_id, event_likes in likes_by_event.items():
+        data += like_event_photos(user, event_likes, event_id)
+
+    return Response(data, status=status.HTTP_200_OK)
+
+
+def like_event_photos(user: User, likes: dict, event_id):
+    """
+    Applies the likes of like_photos to photos of one event (or of all events if event_id is None).
+    """
+    if event_id is None:
+        # check event authorisation for all photos in one query
+        authorised_photo_pks = set(Photo.objects
+                                   .filter(pk__in=likes.keys(), event__authenticated_users__user=user)
+                                   .values_list('pk', flat=True))
+        db = 'default'
+    else:
+        # the database of an event only contains photos of this event
+        db = sharding.event_database(event_id)
+        authorised_photo_pks = set()
+        if UserAuthenticatedForEvent.is_user_authenticated_for_event(user, Event(pk=event_id)):
+            authorised_photo_pks = set(Photo.objects.using(db)
+                                       .filter(pk__in=likes.keys())
+                                       .values_list('pk', flat=True))
+    if authorised_photo_pks != set(likes.keys()):
+        raise ValidationError("photo not found")
+
+    # the statistics of all likes are written at once
+    with transaction.atomic(using=db), batched_counts():
+        liked_photo_pks = set(Like.objects.db_manager(db)
+                              .filter(owner=user, photo__pk__in=likes.keys())
+                              .values_list('photo__pk', flat=True))
+
+        if like_buffer.is_enabled():
+            # write-behind: the likes are written by the next flush
+            for photo_pk, like in likes.items():
+                like_buffer.add(user.pk, photo_pk, like, photo_pk in liked_photo_pks)
+        else:
+            # bulk_create does not call Like.save, hence set dt here
+            now = timezone.now()
+            created = Like.objects.db_manager(db).bulk_create(Like(photo_id=photo_pk, owner=user, dt=now)
+                                                              for photo_pk, like in likes.items()
+                                                              if like and photo_pk not in liked_photo_pks)
+            # nor send post_save
+            count_likes([like.photo_id for like in created], 1, db)
+
+            unliked_photo_pks = [photo_pk for photo_pk, like in likes.items()
+                                 if not like and photo_pk in liked_photo_pks]
+            if unliked_photo_pks:
+                Like.objects.db_manager(db).filter(owner=user, photo__pk__in=unliked_photo_pks).delete()
+
+    like_counts = dict(Like.objects.db_manager(db)
+                       .filter(photo__pk__in=likes.keys())
+                       .order_by()
+                       .values_list('photo__pk')
+                       .annotate(Count('pk')))
+
+    data = [{
+        'photo_id': photo_pk,
+        'likes': like_counts.get(photo_pk, 0) + (like_buffer.like_delta(photo_pk) if like_buffer.is_enabled() else 0),
+        'liked_by_current_user': like,
+    } for photo_pk, like in likes.items()]
+
+    return data
+
+
+@api_view(['POST'])
+@permission_classes((IsAuthenticated,))
+@renderer_classes((AnyMediaTypeRenderer,))
+def photo_files(request, **kwargs):
+    """
+    Batch version of the media view for derivatives: takes {"ids": [...], "rendition": "thumbnail"}
+    and streams the files of all photos the user may see in one response (see media.batch_response).
+    Unknown photos and photos of other events are left out.
+    """
+    user = request.user
+
+    data = request.data if isinstance(request.data, dict) else {}
+    ids = data.get('ids', None)
+    # a list of integers (a string would be iterated character by character)
+    if not isinstance(ids, list) or not all(isinstance(pk, int) and not isinstance(pk, bool) for pk in ids):
+        raise ValidationError("ids must be a list of photo ids")
+    photo_pks = list(OrderedDict.fromkeys(ids))
+    rendition = data.get('rendition', 'thumbnail')
+    if rendition not in media_files.BATCH_RENDITIONS:
+        raise ValidationError("invalid rendition")
+    if len(photo_pks) > settings.PHOTO_FILES_MAX_BATCH:
+        raise ValidationError("at most {} photos per request".format(settings.PHOTO_FILES_MAX_BATCH))
+
+    if sharding.is_enabled():
+        # photos of different events live in different databases
+        pks_by_event = {}
+        for photo_pk in photo_pks:
+            pks_by_event.setdefault(sharding.event_id_for_pk(photo_pk), []).append(photo_pk)
+    else:
+        pks_by_event = {None: photo_pks}
+
+    names = {}
+    for event_id, event_photo_pks in pks_by_event.items():
+        names.update(authorised_photo_files(user, event_photo_pks, rendition, event_id))
+
+    files = [(photo_pk, names[photo_pk]) for photo_pk in photo_pks if names.get(photo_pk)]
+    return media_files.batch_response(request, files)
+
+
+def authorised_photo_files(user: User, photo_pks: list, rendition: str, event_id) -> dict:
+    """
+    Returns {photo pk: file name of the rendition} of the photos the user owns or is authorised to see,
+    checking the authorisation of all photos at once.
+    """
+    if event_id is None:
+        queryset = Photo.objects.filter(pk__in=photo_pks)
+        if not user.is_superuser:
+            queryset = queryset.filter(Q(owner=user) | Q(event__authenticated_users__user=user))
+    else:
+        try:
+            queryset = Photo.objects.using(sharding.event_database(event_id)).filter(pk__in=photo_pks)
+        except Event.DoesNotExist:
+            return {}
+        if not user.is_superuser \
+                and not UserAuthenticatedForEvent.is_user_authenticated_for_event_cached(user, Event(pk=event_id)):
+            queryset = queryset.filter(owner=user)
+    return dict(queryset.values_list('pk', rendition))
+
+
+def fan_out(queryset, user: User, pk=None, event_field='event'):
+    """
+    Spreads a queryset without event filter over the databases of all events the user is authorised for.
+    With a primary key, only the database of the event of this object is used.
+    """
+    if pk is not None:
+        event_ids = [sharding.event_id_for_pk(pk)]
+    else:
+        event_ids = Event.objects.values_list('pk', flat=True)
+
+    querysets = [sharding.using_event(queryset.filter(**{event_field: event_id}), event_id)
+                 for event_id in event_ids
+                 if user.is_superuser
+                 or UserAuthenticatedForEvent.is_user_authenticated_for_event(user, Event(pk=event_id))]
+
+    if pk is not None:
+        return querysets[0] if querysets else queryset.none()
+    return sharding.FanOutQuerySet(querysets)
+
+
+@api_view(['GET', 'HEAD'])
+@permission_classes((AllowAny,))
+@renderer_classes((AnyMediaTypeRenderer,))
+def media(request, path, **kwargs):
+    """
+    Serves media files: event icons to every user, photo files to their owner
+    and to users authorised for their event, sprite sheets to users authorised for their event.
+    Signed urls (see PhotoSerializer) need no authentication.
+    """
+    user = request.user
+
+    # all checks and the file refer to the normalised name (no event_icon/../photos/...)
+    name = media_files.storage_name(path)
+    if name is None:
+        raise Http404('file not found')
+
+    if media_files.is_signed(request, name):
+        return media_files.serve_media(request, name, signed=True)
+
+    if not user.is_authenticated():
+        raise NotAuthenticated()
+
+    if user.is_superuser:
+        pass
+    elif name.startswith(Event._meta.get_field('icon').upload_to + '/'):
+        pass
+    elif name.startswith(sprites.SPRITE_DIR + '/'):
+        # sprites/<event id>/<key>.jpg
+        parts = name.split('/')
+        try:
+            event_pk = int(parts[1])
+        except ValueError:
+            raise Http404('file not found')
+        if len(parts) != 3 or \
+                not UserAuthenticatedForEvent.is_user_authenticated_for_event_cached(user, Event(pk=event_pk)):
+            raise Http404('file not found')
+    else:
+        photo = media_photo(name)
+        if photo is None:
+            raise Http404('file not found')
+
+        owner_pk, event_pk = photo
+        if owner_pk != user.pk and \
+                not UserAuthenticatedForEvent.is_user_authenticated_for_event_cached(user, Event(pk=event_pk)):
+            raise Http404('file not found')
+
+    return media_files.serve_media(request, name)
+
+
+def media_photo(path: str):
+    """
+    Returns (owner pk, event pk) of the photo a media file belongs to, or None.
+    The result is cached for EVENT_AUTH_CACHE_TIMEOUT seconds.
+    """
+    key = 'media-photo:{}'.format(hashlib.md5(path.encode('utf8')).hexdigest())
+    photo = cache.get(key)
+
+    if photo is None:
+        if sharding.is_enabled():
+            querysets = [sharding.using_event(Photo.objects, event_pk)
+                         for event_pk in Event.objects.values_list('pk', flat=True)]
+        else:
+            querysets = [Photo.objects]
+
+        query = Q(photo=path) | Q(thumbnail=path) | Q(web_photo=path)
+        photos = (tuple(p) for queryset in querysets for p in queryset.filter(query).values_list('owner', 'event')[:1])
+        # False: no photo
+        photo = next(photos, False)
+        cache.set(key, photo, settings.EVENT_AUTH_CACHE_TIMEOUT)
+
+    return photo or None
+
+
+@api_view(['GET', 'HEAD'])
+@permission_classes((IsAuthenticated,))
+@renderer_classes((AnyMediaTypeRenderer,))
+def export_event_photos(request, **kwargs):
+    """
+    Streams a zip archive of the visible original photos of an event.
+    Optional filters: owner_id, from and to (photo date, from inclusive, to exclusive).
+    """
+    user = request.user
+    event_pk = int(kwargs['event_id'])
+
+    try:
+        event = Event.objects.get(pk=event_pk)
+    except Event.DoesNotExist:
+        raise Http404('event not found')
+
+    if not user.is_superuser and not UserAuthenticatedForEvent.is_user_authenticated_for_event(user, event):
+        raise PermissionDenied('user not authorised for this event')
+
+    filters = {}
+    try:
+        if 'owner_id' in request.query_params:
+            filters['owner_id'] = int(request.query_params['owner_id'])
+        if 'from' in request.query_params:
+            filters['from_dt'] = export.parse_dt(request.query_params['from'])
+        if 'to' in request.query_params:
+            filters['to_dt'] = export.parse_dt(request.query_params['to'])
+    except (ValueError, OverflowError):
+        raise ValidationError('invalid filter')
+
+    archive = export.ZipStream(export.event_entries(event.pk, **filters))
+    return export.zip_response(request, archive, 'event_{}.zip'.format(event.pk))
+
+
 class UserViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     permission_classes = (IsAdminUser,)
 
-    queryset = User.objects.all().order_by('-date_joined')
     serializer_class = UserSerializer
 
+    def get_queryset(self):
+        # number of newer photos of the same owner, used to cap the preview in the database
+        newer_photos = Photo.objects.filter(owner=OuterRef('owner'), upload_dt__gt=OuterRef('upload_dt')) \
+            .order_by().values('owner').annotate(count=Count('pk')).values('count')
+        preview = Photo.objects \
+            .annotate(newer_photos=Coalesce(Subquery(newer_photos, output_field=IntegerField()), 0)) \
+            .filter(newer_photos__lt=USER_PHOTO_PREVIEW_SIZE) \
+            .order_by('-upload_dt')
+
+        queryset = User.objects.annotate(photo_count=Count('photos'))
+        queryset = queryset.prefetch_related(Prefetch('photos', queryset=preview, to_attr='photo_preview'))
+        return queryset.order_by('-date_joined')
+
 
 class EventViewSet(viewsets.ModelViewSet):
     """
@@ -156,6 +462,18 @@ class EventViewSet(viewsets.ModelViewSet):
     queryset = Event.objects.all()
     serializer_class = EventSerializer
 
+    @detail_route(permission_classes=(IsAuthenticated,))
+    def stats(self, request, pk=None):
+        """
+        Live statistics of the event: numbers of photos, uploaders and likes, top photos and contributors.
+        """
+        event = self.get_object()
+        if not request.user.is_superuser and \
+                not UserAuthenticatedForEvent.is_user_authenticated_for_event(request.user, event):
+            raise PermissionDenied('user not authorised for this event')
+
+        return Response(event_stats(event.pk))
+
 
 class AuthenticatedUserForEventViewSet(viewsets.ModelViewSet):
     """
@@ -182,22 +500,48 @@ class PhotoViewSet(viewsets.ModelViewSet):
         # get metadata from the request object
         user = self.request.user
         event_id = self.request.query_params.get('event_id', None)
+        owner_id = self.request.query_params.get('owner_id', None)
         only_visible = self.request.query_params.get('only_visible', None)
         sort_order = self.request.query_params.get('sort_order', None)
+        query = self.request.query_params.get('search', None)
+        collapse_duplicates = self.request.query_params.get('collapse_duplicates', None)
+
+        if query is not None and event_id is None:
+            raise ValidationError('search requires event_id')
+        # the rankings are per event
+        if sort_order == 'best' and event_id is None:
+            raise ValidationError('sort_order best requires event_id')
 
         # only show visible photos
         if only_visible is not None:
             if only_visible == "1" or only_visible.lower() == "true":
                 queryset = queryset.filter(visible=True)
 
+        # only show photos of the given owner
+        if owner_id is not None:
+            queryset = queryset.filter(owner__id=owner_id)
+
+        # hide near-duplicates of other photos
+        if collapse_duplicates is not None and collapse_duplicates.lower() in ('1', 'true'):
+            queryset = queryset.filter(duplicate_of__isnull=True)
+
         # if there is an event id, use it to filter the queryset
         if event_id is not None:
             event = Event.objects.get(pk=event_id)
 
             if UserAuthenticatedForEvent.is_user_authenticated_for_event(user, event):
-                queryset = queryset.filter(event=event)
+                queryset = sharding.using_event(queryset.filter(event=event), event.pk)
             else:
                 return []
+
+            # full text search in comments and owner names, best matches first unless sorted otherwise
+            if query is not None:
+                if not search.is_available(queryset.db):
+                    raise ValidationError('search is not available')
+                queryset = search.search(queryset, query, event.pk, ranked=sort_order is None)
+        # photos of different events live in different databases
+        elif sharding.is_enabled():
+            return fan_out(self.sort(queryset, sort_order), user, self.kwargs.get('pk', None))
         # if we have the super user, they can see everything
         elif user.is_superuser:
             queryset = queryset
@@ -207,6 +551,11 @@ class PhotoViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(event__authenticated_users__isnull=False,
                                        event__authenticated_users__user__id=user.id)
 
+        # return
+        return self.sort(queryset, sort_order).all()
+
+    @staticmethod
+    def sort(queryset, sort_order):
         if sort_order is not None:
             if sort_order == 'uploaded':
                 queryset = queryset.order_by('-upload_dt')
@@ -218,11 +567,88 @@ class PhotoViewSet(viewsets.ModelViewSet):
                 #print("sort_order: likes")
                 queryset = queryset.annotate(Count('like_set'))
                 queryset = queryset.order_by('-like_set__count')
+            elif sort_order == 'best':
+                # materialised ranking (eventphotos.ranking), only the ranked photos
+                queryset = queryset.filter(best__isnull=False).order_by('best__rank')
             else:
                 queryset.order_by('-photo_dt')
 
-        # return
-        return queryset.all()
+        return queryset
+
+    @list_route(methods=['get'])
+    def sprite(self, request):
+        """
+        Sprite sheet of the thumbnails of a page of an event's photos (same filters, sort order and
+        pagination as the list) and the position of every photo on it, so a grid needs one image request.
+        """
+        event_id = request.query_params.get('event_id', None)
+        if event_id is None:
+            raise ValidationError('event_id is required')
+
+        queryset = self.get_queryset()
+        if isinstance(queryset, list):
+            # not authorised for the event, do not create a sheet in its directory
+            raise Http404('event not found')
+        queryset = self.filter_queryset(queryset)
+        page = self.paginate_queryset(queryset)
+        photos = list(page if page is not None else queryset)
+
+        sheet = sprites.sprite_sheet(photos, int(event_id))
+        url = request.build_absolute_uri(default_storage.url(sheet['name']))
+        if settings.MEDIA_SIGNED_URLS:
+            url = media_files.sign_media_url(url, sheet['name'])
+
+        data = OrderedDict([
+            ('sprite', url),
+            ('width', sheet['width']),
+            ('height', sheet['height']),
+            ('photos', sheet['photos']),
+        ])
+        if page is not None:
+            data['next'] = self.paginator.get_next_link()
+            data['previous'] = self.paginator.get_previous_link()
+        return Response(data)
+
+    @list_route(methods=['get'])
+    def histogram(self, request):
+        """
+        Number of photos of an event (same filters as the list) per bucket of seconds (default
+        PHOTO_HISTOGRAM_BUCKET) of photo_dt or upload_dt (field), for timeline scrubbing. The page of every
+        bucket refers to the list with sort_order created (photo_dt) or uploaded (upload_dt) and the same page_size.
+        """
+        event_id = request.query_params.get('event_id', None)
+        if event_id is None:
+            raise ValidationError('event_id is required')
+
+        field = request.query_params.get('field', 'photo_dt')
+        if field not in timeline.FEED_SORT_ORDERS:
+            raise ValidationError('field must be one of {}'.format(', '.join(sorted(timeline.FEED_SORT_ORDERS))))
+        try:
+            seconds = int(request.query_params.get('bucket', settings.PHOTO_HISTOGRAM_BUCKET))
+        except ValueError:
+            raise ValidationError('invalid bucket')
+        if seconds < settings.PHOTO_HISTOGRAM_MIN_BUCKET:
+            raise ValidationError('bucket must be at least {} seconds'.format(settings.PHOTO_HISTOGRAM_MIN_BUCKET))
+
+        queryset = self.get_queryset()
+        page_size = self.paginator.get_page_size(request) or 1
+        # get_queryset returns a list if the user is not authorised for the event
+        buckets = [] if isinstance(queryset, list) else timeline.histogram(queryset, field, seconds, page_size)
+
+        return Response(OrderedDict([
+            ('field', field),
+            ('bucket', seconds),
+            ('sort_order', timeline.FEED_SORT_ORDERS[field]),
+            ('page_size', page_size),
+            ('buckets', buckets),
+        ]))
+
+    @admission_controlled
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        # retries of an upload (Idempotency-Key) get the response of the first attempt,
+        # admission comes first as the idempotency fingerprint parses the body
+        return super(PhotoViewSet, self).create(request, *args, **kwargs)
 
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
@@ -259,9 +685,12 @@ class LikeViewSet(viewsets.ModelViewSet):
             event = Event.objects.get(pk=event_pk)
 
             if UserAuthenticatedForEvent.is_user_authenticated_for_event(user, event):
-                queryset = queryset.filter(photo__event=event)
+                queryset = sharding.using_event(queryset.filter(photo__event=event), event.pk)
             else:
                 return []
+        # likes of different events live in different databases
+        elif sharding.is_enabled():
+            return fan_out(queryset, user, self.kwargs.get('pk', None), 'photo__event')
         # if we have the super user, they can see everything
         elif user.is_superuser:
             queryset = queryset
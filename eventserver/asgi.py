@@ -0,0 +1,189 @@
+"""
+ASGI config for wserver project.
+
+It exposes the ASGI callable as a module-level variable named ``application``, e.g. for
+
+    uvicorn eventserver.asgi:application
+
+Django 1.11 has neither async views nor an async ORM, so the views keep running synchronously in threads,
+while receiving requests and sending responses happens on the event loop.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.urls import Resolver404, resolve
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "eventserver.settings")
+
+# methods of the requests which may run in the read pool
+READ_METHODS = ('GET', 'HEAD')
+
+
+def path_info(scope: dict) -> str:
+    path, root_path = scope['path'], scope.get('root_path', '')
+    return path[len(root_path):] if root_path and path.startswith(root_path) else path
+
+
+def wsgi_environ(scope: dict, body) -> dict:
+    """
+    WSGI environ of the request of the ASGI HTTP scope, body is the file with the complete request body.
+    """
+    # WSGI strings are the latin-1 decoding of the raw bytes
+    def wsgi_str(value: str) -> str:
+        return value.encode('utf-8').decode('latin-1')
+
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client_host, client_port = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': wsgi_str(scope.get('root_path', '')),
+        'PATH_INFO': wsgi_str(path_info(scope)),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port or 80),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client_host,
+        'REMOTE_PORT': str(client_port),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+
+    # the body is complete, also if it was sent chunked
+    body.seek(0, os.SEEK_END)
+    environ['CONTENT_LENGTH'] = str(body.tell())
+    body.seek(0)
+    return environ
+
+
+class ASGIHandler(object):
+    """
+    Serves Django through ASGI: request bodies and responses are transferred on the event loop, only running
+    the view takes a thread, so slow clients (mobile uploads and feeds) don't tie up the threads of a process.
+
+    GET and HEAD requests of the views in ASGI_READ_VIEWS (events and photo feed) run in a pool of
+    ASGI_READ_THREADS threads, everything else (uploads, likes, ...) in a pool of ASGI_WRITE_THREADS,
+    so that a burst of uploads can't take the threads of the read endpoints.
+    """
+
+    def __init__(self):
+        self.wsgi = WSGIHandler()
+        self.read_pool = ThreadPoolExecutor(settings.ASGI_READ_THREADS, thread_name_prefix='asgi-read')
+        self.write_pool = ThreadPoolExecutor(settings.ASGI_WRITE_THREADS, thread_name_prefix='asgi-write')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        else:
+            raise ValueError('unsupported ASGI scope type {}'.format(scope['type']))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def shutdown(self):
+        self.read_pool.shutdown()
+        self.write_pool.shutdown()
+
+    def pool(self, scope: dict) -> ThreadPoolExecutor:
+        if scope['method'] in READ_METHODS:
+            try:
+                url_name = resolve(path_info(scope)).url_name
+            except Resolver404:
+                url_name = None
+            if url_name in settings.ASGI_READ_VIEWS:
+                return self.read_pool
+        return self.write_pool
+
+    async def http(self, scope, receive, send):
+        body = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body', False):
+                    break
+
+            loop = asyncio.get_event_loop()
+            pool = self.pool(scope)
+            status, headers, content = await loop.run_in_executor(pool, self.get_response,
+                                                                  wsgi_environ(scope, body))
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+
+            if isinstance(content, bytes):
+                await send({'type': 'http.response.body', 'body': content})
+                return
+
+            # streamed response (files): every chunk is read in the pool
+            chunks = iter(content)
+            try:
+                while True:
+                    chunk = await loop.run_in_executor(pool, next, chunks, None)
+                    if chunk is None:
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                await send({'type': 'http.response.body'})
+            finally:
+                await loop.run_in_executor(pool, content.close)
+        finally:
+            body.close()
+
+    def get_response(self, environ: dict):
+        """
+        Runs the request through Django (in a thread of a pool), returns the status, the headers
+        and the content, or the response itself if it is streamed.
+        """
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(' ', 1)[0]),
+                          [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]]
+
+        response = self.wsgi(environ, start_response)
+        status, headers = started
+        if getattr(response, 'streaming', False):
+            return status, headers, response
+
+        # closing the response ends the request (request_finished closes the database connections of the thread)
+        try:
+            content = b''.join(response)
+        finally:
+            response.close()
+        return status, headers, content
+
+
+def get_asgi_application():
+    django.setup(set_prefix=False)
+    return ASGIHandler()
+
+
+application = get_asgi_application()
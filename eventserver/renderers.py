@@ -0,0 +1,42 @@
+import datetime
+import decimal
+
+import msgpack
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Renderer which serializes to MessagePack, a compact binary alternative to JSON.
+    Date times are encoded as integer unix timestamps (seconds).
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=self.encode_default, use_bin_type=True)
+
+    @staticmethod
+    def encode_default(obj):
+        if isinstance(obj, datetime.datetime):
+            return int(obj.timestamp())
+        elif isinstance(obj, datetime.date):
+            return obj.isoformat()
+        elif isinstance(obj, decimal.Decimal):
+            return str(obj)
+        elif isinstance(obj, (tuple, set, frozenset)):
+            return list(obj)
+        return str(obj)
+
+
+class AnyMediaTypeRenderer(JSONRenderer):
+    """
+    Accepts any media type, for views which return files (HttpResponse) instead of data.
+    Error responses are rendered as JSON.
+    """
+    media_type = '*/*'
+    format = 'any'
@@ -0,0 +1,75 @@
+import random
+import threading
+
+from django.conf import settings
+
+_state = threading.local()
+
+# unsafe methods, a successful request with one of them pins the client to the primary
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+def _get_state(name):
+    return getattr(_state, name, False)
+
+
+class ReplicaRouter(object):
+    """
+    Sends reads of the views in DATABASE_REPLICA_VIEWS to a database of DATABASE_REPLICAS, chosen at random
+    once per request so that all reads of a request see the same replica. Writes and all other reads go
+    to the primary ('default'). Once a client has written, its reads are pinned to the primary for
+    DATABASE_REPLICA_PIN_SECONDS (see ReplicaPinningMiddleware), so that it always sees its own writes.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS or not _get_state('use_replicas') or _get_state('pinned'):
+            return 'default'
+        return _state.replica
+
+    def db_for_write(self, model, **hints):
+        # every following read of this request and client goes to the primary
+        # (only for writes in the request's thread, writes of the write queue run in its writer thread)
+        _state.pinned = True
+        _state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas are copies of the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class ReplicaPinningMiddleware(object):
+    """
+    Enables replica reads for the views in DATABASE_REPLICA_VIEWS and pins clients which have written
+    to the primary with a cookie. Unsafe requests (POST, ...) never read from replicas and always pin
+    the client when they succeed, whichever thread wrote for them (see eventserver.sqlite.WriteQueue).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _state.use_replicas = False
+        _state.pinned = settings.DATABASE_REPLICA_PIN_COOKIE in request.COOKIES \
+            or request.method not in ('GET', 'HEAD', 'OPTIONS')
+        _state.wrote = False
+
+        try:
+            response = self.get_response(request)
+
+            if _state.wrote or (request.method in WRITE_METHODS and response.status_code < 400):
+                response.set_cookie(settings.DATABASE_REPLICA_PIN_COOKIE, '1',
+                                    max_age=settings.DATABASE_REPLICA_PIN_SECONDS)
+            return response
+        finally:
+            _state.use_replicas = False
+            _state.pinned = False
+            _state.wrote = False
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.resolver_match.url_name in settings.DATABASE_REPLICA_VIEWS and settings.DATABASE_REPLICAS:
+            _state.use_replicas = True
+            _state.replica = random.choice(settings.DATABASE_REPLICAS)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
 import os
+import tempfile
 
 from local_settings import *
 
@@ -20,6 +21,18 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 THUMBNAIL_SIZE = (256, 256)
 WEB_PHOTO_SIZE = (1024, 1024)
 
+# number of photos embedded in each user of the user listing
+USER_PHOTO_PREVIEW_SIZE = 3
+
+# write-behind mode for like toggles, see eventphotos.likebuffer
+LIKE_WRITE_BEHIND = False
+# flush interval in milliseconds (0: only flush when LIKE_WRITE_BEHIND_MAX_PENDING is reached)
+LIKE_WRITE_BEHIND_FLUSH_INTERVAL = 500
+LIKE_WRITE_BEHIND_MAX_PENDING = 10000
+# optional journal file (one per process: <LIKE_WRITE_BEHIND_JOURNAL>.<pid>), pending toggles survive a crash if set
+LIKE_WRITE_BEHIND_JOURNAL = None
+LIKE_WRITE_BEHIND_JOURNAL_FSYNC = False
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.11/howto/deployment/checklist/
 
@@ -53,14 +66,50 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
     ],
     'DEFAULT_PAGINATION_CLASS': 'eventserver.pagination.UserControlledPagination',
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'eventserver.renderers.MessagePackRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+        'eventserver.parsers.MessagePackParser',
+    ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'eventphotos.authentication.TokenAwareSessionAuthentication',
+        'eventphotos.authentication.CachedTokenAuthentication',
     )
 }
 
+# seconds a token -> user snapshot is cached (see eventphotos.authentication),
+# with several processes CACHES has to point to a shared cache for the invalidation to reach all of them
+AUTH_TOKEN_CACHE_TIMEOUT = 60
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # responses replayed for retried POSTs with an Idempotency-Key header, bounded by MAX_ENTRIES,
+    # shared by all processes (a retry may reach another one), the table is created by manage.py createcachetable
+    'idempotency': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'idempotency_cache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+# seconds a response is replayed for retries with the same Idempotency-Key,
+# and seconds a retry is answered with 409 while the first request is still processed
+IDEMPOTENCY_KEY_TIMEOUT = 24 * 60 * 60
+IDEMPOTENCY_PENDING_TIMEOUT = 5 * 60
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    'eventserver.routers.ReplicaPinningMiddleware',
+    'eventphotos.ranking.BatchedRankingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -91,6 +140,13 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'eventserver.wsgi.application'
 
+# ASGI entry point (eventserver.asgi): connections are served on the event loop, the views run in threads,
+# GET/HEAD requests of ASGI_READ_VIEWS (url names) in ASGI_READ_THREADS, all others in ASGI_WRITE_THREADS
+ASGI_APPLICATION = 'eventserver.asgi.application'
+ASGI_READ_VIEWS = ['events-metadata', 'single-event-metadata', 'photo-list', 'photo-detail']
+ASGI_READ_THREADS = 8
+ASGI_WRITE_THREADS = 4
+
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
 
@@ -101,6 +157,58 @@ DATABASES = {
     }
 }
 
+# read replicas, e.g. a copy of the SQLite file or a PostgreSQL streaming replica:
+# DATABASES['replica1'] = {
+#     'ENGINE': 'django.db.backends.sqlite3',
+#     'NAME': os.path.join(BASE_DIR, 'db.replica1.sqlite3'),
+#     'TEST': {'MIRROR': 'default'},
+# }
+# DATABASE_REPLICAS = ['replica1']
+DATABASE_ROUTERS = ['eventphotos.sharding.EventShardRouter', 'eventserver.routers.ReplicaRouter']
+DATABASE_REPLICAS = []
+# views (url names) whose reads may go to a replica
+DATABASE_REPLICA_VIEWS = ['photo-list', 'photo-detail', 'like-list', 'like-detail', 'events-metadata']
+# after a write, the client reads from the primary for this long
+DATABASE_REPLICA_PIN_SECONDS = 15
+DATABASE_REPLICA_PIN_COOKIE = 'primary_pin'
+
+# one SQLite database per event for photos, likes and authorisations (see eventphotos.sharding),
+# events and users stay in 'default'
+EVENT_SHARDING = False
+EVENT_SHARD_ROOT = os.path.join(BASE_DIR, 'event_databases')
+
+# high-concurrency SQLite profile, applied to every new connection (see eventserver.sqlite)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000,
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # in KiB
+}
+
+# serialize and batch short write transactions (likes, photo rows) through one writer thread per process
+SQLITE_WRITE_QUEUE = True
+SQLITE_WRITE_QUEUE_MAX_BATCH = 100
+
+# admission control of photo uploads (eventphotos.admission): at most
+# UPLOAD_ADMISSION_WORKERS * (1 - UPLOAD_ADMISSION_READ_RESERVE) uploads are processed per process
+# (set UPLOAD_ADMISSION_WORKERS to the worker threads of a process, the rest stays free for reads),
+# at most UPLOAD_ADMISSION_GLOBAL_LIMIT on the host (flock'd slot files below UPLOAD_ADMISSION_LOCK_DIR,
+# which has to be local and shared by all processes of the site)
+# and at most UPLOAD_ADMISSION_EVENT_LIMIT / _USER_LIMIT per event / user (overridden by pk in the
+# *_LIMITS dicts). Excess uploads are answered at once (without reading their body, apart from the event
+# limit) with 429 and Retry-After: UPLOAD_ADMISSION_RETRY_AFTER
+UPLOAD_ADMISSION = True
+UPLOAD_ADMISSION_WORKERS = 4
+UPLOAD_ADMISSION_READ_RESERVE = 0.5
+UPLOAD_ADMISSION_GLOBAL_LIMIT = 8
+UPLOAD_ADMISSION_EVENT_LIMIT = 4
+UPLOAD_ADMISSION_EVENT_LIMITS = {}
+UPLOAD_ADMISSION_USER_LIMIT = 2
+UPLOAD_ADMISSION_USER_LIMITS = {}
+UPLOAD_ADMISSION_LOCK_DIR = os.path.join(tempfile.gettempdir(), 'eventphotos_upload_slots')
+UPLOAD_ADMISSION_RETRY_AFTER = 5
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -140,3 +248,75 @@ STATIC_URL = '/static/'
 
 MEDIA_ROOT = BASE_DIR + '/media'
 MEDIA_URL = '/media/'
+
+# new media files go to hash-prefixed directories (photos/9d/4e/x.jpg), existing ones are moved with
+# manage.py migrate_media_layout. Originals moved into cold storage by manage.py archive_originals are
+# read from their containers. 'eventserver.storage.S3Storage' (needs boto3) keeps the files in the bucket
+# MEDIA_S3_BUCKET of an S3 compatible object store instead (AWS S3, or e.g. MinIO as local stand-in)
+DEFAULT_FILE_STORAGE = 'eventphotos.coldstorage.TieredFileSystemStorage'
+MEDIA_FANOUT_LEVELS = 2
+MEDIA_S3_BUCKET = 'eventphotos'
+MEDIA_S3_ENDPOINT_URL = None
+MEDIA_S3_ACCESS_KEY = None
+MEDIA_S3_SECRET_KEY = None
+MEDIA_S3_URL_EXPIRES = 60 * 60
+
+# originals of events which ended COLD_STORAGE_AFTER_DAYS ago are packed into container files
+# of at most COLD_STORAGE_CONTAINER_SIZE bytes below COLD_STORAGE_ROOT (manage.py archive_originals),
+# zlib compressed with COLD_STORAGE_COMPRESSION_LEVEL where that makes them smaller
+COLD_STORAGE_ROOT = BASE_DIR + '/cold_storage'
+COLD_STORAGE_AFTER_DAYS = 90
+COLD_STORAGE_CONTAINER_SIZE = 1024 * 1024 * 1024
+COLD_STORAGE_COMPRESSION_LEVEL = 9
+
+# media files are served by eventphotos.views.media after the event authorisation check,
+# the transfer itself is handed to the front-end server:
+# - None: Django streams the file (development)
+# - 'nginx': X-Accel-Redirect to MEDIA_ACCEL_PREFIX, which has to be an internal location aliasing MEDIA_ROOT
+# - 'sendfile': X-Sendfile with the absolute path (Apache mod_xsendfile, lighttpd)
+MEDIA_ACCEL = None
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+# photo, thumbnail and web_photo urls are signed and valid for one to two buckets, everybody gets
+# the same url during a bucket so caching proxies (nginx proxy_cache, varnish) can share the response
+MEDIA_SIGNED_URLS = True
+MEDIA_URL_BUCKET_SECONDS = 24 * 60 * 60
+# Cache-Control max-age of unsigned media responses, file names are never reused for other content
+MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+
+# maximum number of photos per /api/photo-files/ request
+PHOTO_FILES_MAX_BATCH = 200
+
+# thumbnail sprite sheets (/api/photos/sprite/): cell size, cells per row, JPEG quality
+# and seconds the coordinates of a sheet are cached
+PHOTO_SPRITE_CELL_SIZE = (128, 128)
+PHOTO_SPRITE_COLUMNS = 10
+PHOTO_SPRITE_QUALITY = 85
+PHOTO_SPRITE_CACHE_TIMEOUT = 24 * 60 * 60
+
+# default and minimum bucket size (seconds) of /api/photos/histogram/
+PHOTO_HISTOGRAM_BUCKET = 10 * 60
+PHOTO_HISTOGRAM_MIN_BUCKET = 60
+
+# maximum number of words of a photo search (/api/photos/?event_id=..&search=..)
+PHOTO_SEARCH_MAX_TERMS = 10
+
+# uploads whose perceptual hash differs from one of an earlier photo of the event in at most this many
+# of 64 bits are flagged as its duplicate (duplicate_of, hidden from feeds with collapse_duplicates=true)
+PHOTO_DUPLICATE_DISTANCE = 6
+# number of events whose hash index a process keeps in memory (least recently used ones are dropped)
+PHOTO_DUPLICATE_INDEX_EVENTS = 100
+
+# "best of" ranking per event (sort_order=best, see eventphotos.ranking): number of ranked photos,
+# weight of log2(1 + likes) against the upload time in BEST_PHOTOS_HALF_LIFE seconds, and the score
+# every further photo of an uploader loses
+BEST_PHOTOS_COUNT = 100
+BEST_PHOTOS_LIKES_WEIGHT = 1.0
+BEST_PHOTOS_HALF_LIFE = 2 * 60 * 60
+BEST_PHOTOS_OWNER_PENALTY = 1.0
+
+# number of top photos and contributors of /api/events/<id>/stats/
+EVENT_STATS_TOP = 10
+
+# seconds the results of the event authorisation check for media files are cached
+EVENT_AUTH_CACHE_TIMEOUT = 60
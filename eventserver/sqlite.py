@@ -0,0 +1,106 @@
+import queue
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    """
+    Applies SQLITE_PRAGMAS (WAL mode, busy timeout, ...) to every new SQLite connection.
+    """
+    if connection.vendor != 'sqlite':
+        return
+
+    for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+        connection.connection.execute('PRAGMA {} = {}'.format(name, value))
+
+
+class WriteJob(object):
+    def __init__(self, fn, using: str):
+        self.fn = fn
+        self.using = using
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+
+
+class WriteQueue(object):
+    """
+    Serializes short write transactions of this process through a single writer thread.
+
+    Jobs which are queued while the writer is busy are committed together in one transaction
+    (each job in its own savepoint), so concurrent requests neither wait for the SQLite write lock
+    nor pay for one commit each. Enabled with SQLITE_WRITE_QUEUE, otherwise jobs run in the calling thread.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, fn, using: str = DEFAULT_DB_ALIAS):
+        """
+        Runs fn in a transaction on the database using and returns its result, fn's exceptions are re-raised.
+        """
+        if not getattr(settings, 'SQLITE_WRITE_QUEUE', False) \
+                or threading.current_thread() is self.thread \
+                or any(connection.in_atomic_block for connection in connections.all()):
+            # the writer thread could not see (or would wait for) the caller's open transactions,
+            # on whichever database (event databases of the sharding)
+            with transaction.atomic(using=using):
+                return fn()
+
+        self._start()
+
+        job = WriteJob(fn, using)
+        self.queue.put(job)
+        job.done.wait()
+
+        if job.exception is not None:
+            raise job.exception
+        return job.result
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            # take everything that queued up while the last batch was written
+            jobs = [self.queue.get()]
+            while len(jobs) < settings.SQLITE_WRITE_QUEUE_MAX_BATCH:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # one transaction per database
+            batches = {}
+            for job in jobs:
+                batches.setdefault(job.using, []).append(job)
+
+            for using, batch in batches.items():
+                try:
+                    with transaction.atomic(using=using):
+                        for job in batch:
+                            try:
+                                with transaction.atomic(using=using):
+                                    job.result = job.fn()
+                            except Exception as e:
+                                job.exception = e
+                except Exception as e:
+                    # commit failed
+                    for job in batch:
+                        job.exception = job.exception or e
+                finally:
+                    for job in batch:
+                        job.done.set()
+
+
+write_queue = WriteQueue()
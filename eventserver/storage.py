@@ -0,0 +1,129 @@
+import hashlib
+import mimetypes
+import posixpath
+import shutil
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, Storage
+from django.utils.deconstruct import deconstructible
+
+
+class HashedNameMixin(object):
+    """
+    Puts new files of a FileField into MEDIA_FANOUT_LEVELS levels of directories named after the
+    md5 of the file name (photos/x.jpg -> photos/9d/4e/x.jpg), so that no directory grows too large.
+    """
+
+    def generate_filename(self, filename):
+        return self.fan_out(super(HashedNameMixin, self).generate_filename(filename))
+
+    @staticmethod
+    def fan_out(name: str) -> str:
+        dirname, basename = posixpath.split(name.replace('\\', '/'))
+        digest = hashlib.md5(basename.encode('utf8')).hexdigest()
+        prefixes = [digest[2 * i:2 * i + 2] for i in range(settings.MEDIA_FANOUT_LEVELS)]
+        return posixpath.join(dirname, *(prefixes + [basename]))
+
+
+@deconstructible
+class HashedFileSystemStorage(HashedNameMixin, FileSystemStorage):
+    pass
+
+
+def _is_not_found(e: Exception) -> bool:
+    error = getattr(e, 'response', {}).get('Error', {})
+    return error.get('Code', None) in ('404', 'NoSuchKey', 'NotFound')
+
+
+@deconstructible
+class S3Storage(HashedNameMixin, Storage):
+    """
+    Stores files in the bucket MEDIA_S3_BUCKET of an S3 compatible object store (AWS S3, MinIO, Ceph, ...)
+    at MEDIA_S3_ENDPOINT_URL, requires boto3. Any client with the boto3 S3 client methods used here can be
+    passed instead, e.g. one for a local stand-in.
+
+    Files are downloaded completely on open (into memory or a temporary file), urls are presigned and
+    valid for MEDIA_S3_URL_EXPIRES seconds.
+    """
+
+    def __init__(self, bucket=None, endpoint_url=None, client=None):
+        self.bucket = bucket or settings.MEDIA_S3_BUCKET
+        self.endpoint_url = endpoint_url or settings.MEDIA_S3_ENDPOINT_URL
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise ImproperlyConfigured('S3Storage requires boto3')
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url,
+                                        aws_access_key_id=settings.MEDIA_S3_ACCESS_KEY,
+                                        aws_secret_access_key=settings.MEDIA_S3_SECRET_KEY)
+        return self._client
+
+    def _head(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=name)
+        except Exception as e:
+            if _is_not_found(e):
+                raise FileNotFoundError(name)
+            raise
+
+    def _open(self, name, mode='rb'):
+        if 'w' in mode or 'a' in mode or '+' in mode:
+            raise ValueError('S3Storage files are read-only, use save()')
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=name)['Body']
+        except Exception as e:
+            if _is_not_found(e):
+                raise FileNotFoundError(name)
+            raise
+        f = SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        shutil.copyfileobj(body, f)
+        f.seek(0)
+        return File(f, name)
+
+    def _save(self, name, content):
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        content_type, encoding = mimetypes.guess_type(name)
+        self.client.put_object(Bucket=self.bucket, Key=name, Body=content.read(),
+                               ContentType=content_type or 'application/octet-stream')
+        return name
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+    def exists(self, name):
+        try:
+            self._head(name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def size(self, name):
+        return self._head(name)['ContentLength']
+
+    def get_modified_time(self, name):
+        return self._head(name)['LastModified']
+
+    def url(self, name):
+        return self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': name},
+                                                  ExpiresIn=settings.MEDIA_S3_URL_EXPIRES)
+
+    def listdir(self, path):
+        prefix = path.rstrip('/') + '/' if path else ''
+        directories, files = [], []
+        kwargs = {'Bucket': self.bucket, 'Prefix': prefix, 'Delimiter': '/'}
+        while True:
+            result = self.client.list_objects_v2(**kwargs)
+            directories += [p['Prefix'][len(prefix):].rstrip('/') for p in result.get('CommonPrefixes', [])]
+            files += [o['Key'][len(prefix):] for o in result.get('Contents', [])]
+            if not result.get('IsTruncated', False):
+                return directories, files
+            kwargs['ContinuationToken'] = result['NextContinuationToken']
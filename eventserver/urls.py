@@ -14,7 +14,6 @@ Including another URLconf
     2. Add a URL to urlpatterns:  url(r'^blog/', include('blog.urls'))
 """
 from django.conf.urls import url, include
-from django.conf.urls.static import static
 from django.contrib import admin
 from rest_framework import routers
 
@@ -22,7 +21,7 @@ from eventphotos import views
 from eventserver import settings
 
 router = routers.DefaultRouter()
-router.register(r'users', views.UserViewSet)
+router.register(r'users', views.UserViewSet, base_name='user')
 router.register(r'authenticateduserforevent', views.AuthenticatedUserForEventViewSet)
 router.register(r'events', views.EventViewSet, base_name='event')
 router.register(r'photos', views.PhotoViewSet, base_name='photo')
@@ -38,12 +37,14 @@ urlpatterns = [
     url(r'^api/events-metadata/', views.events_metadata, name='events-metadata'),
     url(r'^api/single-event-metadata/(?P<event_id>\d+)', views.single_event_metadata, name='single-event-metadata'),
     url(r'^api/like-photo/', views.like_photo, name='like-photo'),
+    url(r'^api/like-photos/', views.like_photos, name='like-photos'),
+    url(r'^api/photo-files/', views.photo_files, name='photo-files'),
+    url(r'^api/export-event-photos/(?P<event_id>\d+)', views.export_event_photos, name='export-event-photos'),
 
     url(r'^api/', include(router.urls)),
 
     url(r'^api/auth/', include('rest_framework.urls', namespace='rest_framework')),
     # url(r'^api/token-auth/', rest_views.obtain_auth_token),
-]
 
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    url(r'^{}(?P<path>.+)$'.format(settings.MEDIA_URL.lstrip('/')), views.media, name='media'),
+]